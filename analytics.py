@@ -0,0 +1,159 @@
+import json
+
+# 默认不计入均分和GPA的课程性质
+EXCLUDED_TYPES = ('校公选课',)
+
+
+def bit_points(score):
+    """
+    北理工GPA公式：60分及以上为 4 - 3 * (100 - 分数)² / 1600，60分以下为0
+    :param score: 百分制分数
+    :return: 绩点
+    """
+    return 4 - 3 * (100 - score) ** 2 / 1600 if score >= 60 else 0
+
+
+def threshold_scale(thresholds):
+    """
+    由分段表生成绩点函数
+    :param thresholds: [(最低分, 绩点)]，不低于最低分时取对应绩点，都不满足时为0
+    :return: 绩点函数
+    """
+    thresholds = sorted(((float(low), float(points)) for low, points in thresholds), reverse=True)
+    
+    def points(score):
+        for low, value in thresholds:
+            if score >= low:
+                return value
+        return 0
+    
+    return points
+
+
+GPA_SCALES = {
+    'bit': bit_points,
+    'standard': threshold_scale([(90, 4), (80, 3), (70, 2), (60, 1)]),
+}
+
+
+def set_gpa_scales(scales):
+    """
+    设置GPA绩点表，已有的同名绩点表会被替换
+    :param dict scales: { 名称: [[最低分, 绩点]] }，名称为'bit'时使用北理工公式
+    :return: 无
+    """
+    for name, thresholds in scales.items():
+        GPA_SCALES[name] = bit_points if name == 'bit' else threshold_scale(thresholds)
+
+
+def empty():
+    return {'count': 0, 'credits': 0.0, 'score_sum': 0.0, 'histogram': {}, 'class_rank_sum': 0.0,
+            'class_rank_credits': 0.0, 'majority_rank_sum': 0.0, 'majority_rank_credits': 0.0}
+
+
+def aggregate(rows):
+    """
+    计算一组成绩的聚合数据，同一学期同一课程性质的成绩为一组
+    :param rows: [(分数, 学分, 班级排名百分比, 专业排名百分比)]，排名可以为None
+    :return: 聚合数据字典，格式{ 'count', 'credits', 'score_sum': 学分加权总分, 'histogram': { 分数: 学分 },
+             'class_rank_sum', 'class_rank_credits', 'majority_rank_sum', 'majority_rank_credits' }
+    """
+    agg = empty()
+    for score, credit, class_rank, majority_rank in rows:
+        credit = credit or 0
+        agg['count'] += 1
+        agg['credits'] += credit
+        agg['score_sum'] += score * credit
+        agg['histogram'][str(score)] = agg['histogram'].get(str(score), 0) + credit
+        if class_rank is not None:
+            agg['class_rank_sum'] += class_rank * credit
+            agg['class_rank_credits'] += credit
+        if majority_rank is not None:
+            agg['majority_rank_sum'] += majority_rank * credit
+            agg['majority_rank_credits'] += credit
+    return agg
+
+
+def merge(aggregates):
+    """
+    合并多组聚合数据
+    :param aggregates: 聚合数据迭代器
+    :return: 合并后的聚合数据
+    """
+    res = empty()
+    for agg in aggregates:
+        for key, value in agg.items():
+            if key == 'histogram':
+                for score, credit in value.items():
+                    res['histogram'][score] = res['histogram'].get(score, 0) + credit
+            else:
+                res[key] += value
+    return res
+
+
+def encode_histogram(agg):
+    return json.dumps(agg['histogram'], separators=(',', ':'))
+
+
+def decode(row):
+    """
+    从数据库行恢复聚合数据
+    :param row: AGGREGATES表中从Count到MajorityRankCredits的各列
+    :return: 聚合数据
+    """
+    return {'count': row[0], 'credits': row[1], 'score_sum': row[2], 'histogram': json.loads(row[3]),
+            'class_rank_sum': row[4], 'class_rank_credits': row[5], 'majority_rank_sum': row[6],
+            'majority_rank_credits': row[7]}
+
+
+def gpa(agg, scale):
+    """
+    计算学分加权GPA
+    :param agg: 聚合数据
+    :param scale: 绩点函数
+    :return: GPA，没有学分时为None
+    """
+    if agg['credits'] <= 0:
+        return None
+    return sum(scale(float(score)) * credit for score, credit in agg['histogram'].items()) / agg['credits']
+
+
+def summarize(groups, exclude_types=EXCLUDED_TYPES):
+    """
+    汇总若干组聚合数据
+    :param groups: [(学期, 课程性质, 聚合数据)]
+    :param exclude_types: 不计入均分、GPA和排名的课程性质
+    :return: { 'count', 'credits', 'average': 加权均分, 'average_all': 含排除课程的加权均分, 'gpa': { 绩点表名: GPA },
+               'credits_by_type': { 课程性质: 学分 }, 'class_rank', 'majority_rank': 学分加权的排名百分比 }，
+             均分和GPA没有学分时为None
+    """
+    counted = merge(agg for _, course_type, agg in groups if course_type not in exclude_types)
+    total = merge(agg for _, _, agg in groups)
+    credits_by_type = {}
+    for _, course_type, agg in groups:
+        credits_by_type[course_type] = credits_by_type.get(course_type, 0) + agg['credits']
+    return {
+        'count': counted['count'],
+        'credits': counted['credits'],
+        'average': counted['score_sum'] / counted['credits'] if counted['credits'] > 0 else None,
+        'average_all': total['score_sum'] / total['credits'] if total['credits'] > 0 else None,
+        'gpa': {name: gpa(counted, scale) for name, scale in GPA_SCALES.items()},
+        'credits_by_type': credits_by_type,
+        'class_rank': counted['class_rank_sum'] / counted['class_rank_credits']
+        if counted['class_rank_credits'] > 0 else None,
+        'majority_rank': counted['majority_rank_sum'] / counted['majority_rank_credits']
+        if counted['majority_rank_credits'] > 0 else None,
+    }
+
+
+def term_trend(groups, exclude_types=EXCLUDED_TYPES):
+    """
+    按学期汇总，用于查看均分和排名的变化趋势
+    :param groups: [(学期, 课程性质, 聚合数据)]
+    :param exclude_types: 不计入均分、GPA和排名的课程性质
+    :return: [(学期, summarize的结果)]，按学期排序
+    """
+    terms = {}
+    for group in groups:
+        terms.setdefault(group[0], []).append(group)
+    return [(term, summarize(terms[term], exclude_types)) for term in sorted(terms)]
@@ -0,0 +1,599 @@
+import asyncio
+import atexit
+import contextlib
+import datetime
+import email.utils
+import json
+import logging
+import threading
+import time
+import weakref
+from collections import namedtuple
+from http.cookies import SimpleCookie
+
+import aiohttp
+from yarl import URL
+
+import metrics
+import parsers
+from bit import HOSTS, LOGIN_TTL, STATE_VERSION, TERM_CACHE, WEBVPN_JWXT, Bit, BitInfoError, TermWeeks, \
+    UpstreamAttempts, build_ics, decode_state, decrypt_secret, encode_state, encrypt_password, encrypt_secret, \
+    migrate_state, render_classes_ics
+import bit as bit_module
+
+Response = namedtuple('Response', ['status', 'url', 'text', 'is_redirect'])
+
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+# 每个事件循环各自的主机并发信号量和共享连接池
+_loop_semaphores = weakref.WeakKeyDictionary()
+_loop_connectors = weakref.WeakKeyDictionary()
+_loop_thread = None
+_loop_thread_lock = threading.Lock()
+
+
+def host_slot(url):
+    """
+    获取url所在主机在当前事件循环中的并发槽位，上限与bit.set_host_concurrency一致
+    :param url: 请求url
+    :return: 异步上下文管理器
+    """
+    limit = bit_module._host_concurrency
+    if limit <= 0:
+        return contextlib.nullcontext()
+    semaphores = _loop_semaphores.setdefault(asyncio.get_running_loop(), {})
+    host = URL(url).host
+    if host not in semaphores:
+        semaphores[host] = asyncio.BoundedSemaphore(limit)
+    return semaphores[host]
+
+
+def get_connector():
+    """
+    获取当前事件循环共享的连接池，所有AsyncBit实例复用同一组连接
+    :return: aiohttp.TCPConnector
+    """
+    loop = asyncio.get_running_loop()
+    connector = _loop_connectors.get(loop)
+    if connector is None or connector.closed:
+        connector = aiohttp.TCPConnector(limit=100, limit_per_host=0)
+        _loop_connectors[loop] = connector
+    return connector
+
+
+async def close_connector():
+    """
+    关闭当前事件循环共享的连接池，在事件循环结束前调用
+    :return: 无
+    """
+    connector = _loop_connectors.pop(asyncio.get_running_loop(), None)
+    if connector is not None:
+        await connector.close()
+
+
+def get_loop():
+    """
+    获取供同步调用使用的后台事件循环，首次调用时在守护线程中启动
+    :return: 事件循环
+    """
+    global _loop_thread
+    with _loop_thread_lock:
+        if _loop_thread is None:
+            loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=loop.run_forever, name='async-bit', daemon=True)
+            _loop_thread.loop = loop
+            _loop_thread.start()
+            atexit.register(shutdown_loop)
+        return _loop_thread.loop
+
+
+def shutdown_loop(timeout=5):
+    """
+    关闭后台事件循环的共享连接池并停止事件循环，进程退出时自动调用
+    :param timeout: 等待连接池关闭的最长时间，单位秒
+    :return: 无
+    """
+    global _loop_thread
+    with _loop_thread_lock:
+        thread, _loop_thread = _loop_thread, None
+    if thread is None:
+        return
+    atexit.unregister(shutdown_loop)
+    try:
+        asyncio.run_coroutine_threadsafe(close_connector(), thread.loop).result(timeout)
+    except Exception as e:
+        logging.warning(f"关闭后台事件循环的连接池失败：{repr(e)}")
+    finally:
+        thread.loop.call_soon_threadsafe(thread.loop.stop)
+        thread.join(timeout)
+        if not thread.loop.is_running():
+            thread.loop.close()
+
+
+def submit(coro):
+    """
+    将协程提交到后台事件循环
+    :param coro: 协程
+    :return: concurrent.futures.Future
+    """
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+class AsyncBit:
+    """
+    基于asyncio的BIT客户端，解析函数和会话状态格式与Bit相同，可用to_state/from_state互相转换
+    需要在事件循环中创建，同步代码请使用SyncBit
+    """
+    
+    def __init__(self, username=None, password=None):
+        self.department = ''
+        self.name = ''
+        self.username = username
+        self.__password = password
+        self.scores = {}
+        self.currentTerm = ''
+        self.classTime = {}
+        self.loginTime = {}
+        self.missingWeeks = []
+        self.scoresFingerprint = None
+        self.scoresUnchanged = False
+        self.__cookies = aiohttp.CookieJar(unsafe=True)
+        self.__session = None
+        self.__login_lock = None
+        self.__relogin_time = {}
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.close()
+    
+    def __get_session(self):
+        if self.__session is None or self.__session.closed:
+            self.__session = aiohttp.ClientSession(connector=get_connector(), connector_owner=False,
+                                                   cookie_jar=self.__cookies)
+        return self.__session
+    
+    async def close(self):
+        """
+        关闭会话，cookie保留在对象中
+        :return: 无
+        """
+        if self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+    
+    async def __request(self, method, url, allow_redirects=True, **kwargs):
+        """
+        发送请求并读取完整响应，超时、重试和熔断规则同Bit
+        :param method: 请求方法
+        :param url: 请求url
+        :return: Response
+        """
+        attempts = UpstreamAttempts(method, url)
+        connect, read = attempts.timeout
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(sock_connect=connect, sock_read=read))
+        for _ in attempts:
+            try:
+                async with host_slot(url):
+                    with metrics.track_upstream(attempts.endpoint):
+                        async with self.__get_session().request(method, url, allow_redirects=allow_redirects,
+                                                                **kwargs) as response:
+                            result = Response(response.status, str(response.url),
+                                              await response.text(errors='replace'),
+                                              response.status in REDIRECT_STATUS)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if not attempts.failed(e):
+                    raise
+            else:
+                if attempts.finished(result.status):
+                    return result
+            await asyncio.sleep(attempts.backoff())
+    
+    @staticmethod
+    def __is_login_redirect(response):
+        login_pages = (f"{HOSTS['login']}/authserver/login", f"{HOSTS['webvpn']}/login")
+        return response.is_redirect or response.url.startswith(login_pages)
+    
+    async def __relogin(self, realm):
+        if realm == 'webvpn':
+            await self.webvpn_login()
+        else:
+            await self.login()
+    
+    async def __ensure_login(self, realm):
+        """
+        确认登录状态，规则同Bit
+        :param realm: 'cas'为统一身份认证，'webvpn'为webvpn
+        :return: 无
+        """
+        if not bit_module._login_probe or time.time() - self.loginTime.get(realm, 0) < LOGIN_TTL:
+            return
+        if realm == 'webvpn':
+            if not await self.check_webvpn_login():
+                await self.webvpn_login()
+        elif not await self.check_login_status():
+            await self.login()
+    
+    async def __fetch(self, method, url, realm, **kwargs):
+        """
+        以登录身份请求数据接口，被重定向到登录页时重新登录并重试一次，同一对象的并发请求只重新登录一次
+        :param method: 请求方法
+        :param url: 请求url
+        :param realm: 'cas'为统一身份认证，'webvpn'为webvpn
+        :return: Response
+        """
+        if method == 'POST':
+            kwargs.setdefault('allow_redirects', False)
+        started = time.time()
+        response = await self.__request(method, url, **kwargs)
+        if self.__is_login_redirect(response):
+            metrics.UPSTREAM_ERRORS.inc(bit_module.endpoint_name(url), 'login_expired')
+            if self.__login_lock is None:
+                self.__login_lock = asyncio.Lock()
+            async with self.__login_lock:
+                if self.__relogin_time.get(realm, 0) < started:
+                    logging.info(f"{self.username} 的{realm}登录失效，重新登录")
+                    self.loginTime.pop(realm, None)
+                    await self.__relogin(realm)
+                    self.__relogin_time[realm] = time.time()
+            response = await self.__request(method, url, **kwargs)
+            if self.__is_login_redirect(response):
+                raise BitInfoError("登录失败")
+        self.loginTime[realm] = time.time()
+        return response
+    
+    async def check_account_status(self):
+        """
+        检查账号状态，返回False说明账号异常
+        :return: 账号是否正常
+        """
+        result = await self.__request('GET', f"{HOSTS['login']}/authserver/checkNeedCaptcha.htl",
+                                      params={'username': self.username})
+        return not json.loads(result.text)['isNeed']
+    
+    async def check_login_status(self):
+        """
+        检查统一身份认证登录状态，未登录返回False
+        :return: 是否已经登录
+        """
+        result = await self.__request('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/xskcb/cxxsjbxx.do",
+                                      allow_redirects=False)
+        if result.status != 200:
+            logging.info(f"{self.username} 的统一身份认证登录失效")
+            return False
+        self.loginTime['cas'] = time.time()
+        return True
+    
+    async def check_webvpn_login(self):
+        """
+        检查webvpn登录状态，未登录返回False
+        :return: 是否已经登录
+        """
+        result = await self.__request('GET', f"{HOSTS['webvpn']}{WEBVPN_JWXT}/framework/main.jsp",
+                                      allow_redirects=False)
+        if result.status != 200:
+            logging.info(f"{self.username} 的webvpn登录失效")
+            return False
+        self.loginTime['webvpn'] = time.time()
+        return True
+    
+    async def login_to_url(self, login_url):
+        """
+        登录到url，规则同Bit.login_to_url
+        :param login_url: 登录url
+        :return: 无
+        """
+        if bit_module._login_probe and not await self.check_account_status():
+            raise BitInfoError("账号异常")
+        result = await self.__request('GET', login_url)
+        form = parsers.parse_login_form(result.text)
+        if form is None:
+            return
+        param_execution, password_salt = form
+        data = {
+            'username': self.username,
+            'password': encrypt_password(self.__password, password_salt),
+            'captcha': '',
+            'rememberMe': 'true',
+            '_eventId': 'submit',
+            'cllt': 'userNameLogin',
+            'dllt': 'generalLogin',
+            'lt': '',
+            'execution': param_execution
+        }
+        result = await self.__request('POST', result.url, data=data)
+        if result.status == 401:
+            if not bit_module._login_probe and not await self.check_account_status():
+                raise BitInfoError("账号异常")
+            raise BitInfoError("密码错误")
+    
+    async def login(self):
+        """
+        执行登录操作，TTL内已登录时直接返回
+        :return: 无
+        """
+        if self.username is None or self.__password is None:
+            raise BitInfoError("账号或密码不能为空")
+        if time.time() - self.loginTime.get('cas', 0) < LOGIN_TTL:
+            return
+        if bit_module._login_probe and await self.check_login_status():
+            return
+        await self.login_to_url(f"{HOSTS['login']}/authserver/login")
+        await self.__request('GET', f"{HOSTS['ehall']}/login?service={HOSTS['ehall']}/new/index.html")
+        await self.__request('GET', f"{HOSTS['ehall']}/appShow?appId=5959167891382285")
+        self.loginTime['cas'] = time.time()
+        await self.webvpn_login()
+    
+    async def webvpn_login(self):
+        """
+        登录webvpn
+        :return: 无
+        """
+        self.__cookies.update_cookies({'show_vpn': '0', 'refresh': '1'}, URL(HOSTS['webvpn']))
+        await self.login_to_url(f"{HOSTS['webvpn']}/login?cas_login=true")
+        await self.__request('GET', f"{HOSTS['webvpn']}{WEBVPN_JWXT}/kscj/cjcx_list")
+        self.loginTime['webvpn'] = time.time()
+    
+    def to_state(self):
+        """
+        导出会话状态，格式同Bit.to_state
+        :return: 可JSON序列化的状态字典
+        """
+        cookies = []
+        for i in self.__cookies:
+            expires = None
+            if i['expires']:
+                try:
+                    expires = int(email.utils.parsedate_to_datetime(i['expires']).timestamp())
+                except (TypeError, ValueError):
+                    pass
+            cookies.append({'name': i.key, 'value': i.value, 'domain': i['domain'], 'path': i['path'] or '/',
+                            'expires': expires, 'secure': bool(i['secure']),
+                            'httponly': bool(i['httponly'])})
+        return {
+            'version': STATE_VERSION,
+            'username': self.username,
+            'password': None if self.__password is None else encrypt_secret(self.__password),
+            'cookies': cookies,
+            'currentTerm': self.currentTerm,
+            'classTime': {i: [self.classTime[i]['begin'].strftime('%H:%M'), self.classTime[i]['end'].strftime('%H:%M')]
+                          for i in self.classTime},
+            'scores': self.scores,
+            'scoresFingerprint': self.scoresFingerprint
+        }
+    
+    @classmethod
+    def from_state(cls, state):
+        """
+        从会话状态恢复对象，状态可以来自Bit或AsyncBit
+        :param state: 会话状态字典
+        :return: AsyncBit对象
+        """
+        state = migrate_state(state)
+        bit = cls(state['username'], None if state['password'] is None else decrypt_secret(state['password']))
+        for i in state['cookies']:
+            if i['expires'] is not None and i['expires'] < time.time():
+                continue
+            cookie = SimpleCookie()
+            cookie[i['name']] = i['value']
+            morsel = cookie[i['name']]
+            morsel['domain'] = i['domain']
+            morsel['path'] = i['path']
+            if i['expires'] is not None:
+                morsel['expires'] = email.utils.formatdate(i['expires'], usegmt=True)
+            if i['secure']:
+                morsel['secure'] = True
+            if i['httponly']:
+                morsel['httponly'] = True
+            bit.__cookies.update_cookies(cookie, URL.build(scheme='https', host=i['domain'].lstrip('.')))
+        bit.currentTerm = state['currentTerm']
+        bit.classTime = {i: {'begin': datetime.datetime.strptime(state['classTime'][i][0], '%H:%M'),
+                             'end': datetime.datetime.strptime(state['classTime'][i][1], '%H:%M')}
+                         for i in state['classTime']}
+        bit.scores = state['scores']
+        bit.scoresFingerprint = state['scoresFingerprint']
+        return bit
+    
+    def serialize(self):
+        """
+        序列化为字节流，与Bit.serialize格式相同
+        :return: 字节流
+        """
+        return encode_state(self.to_state())
+    
+    @classmethod
+    def deserialize(cls, data):
+        """
+        从Bit或AsyncBit序列化得到的字节流恢复对象
+        :param data: 字节流
+        :return: AsyncBit对象
+        """
+        return cls.from_state(decode_state(data))
+    
+    def to_bit(self):
+        """
+        转换为阻塞的Bit对象
+        :return: Bit对象
+        """
+        return Bit.from_state(self.to_state())
+    
+    async def get_info(self):
+        """
+        获取用户姓名和学院
+        :return: {'name': 姓名, 'department': 学院}
+        """
+        await self.__ensure_login('cas')
+        result = await self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/xskcb/cxxsjbxx.do", 'cas')
+        info = parsers.parse_user_info(result.text)
+        self.name = info['name']
+        self.department = info['department']
+        return info
+    
+    async def __get_score_analysis(self, data, slots):
+        async with slots:
+            response = await self.__fetch(
+                'GET',
+                f"{HOSTS['webvpn']}{WEBVPN_JWXT}/kscj/cjfx",
+                'webvpn',
+                params={'xs0101id': self.username,
+                        'xnxq01id': data['term'],
+                        'kch': data['id']
+                        })
+        data.update(parsers.parse_score_analysis(response.text))
+        return data
+    
+    async def get_scores_update(self, refresh_all=False, workers=4):
+        """
+        从webvpn爬取新成绩，返回更新的成绩项，格式和成绩列表指纹规则同Bit.get_scores_update
+        :param refresh_all: 是否刷新全部，默认为否
+        :param workers: 同时获取成绩分析的请求数，默认为4
+        :return: 包含成绩相关信息的字典，顺序与成绩列表一致
+        """
+        await self.__ensure_login('webvpn')
+        response = await self.__fetch('GET', f"{HOSTS['webvpn']}{WEBVPN_JWXT}/kscj/cjcx_list", 'webvpn')
+        rows = parsers.extract_table_rows(response.text)
+        fingerprint = parsers.score_list_fingerprint(rows)
+        self.scoresUnchanged = not refresh_all and fingerprint == self.scoresFingerprint
+        if self.scoresUnchanged:
+            return {}
+        pending = []
+        for data in parsers.parse_score_rows(rows):
+            key = f"{data['id']} - {data['term']}"
+            if not refresh_all and key in self.scores:
+                continue
+            pending.append((key, data))
+        slots = asyncio.Semaphore(max(1, workers))
+        results = await asyncio.gather(*(self.__get_score_analysis(data, slots) for _, data in pending))
+        updates = {}
+        for (key, _), data in zip(pending, results):
+            self.scores[key] = data
+            updates[key] = data
+        self.scoresFingerprint = fingerprint
+        return updates
+    
+    async def __load_current_term(self):
+        await self.__ensure_login('cas')
+        response = await self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/jshkcb/dqxnxq.do", 'cas')
+        return parsers.parse_current_term(response.text)
+    
+    async def get_current_term(self):
+        """
+        获取当前学期并保存，优先使用与Bit共享的缓存，同时未命中时只有一个调用访问上游
+        :return: 当前学期，如2019-2020-1
+        """
+        self.currentTerm = await TERM_CACHE.get_async('currentTerm', self.__load_current_term)
+        return self.currentTerm
+    
+    async def __load_class_time(self):
+        response = await self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/jshkcb/jc.do", 'cas')
+        return parsers.parse_class_time(response.text)
+    
+    async def get_class_time(self):
+        """
+        获取上课时间并保存，优先使用与Bit共享的缓存，同时未命中时只有一个调用访问上游
+        :return: 上课时间表，格式{ '第i节': {'begin': datetime,'end': datetime} }
+        """
+        self.classTime = dict(await TERM_CACHE.get_async('classTime', self.__load_class_time))
+        return self.classTime
+    
+    async def get_week_classes(self, term, week):
+        """
+        获取指定学期指定周的课程信息
+        :param term: 学期，如2019-2020-1
+        :param week: 周次
+        :return: 课程信息list
+        """
+        response = await self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/wdkbByController/cxzkbrq.do",
+                                      'cas', data={'requestParamStr': f'{{"XNXQDM": "{term}", "ZC": "{week}"}}'})
+        dates = parsers.parse_week_dates(response.text)
+        response = await self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/xskcb/cxxszhxqkb.do",
+                                      'cas', data={'XNXQDM': term, 'SKZC': str(week)})
+        return parsers.parse_week_classes(response.text, dates, self.classTime)
+    
+    async def get_term_classes(self, term=None, window=1, partial=False):
+        """
+        获取指定学期课程信息，规则同Bit.get_term_classes
+        :param term: 学期，如2019-2020-1
+        :param window: 每批同时获取的周数，默认为1即逐周获取
+        :param partial: 某周获取失败时是否跳过该周并返回部分课表，默认为否
+        :return: 课程信息list
+        """
+        await self.__ensure_login('cas')
+        await asyncio.gather(self.get_current_term(), self.get_class_time())
+        if term is None:
+            term = self.currentTerm
+        weeks = TermWeeks(term, window, partial)
+        self.missingWeeks = weeks.missing
+        for batch in weeks.batches():
+            results = await asyncio.gather(*(self.get_week_classes(term, i) for i in batch), return_exceptions=True)
+            for i, result in zip(batch, results):
+                if weeks.add(i, result):
+                    break
+        return weeks.classes
+    
+    async def get_term_classes_ics(self, term=None, window=1, partial=False, compress=False):
+        """
+        获取指定学期课程ics格式日程表
+        :return: 课程信息ics，compress时为ics文本
+        """
+        return render_classes_ics(await self.get_term_classes(term, window, partial), compress)
+    
+    async def get_exams(self, term=None):
+        """
+        获取指定学期考试安排信息
+        :param term: 学期，如2019-2020-1
+        :return: 考试安排list
+        """
+        if term is None:
+            term = self.currentTerm
+        response = await self.__fetch(
+            'POST',
+            f"{HOSTS['ehallapp']}/jwapp/sys/studentWdksapApp/WdksapController/cxxsksap.do",
+            'cas',
+            data={'requestParamStr': f'{{"XNXQDM":"{term}","*order":"-KSRQ,-KSSJMS"}}'})
+        return parsers.parse_exams(response.text)
+    
+    async def get_exams_ics(self, term=None):
+        """
+        获取指定学期考试安排ics
+        :param term: 学期，如2019-2020-1
+        :return: 考试安排ics
+        """
+        return build_ics(await self.get_exams(term))
+
+
+class SyncBit:
+    """
+    AsyncBit的同步包装，协程方法在后台事件循环中执行并阻塞等待结果，其余属性直接访问AsyncBit
+    可以替代Bit供现有的同步代码使用
+    """
+    
+    def __init__(self, username=None, password=None, client=None):
+        if client is None:
+            client = self.__run(AsyncBit, username, password)
+        object.__setattr__(self, '_client', client)
+    
+    @staticmethod
+    def __run(func, *args):
+        async def call():
+            return func(*args)
+        return submit(call()).result()
+    
+    @classmethod
+    def deserialize(cls, data):
+        return cls(client=cls.__run(AsyncBit.deserialize, data))
+    
+    def __getattr__(self, item):
+        attr = getattr(self._client, item)
+        if asyncio.iscoroutinefunction(attr):
+            def wrapper(*args, **kwargs):
+                return submit(attr(*args, **kwargs)).result()
+            return wrapper
+        return attr
+    
+    def __setattr__(self, key, value):
+        setattr(self._client, key, value)
+    
+    def close(self):
+        submit(self._client.close()).result()
@@ -0,0 +1,59 @@
+"""
+ics导出基准：比较ics.Calendar逐周导出与RRULE合并后流式导出的文档大小和生成耗时
+
+用法：python -m benchmarks.ics_export [--number 次数] [--weeks 周数] [--classes 每周课程数]
+"""
+import argparse
+import logging
+import timeit
+
+import bit
+import ics_writer
+from benchmarks.stub_server import StubData, StubServer, TERM
+
+
+def expand(events):
+    """
+    将合并后的事件按RRULE和EXDATE展开，用于校验合并结果
+    :param events: compress_weekly得到的事件list
+    :return: 展开后的(名称, 地点, 开始时间, 结束时间)集合
+    """
+    res = set()
+    for i in events:
+        count = int(i['rrule'].split('COUNT=')[1]) if i.get('rrule') else 1
+        for n in range(count):
+            begin = i['begin'] + bit.datetime.timedelta(weeks=n)
+            if begin not in i.get('exdates', []):
+                res.add((i['name'], i['location'], begin, i['end'] + bit.datetime.timedelta(weeks=n)))
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BitEssentials ics导出基准')
+    parser.add_argument('--number', type=int, default=5, help='每种方式生成次数')
+    parser.add_argument('--weeks', type=int, default=18, help='学期周数')
+    parser.add_argument('--classes', type=int, default=20, help='每周课程数')
+    args = parser.parse_args()
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    server = StubServer(StubData(weeks=args.weeks, classes_per_week=args.classes))
+    bit.set_base_url(server.start())
+    classes = bit.Bit('1120210000', 'password').get_term_classes(TERM, window=20)
+    server.shutdown()
+
+    compressed = ics_writer.compress_weekly(classes)
+    if expand(compressed) != {(i['name'], i['location'], i['begin'], i['end']) for i in classes}:
+        raise AssertionError('合并后的重复事件与原课表不一致')
+    full = str(bit.build_ics(classes))
+    rrule = ics_writer.render_calendar(compressed)
+    full_time = timeit.timeit(lambda: str(bit.build_ics(classes)), number=args.number) / args.number * 1000
+    rrule_time = timeit.timeit(lambda: ics_writer.render_calendar(ics_writer.compress_weekly(classes)),
+                               number=args.number) / args.number * 1000
+    print(f"共 {len(classes)} 节课，{args.weeks} 周，每种方式生成 {args.number} 次")
+    print(f"{'方式':<12}{'事件数':>8}{'大小KB':>10}{'耗时ms':>10}")
+    print(f"{'ics.Calendar':<12}{len(classes):>8}{len(full.encode('utf-8')) / 1024:>10.1f}{full_time:>10.2f}")
+    print(f"{'RRULE':<12}{len(compressed):>8}{len(rrule.encode('utf-8')) / 1024:>10.1f}{rrule_time:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
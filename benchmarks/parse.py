@@ -0,0 +1,128 @@
+"""
+页面解析微基准：在页面样本上比较完整构建BeautifulSoup文档树的旧解析方式与parsers中的定向解析
+
+用法：python -m benchmarks.parse [--number 次数] [--record]
+--record 用替身服务的合成数据重新生成 benchmarks/fixtures 中的样本，也可以把真实页面保存为同名文件替换样本
+"""
+import argparse
+import os
+import re
+import timeit
+
+from bs4 import BeautifulSoup
+
+import parsers
+from benchmarks.stub_server import StubData
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+BASE = 'https://lexue.bit.edu.cn'
+
+
+def reference_login_form(html):
+    page = BeautifulSoup(html, 'html.parser')
+    if page.find(id="execution") is None:
+        return None
+    return page.find(id="execution")['value'], page.find(id="pwdEncryptSalt")['value']
+
+
+def reference_score_list(html):
+    rows = []
+    for i in BeautifulSoup(html, 'html.parser').find_all('tr')[2:]:
+        columns = i.find_all('td')
+        rows.append({'id': columns[2].text, 'term': columns[1].text, 'name': columns[3].text,
+                     'type': columns[11].text, 'credit': float(columns[6].text),
+                     'score': int(re.search(r'zcj=(\d+)', columns[-1].a['onclick']).group(1))})
+    return rows
+
+
+def reference_score_analysis(html):
+    analyse = BeautifulSoup(html, 'html.parser').find_all('td')
+    return {'class_total': int(re.search(r'\d+', analyse[1].text)[0]),
+            'majority_total': int(re.search(r'\d+', analyse[2].text)[0]),
+            'average': analyse[4].text.split('：')[1],
+            'max': int(analyse[5].text.split('：')[1]),
+            'class_rank': int(analyse[8].text.split('：')[1].strip('%')) / 100,
+            'majority_rank': int(analyse[9].text.split('：')[1].strip('%')) / 100,
+            'all_rank': int(analyse[10].text.split('：')[1].strip('%')) / 100}
+
+
+def reference_lexue_page(html):
+    bs = BeautifulSoup(html, 'html.parser')
+    files = [i.parent['href'] for i in bs.find_all(class_='fp-filename') if i.parent.has_attr('href')]
+    if bs.find(class_='single-section'):
+        targets = bs.find(class_='single-section').find_all(class_='instancename')
+    elif bs.find(class_='topics'):
+        targets = bs.find(class_='topics').find_all(class_='instancename')
+    else:
+        targets = bs.find_all(class_='instancename')
+    folders = []
+    resources = []
+    for i in targets:
+        type_tag = i.find(class_='accesshide')
+        if type_tag:
+            obj_type = type_tag.text.strip()
+            type_tag.decompose()
+            if obj_type == '文件夹':
+                folders.append((i.parent['href'], i.text))
+            elif obj_type == '文件':
+                resources.append(i.parent['href'])
+    sections = [(i.a['href'], i.a.text) for i in bs.find_all(class_='section-title')]
+    return {'title': bs.title.text, 'files': files, 'folders': folders, 'resources': resources, 'sections': sections}
+
+
+CASES = [
+    ('login', 'login.html', reference_login_form, parsers.parse_login_form),
+    ('cjcx_list', 'cjcx_list.html', reference_score_list, parsers.parse_score_list),
+    ('cjfx', 'cjfx.html', reference_score_analysis, parsers.parse_score_analysis),
+    ('lexue_course', 'lexue_course.html', reference_lexue_page, parsers.parse_lexue_page),
+    ('lexue_section', 'lexue_section.html', reference_lexue_page, parsers.parse_lexue_page),
+    ('lexue_folder', 'lexue_folder.html', reference_lexue_page, parsers.parse_lexue_page),
+]
+
+
+def record():
+    """
+    用合成数据生成页面样本
+    :return: 无
+    """
+    data = StubData(courses=60)
+    pages = {
+        'login.html': "<html><body><form id=\"pwdFromId\" method=\"post\">"
+                      "<input type=\"hidden\" id=\"execution\" name=\"execution\" value=\"e1s1\"/>"
+                      "<input type=\"hidden\" id=\"pwdEncryptSalt\" value=\"rjBFAaHsNkKAhpoi\"/>"
+                      f"</form><p>{'统一身份认证说明。' * 300}</p></body></html>",
+        'cjcx_list.html': data.score_list(),
+        'cjfx.html': data.score_analysis('100001'),
+        'lexue_course.html': data.lexue_course(BASE, '1'),
+        'lexue_section.html': data.lexue_course(BASE, '1', '1'),
+        'lexue_folder.html': data.lexue_folder(BASE, '1'),
+    }
+    os.makedirs(FIXTURES, exist_ok=True)
+    for name, html in pages.items():
+        with open(os.path.join(FIXTURES, name), 'w', encoding='utf-8') as f:
+            f.write(html)
+    print(f"已生成 {len(pages)} 个样本到 {FIXTURES}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BitEssentials 页面解析微基准')
+    parser.add_argument('--number', type=int, default=50, help='每个样本解析次数')
+    parser.add_argument('--record', action='store_true', help='重新生成页面样本')
+    args = parser.parse_args()
+    if args.record:
+        record()
+        return
+    print(f"解析后端 {parsers.BACKEND}，每个样本解析 {args.number} 次")
+    print(f"{'样本':<16}{'大小KB':>8}{'旧ms':>10}{'新ms':>10}{'加速':>8}")
+    for name, filename, reference, parse in CASES:
+        with open(os.path.join(FIXTURES, filename), 'r', encoding='utf-8') as f:
+            html = f.read()
+        if reference(html) != parse(html):
+            raise AssertionError(f"{name} 的解析结果与旧解析方式不一致")
+        old = timeit.timeit(lambda: reference(html), number=args.number) / args.number * 1000
+        new = timeit.timeit(lambda: parse(html), number=args.number) / args.number * 1000
+        print(f"{name:<16}{len(html.encode('utf-8')) / 1024:>8.1f}{old:>10.2f}{new:>10.2f}{old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+离线基准测试：启动本地替身服务，将Bit指向替身服务，测量各项操作的延迟和吞吐量
+
+用法：python -m benchmarks.run [--latency 毫秒] [--iterations 次数] [--concurrency 并发数] [场景 ...]
+"""
+import argparse
+import logging
+import queue
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bit
+from async_bit import SyncBit
+from benchmarks.stub_server import StubData, StubServer, TERM
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def new_client(login=True):
+    client = bit.Bit('1120210000', 'password')
+    if login:
+        client.login()
+    return client
+
+
+def new_async_client(login=True):
+    client = SyncBit('1120210000', 'password')
+    if login:
+        client.login()
+    return client
+
+
+def bench_login(client, workdir):
+    new_client()
+
+
+def bench_scores(client, workdir):
+    client.scores = {}
+    client.get_scores_update(refresh_all=True)
+
+
+def bench_scores_unchanged(client, workdir):
+    client.get_scores_update()
+
+
+def bench_classes(client, workdir):
+    client.get_term_classes(TERM, window=20)
+
+
+def bench_exams(client, workdir):
+    client.get_exams(TERM)
+
+
+def bench_lexue(client, workdir):
+    with tempfile.TemporaryDirectory(dir=workdir) as path:
+        client.download_lexue_course_files('1', path, quiet=True)
+
+
+SCENARIOS = {
+    'login': bench_login,
+    'scores': bench_scores,
+    'scores_unchanged': bench_scores_unchanged,
+    'classes': bench_classes,
+    'exams': bench_exams,
+    'lexue': bench_lexue,
+    'async_scores': bench_scores,
+    'async_classes': bench_classes,
+}
+# 使用AsyncBit的场景，其余场景使用Bit
+CLIENTS = {
+    'async_scores': new_async_client,
+    'async_classes': new_async_client,
+}
+# 计时前对每个客户端执行一次的预热操作，如先完整获取一次成绩记录成绩列表指纹，计时阶段才会命中
+WARMUP = {
+    'scores_unchanged': bench_scores_unchanged,
+}
+
+
+def run_scenario(server, name, iterations, concurrency, workdir):
+    """
+    以指定并发数执行场景，每次执行时独占一个已登录客户端，同一客户端不会被多个线程同时使用，有预热操作的场景先对每个客户端预热
+    :return: 统计结果字典
+    """
+    clients = [CLIENTS.get(name, new_client)() for _ in range(concurrency)]
+    if name in WARMUP:
+        for client in clients:
+            WARMUP[name](client, workdir)
+    idle = queue.Queue()
+    for client in clients:
+        idle.put(client)
+    latencies = []
+    requests_before = server.requests
+
+    def worker(n):
+        client = idle.get()
+        try:
+            begin = time.perf_counter()
+            SCENARIOS[name](client, workdir)
+            latencies.append(time.perf_counter() - begin)
+        finally:
+            idle.put(client)
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(iterations)))
+    wall = time.perf_counter() - begin
+    for client in clients:
+        if isinstance(client, SyncBit):
+            client.close()
+    return {
+        'name': name,
+        'ops': iterations,
+        'mean': statistics.mean(latencies) * 1000,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'max': max(latencies) * 1000,
+        'throughput': iterations / wall,
+        'requests': (server.requests - requests_before) / iterations,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BitEssentials 离线基准测试')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=f"场景，可选 {', '.join(SCENARIOS)}")
+    parser.add_argument('--latency', type=float, default=0, help='替身服务每个请求注入的延迟，单位毫秒')
+    parser.add_argument('--iterations', type=int, default=20, help='每个场景执行次数')
+    parser.add_argument('--concurrency', type=int, default=1, help='并发执行的客户端数')
+    parser.add_argument('--courses', type=int, default=50, help='成绩列表中的课程数')
+    parser.add_argument('--weeks', type=int, default=18, help='学期周数')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    server = StubServer(StubData(courses=args.courses, weeks=args.weeks), latency=args.latency / 1000)
+    bit.set_base_url(server.start())
+    print(f"替身服务 {server.base_url}，注入延迟 {args.latency}ms，并发 {args.concurrency}，每个场景 {args.iterations} 次")
+    print(f"{'场景':<18}{'次数':>6}{'平均ms':>10}{'p50ms':>10}{'p95ms':>10}{'最大ms':>10}{'次/秒':>10}{'请求/次':>10}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scenarios:
+            res = run_scenario(server, name, args.iterations, args.concurrency, workdir)
+            print(f"{res['name']:<18}{res['ops']:>6}{res['mean']:>10.1f}{res['p50']:>10.1f}{res['p95']:>10.1f}"
+                  f"{res['max']:>10.1f}{res['throughput']:>10.2f}{res['requests']:>10.1f}")
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import datetime
+import json
+import random
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+from bit import WEBVPN_JWXT
+
+TYPES = ['必修', '选修', '校公选课', '通识']
+TERM = '2021-2022-1'
+TERM_BEGIN = datetime.date(2021, 9, 6)
+
+
+class StubData:
+    """
+    合成的上游数据，同一个种子生成的内容完全相同
+    """
+    
+    def __init__(self, courses=50, weeks=18, classes_per_week=20, exams=8, lexue_pages=10, lexue_files=5,
+                 file_size=256 * 1024, seed=0):
+        rnd = random.Random(seed)
+        self.weeks = weeks
+        self.file_size = file_size
+        self.scores = []
+        for i in range(courses):
+            self.scores.append({'id': f"{100000 + i}", 'term': f"{2018 + i % 4}-{2019 + i % 4}-{1 + i % 2}",
+                                'name': f"课程{i}", 'type': TYPES[i % len(TYPES)], 'credit': rnd.choice([1, 1.5, 2, 3, 4]),
+                                'score': rnd.randint(60, 100)})
+        self.classes = []
+        for i in range(classes_per_week):
+            begin = rnd.randint(1, 11)
+            self.classes.append({'KCM': f"课程{i}", 'SKJS': f"教师{i}", 'XXXQMC': '良乡校区', 'JASMC': f"文{rnd.randint(100, 999)}",
+                                 'SKXQ': rnd.randint(1, 7), 'KSJC_DISPLAY': f"第{begin}节",
+                                 'JSJC_DISPLAY': f"第{min(begin + 1, 12)}节"})
+        self.exams = []
+        for i in range(exams):
+            day = TERM_BEGIN + datetime.timedelta(weeks=weeks, days=i)
+            self.exams.append({'KCM': f"课程{i}", 'ZJJSXM': f"教师{i}", 'KCH': f"{100000 + i}", 'JASMC': f"理{i}01",
+                               'KSSJMS': f"{day.isoformat()} 08:00-10:00(星期{day.isoweekday()})", 'ZWH': str(i + 1)})
+        self.lexue_pages = lexue_pages
+        self.lexue_files = lexue_files
+    
+    def score_list(self):
+        rows = ''.join(
+            f"<tr><td>{n}</td><td>{i['term']}</td><td>{i['id']}</td><td>{i['name']}</td><td>{i['score']}</td><td></td>"
+            f"<td>{i['credit']}</td><td>32</td><td>考试</td><td>初修</td><td></td><td>{i['type']}</td>"
+            f"<td><a href=\"javascript:void(0)\" onclick=\"JsMod('/jsxsd/kscj/cjfx?zcj={i['score']}')\">分析</a></td></tr>"
+            for n, i in enumerate(self.scores))
+        return ("<html><head><title>学生个人考试成绩</title></head><body><table id=\"dataList\">"
+                "<tr><th colspan=\"13\">成绩</th></tr><tr><th>序号</th><th>开课学期</th><th>课程编号</th><th>课程名称</th>"
+                "<th>成绩</th><th>成绩标识</th><th>学分</th><th>总学时</th><th>考核方式</th><th>考试性质</th>"
+                f"<th>课程属性</th><th>课程性质</th><th>操作</th></tr>{rows}</table></body></html>")
+    
+    @staticmethod
+    def score_analysis(course_id):
+        seed = int(course_id) if course_id.isdigit() else 0
+        rnd = random.Random(seed)
+        cells = ['成绩分析', f"班级人数：{rnd.randint(20, 40)}", f"专业人数：{rnd.randint(80, 200)}", '',
+                 f"平均分：{rnd.randint(60, 90)}.{rnd.randint(0, 9)}", f"最高分：{rnd.randint(90, 100)}", '', '',
+                 f"班级排名：{rnd.randint(1, 100)}%", f"专业排名：{rnd.randint(1, 100)}%", f"全部排名：{rnd.randint(1, 100)}%"]
+        return "<html><body><table>" + ''.join(f"<tr><td>{i}</td></tr>" for i in cells) + "</table></body></html>"
+    
+    @staticmethod
+    def class_time():
+        rows = []
+        for i in range(1, 13):
+            begin = datetime.datetime(2000, 1, 1, 8) + datetime.timedelta(minutes=55 * (i - 1))
+            end = begin + datetime.timedelta(minutes=45)
+            rows.append({'MC': f"第{i}节", 'KSSJ': begin.strftime('%H:%M'), 'JSSJ': end.strftime('%H:%M')})
+        return {'datas': {'jc': {'rows': rows}}}
+    
+    @staticmethod
+    def week_dates(week):
+        monday = TERM_BEGIN + datetime.timedelta(weeks=week - 1)
+        return {'data': [{'XQ': i, 'RQ': (monday + datetime.timedelta(days=i - 1)).isoformat()} for i in range(1, 8)]}
+    
+    def week_classes(self, week):
+        return {'datas': {'cxxszhxqkb': {'rows': self.classes if 1 <= week <= self.weeks else []}}}
+    
+    def exam_list(self):
+        return {'datas': {'cxxsksap': {'rows': self.exams}}}
+    
+    def lexue_course(self, base, courseid, section=None):
+        nav = ''.join(f"<li><a href=\"{base}/lexue/course/view.php?id={i + 1000}\"><span class=\"instancename\">导航{i}"
+                      f"<span class=\"accesshide\"> 文件</span></span></a></li>" for i in range(30))
+        nav = f"<div class=\"block\"><ul>{nav}</ul></div><p>{'页面说明文字。' * 200}</p>"
+        if section is not None:
+            items = ''.join(
+                f"<li><a href=\"{base}/lexue/mod/resource/view.php?id={section}{i}\"><span class=\"instancename\">资源{i}"
+                f"<span class=\"accesshide\"> 文件</span></span></a></li>" for i in range(self.lexue_files))
+            return (f"<html><head><title>课程 {courseid} 章节 {section}</title></head><body><h1>课程{courseid}</h1>{nav}"
+                    f"<div class=\"single-section\"><ul>{items}</ul></div></body></html>")
+        items = ''.join(
+            f"<li><a href=\"{base}/lexue/mod/folder/view.php?id={i}\"><span class=\"instancename\">文件夹{i}"
+            f"<span class=\"accesshide\"> 文件夹</span></span></a></li>"
+            f"<li><a href=\"{base}/lexue/mod/resource/view.php?id={i}\"><span class=\"instancename\">资源{i}"
+            f"<span class=\"accesshide\"> 文件</span></span></a></li>"
+            for i in range(self.lexue_pages))
+        sections = ''.join(
+            f"<h3 class=\"section-title\"><a href=\"{base}/lexue/course/view.php?id={courseid}&amp;section={i}\">"
+            f"第{i}章</a></h3>" for i in range(1, 3))
+        return (f"<html><head><title>课程 {courseid}</title></head><body><h1>课程{courseid}</h1>{nav}"
+                f"<ul class=\"topics\">{items}</ul>{sections}</body></html>")
+    
+    def lexue_folder(self, base, folder):
+        files = ''.join(
+            f"<a href=\"{base}/lexue/pluginfile.php/{folder}/{i}\"><span class=\"fp-filename\">文件{folder}-{i}.pdf</span></a>"
+            for i in range(self.lexue_files))
+        return f"<html><head><title>文件夹{folder}</title></head><body><div class=\"filemanager\">{files}</div></body></html>"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    
+    def log_message(self, format, *args):
+        pass
+    
+    @property
+    def data(self):
+        return self.server.data
+    
+    def __cookies(self):
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        return {i: cookie[i].value for i in cookie}
+    
+    def __send(self, status, body=b'', content_type='text/html; charset=utf-8', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or []):
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def __json(self, data):
+        self.__send(200, json.dumps(data, ensure_ascii=False), 'application/json; charset=utf-8')
+    
+    def __redirect(self, location, cookies=()):
+        headers = [('Location', location)] + [('Set-Cookie', f"{i}=1; Path=/") for i in cookies]
+        self.__send(302, headers=headers)
+    
+    def __login_page(self, service):
+        action = f"/login/authserver/login?service={quote(service)}" if service else '/login/authserver/login'
+        self.__send(200, f"<html><body><form id=\"pwdFromId\" action=\"{action}\" method=\"post\">"
+                         "<input type=\"hidden\" id=\"execution\" name=\"execution\" value=\"e1s1\"/>"
+                         "<input type=\"hidden\" id=\"pwdEncryptSalt\" value=\"rjBFAaHsNkKAhpoi\"/>"
+                         "</form></body></html>")
+    
+    def __handle(self, method):
+        self.server.count_request()
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items()} if length else {}
+        host, _, path = url.path.lstrip('/').partition('/')
+        path = '/' + path
+        cookies = self.__cookies()
+        base = self.server.base_url
+        if host == 'login':
+            if path == '/authserver/checkNeedCaptcha.htl':
+                return self.__json({'isNeed': False})
+            if path == '/authserver/login':
+                service = query.get('service')
+                if method == 'POST':
+                    if form.get('username') == 'wrong':
+                        return self.__send(401, '密码错误')
+                    if service:
+                        return self.__redirect(service, ['stub_cas'])
+                    return self.__send(200, '登录成功', headers=[('Set-Cookie', 'stub_cas=1; Path=/')])
+                if 'stub_cas' in cookies and service:
+                    return self.__redirect(service)
+                return self.__login_page(service)
+        elif host == 'ehall':
+            return self.__send(200, 'ok')
+        elif host == 'ehallapp':
+            if 'stub_cas' not in cookies:
+                return self.__redirect(f"{base}/login/authserver/login?service={quote(base + url.path)}")
+            if path.endswith('/cxxsjbxx.do'):
+                return self.__json({'datas': {'cxxsjbxx': {'rows': [{'XM': '张三', 'YXMC': '计算机学院'}]}}})
+            if path.endswith('/dqxnxq.do'):
+                return self.__json({'datas': {'dqxnxq': {'rows': [{'DM': TERM}]}}})
+            if path.endswith('/jc.do'):
+                return self.__json(self.data.class_time())
+            if path.endswith('/cxzkbrq.do'):
+                return self.__json(self.data.week_dates(int(json.loads(form['requestParamStr'])['ZC'])))
+            if path.endswith('/cxxszhxqkb.do'):
+                return self.__json(self.data.week_classes(int(form['SKZC'])))
+            if path.endswith('/cxxsksap.do'):
+                return self.__json(self.data.exam_list())
+        elif host == 'webvpn':
+            if path == '/login':
+                if 'stub_cas' not in cookies:
+                    return self.__redirect(
+                        f"{base}/login/authserver/login?service={quote(base + '/webvpn/login?cas_login=true')}")
+                return self.__send(200, 'webvpn', headers=[('Set-Cookie', 'stub_vpn=1; Path=/')])
+            if 'stub_vpn' not in cookies:
+                return self.__redirect(f"{base}/webvpn/login")
+            if path == f"{WEBVPN_JWXT}/framework/main.jsp":
+                return self.__send(200, 'main')
+            if path == f"{WEBVPN_JWXT}/kscj/cjcx_list":
+                return self.__send(200, self.data.score_list())
+            if path == f"{WEBVPN_JWXT}/kscj/cjfx":
+                return self.__send(200, self.data.score_analysis(query.get('kch', '')))
+        elif host == 'lexue':
+            if path == '/course/view.php':
+                return self.__send(200, self.data.lexue_course(base, query.get('id', ''), query.get('section')))
+            if path == '/mod/folder/view.php':
+                return self.__send(200, self.data.lexue_folder(base, query.get('id', '')))
+            if path == '/mod/resource/view.php' or path.startswith('/pluginfile.php/'):
+                name = f"{path.strip('/').replace('/', '-')}{query.get('id', '')}.pdf"
+                return self.__send(200, b'\0' * self.data.file_size, 'application/pdf', headers=[
+                    ('Content-Disposition', f"attachment; filename=\"{name}\"".encode('utf-8').decode('ISO-8859-1')),
+                    ('ETag', f"\"{name}\"")])
+        self.__send(404, 'not found')
+    
+    def do_GET(self):
+        self.__handle('GET')
+    
+    def do_POST(self):
+        self.__handle('POST')
+    
+    def do_HEAD(self):
+        self.__handle('HEAD')
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    本地替身服务，按路径第一段区分模拟的上游主机，配合bit.set_base_url使用
+    """
+    daemon_threads = True
+    
+    def __init__(self, data=None, latency=0.0, host='127.0.0.1', port=0):
+        super().__init__((host, port), StubHandler)
+        self.data = data or StubData()
+        self.latency = latency
+        self.requests = 0
+        self.__lock = threading.Lock()
+    
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+    
+    def count_request(self):
+        with self.__lock:
+            self.requests += 1
+    
+    def start(self):
+        """
+        在后台线程中启动服务
+        :return: 服务地址
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.base_url
@@ -5,18 +5,417 @@ import json
 import pickle
 import os
 import cgi
-import re
+import collections
+import hashlib
+import math
+import threading
+import contextlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 import ics
 import requests
+from requests.adapters import HTTPAdapter
 import datetime
 import logging
-import pytz
 from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
 from Crypto.Util.Padding import pad
-from bs4 import BeautifulSoup
 
-TZ = pytz.timezone("Asia/Shanghai")
+import cache
+import ics_writer
+import metrics
+import parsers
+import resilience
+import tracing
+from parsers import TZ, get_datetime
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+LEXUE_MANIFEST = '.lexue_manifest.json'
+LOGIN_TTL = 10 * 60
+# 上游主机，可通过set_base_url指向本地替身服务
+HOSTS = {
+    'login': 'https://login.bit.edu.cn',
+    'webvpn': 'https://webvpn.bit.edu.cn',
+    'ehall': 'http://jxzxehall.bit.edu.cn',
+    'ehallapp': 'http://jxzxehallapp.bit.edu.cn',
+    'lexue': 'https://lexue.bit.edu.cn',
+}
+WEBVPN_JWXT = '/http/77726476706e69737468656265737421fae04c8f69326144300d8db9d6562d/jsxsd'
+# 指标中的逻辑接口名，按url中的片段匹配，先匹配的优先，都不匹配时使用HOSTS中的主机名
+ENDPOINTS = (
+    ('checkNeedCaptcha', 'captcha_check'),
+    ('/authserver/login', 'cas_login'),
+    ('cas_login=true', 'webvpn_login'),
+    ('/framework/main.jsp', 'webvpn_check'),
+    ('/kscj/cjcx_list', 'cjcx_list'),
+    ('/kscj/cjfx', 'cjfx'),
+    ('/xskcb/cxxsjbxx.do', 'user_info'),
+    ('/jshkcb/dqxnxq.do', 'current_term'),
+    ('/jshkcb/jc.do', 'class_time'),
+    ('/cxzkbrq.do', 'week_dates'),
+    ('/cxxszhxqkb.do', 'week_classes'),
+    ('/cxxsksap.do', 'exams'),
+)
+# 各接口的(连接超时, 读取超时)，单位秒，未列出的接口使用default
+TIMEOUTS = {
+    'default': (5, 20),
+    'cas_login': (5, 30),
+    'webvpn_login': (5, 30),
+    'cjfx': (5, 15),
+    'lexue': (5, 60),
+}
+# 只查询数据、可以安全重试的POST接口
+READ_ONLY_POSTS = {'user_info', 'current_term', 'class_time', 'week_dates', 'week_classes', 'exams'}
+# 可重试的上游状态码
+RETRY_STATUS = (502, 503, 504)
+# 跳过失败周获取课表时，连续失败多少周后停止，与每批并发获取的周数无关
+MAX_MISSING_WEEKS = 3
+STATE_MAGIC = b'BITSTATE'
+STATE_VERSION = 3
+# 旧版本状态到新版本状态的迁移函数，键为旧版本号
+STATE_MIGRATIONS = {
+    1: lambda state: {**state, 'version': 2, 'scoresFingerprint': None},
+    2: lambda state: {**state, 'version': 3, 'cookies': [
+        {**{k: v for k, v in i.items() if k != 'rest'}, 'httponly': has_httponly(i['rest'])}
+        for i in state['cookies']]},
+}
+
+_host_concurrency = 0
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+_login_probe = False
+_state_keys = []
+_request_count = 0
+_request_count_lock = threading.Lock()
+_max_retries = 2
+_pool_connections = 16
+_pool_maxsize = 32
+_shared_adapter = None
+_shared_adapter_lock = threading.Lock()
+# 所有用户相同的学期数据：当前学期和上课时间表
+TERM_CACHE = cache.TTLCache(60 * 60)
+
+
+def set_host_concurrency(limit):
+    """
+    设置对每个上游主机的最大并发请求数，所有Bit实例共享
+    :param int limit: 最大并发数，0表示不限制
+    :return: 无
+    """
+    global _host_concurrency
+    with _host_semaphores_lock:
+        _host_concurrency = limit
+        _host_semaphores.clear()
+
+
+def set_base_url(base_url):
+    """
+    将所有上游主机指向base_url下以主机名区分的路径，如base_url/webvpn，用于本地替身服务
+    :param str base_url: 替身服务地址，如http://127.0.0.1:8000
+    :return: 无
+    """
+    for i in HOSTS:
+        HOSTS[i] = f"{base_url.rstrip('/')}/{i}"
+
+
+def set_login_probe(enabled):
+    """
+    设置是否在请求前发送探测请求确认登录状态，关闭时由实际请求懒验证
+    :param bool enabled: 是否探测
+    :return: 无
+    """
+    global _login_probe
+    _login_probe = enabled
+
+
+def set_state_key(secret, *previous):
+    """
+    设置会话状态中加密凭据使用的密钥，更换密钥时将旧密钥放在previous中，用旧密钥加密的状态下次保存时改用新密钥
+    :param str secret: 加密使用的密钥原文，实际使用其sha256
+    :param str previous: 只用于解密的旧密钥原文
+    :return: 无
+    """
+    global _state_keys
+    if not secret:
+        raise BitInfoError("会话状态密钥不能为空")
+    _state_keys = [hashlib.sha256(i.encode('utf-8')).digest() for i in (secret, *previous) if i]
+
+
+def encrypt_secret(text):
+    """
+    使用会话状态密钥加密字符串
+    :param text: 明文
+    :return: base64编码的密文
+    """
+    if not _state_keys:
+        raise BitInfoError("未设置会话状态密钥")
+    nonce = get_random_bytes(12)
+    aes = AES.new(_state_keys[0], AES.MODE_GCM, nonce=nonce)
+    ciphertext, tag = aes.encrypt_and_digest(text.encode('utf-8'))
+    return base64.b64encode(nonce + tag + ciphertext).decode('utf-8')
+
+
+def decrypt_secret(text):
+    """
+    使用会话状态密钥解密字符串，依次尝试当前密钥和旧密钥
+    :param text: encrypt_secret得到的密文
+    :return: 明文
+    """
+    if not _state_keys:
+        raise BitInfoError("未设置会话状态密钥")
+    data = base64.b64decode(text)
+    for key in _state_keys:
+        aes = AES.new(key, AES.MODE_GCM, nonce=data[:12])
+        try:
+            return aes.decrypt_and_verify(data[28:], data[12:28]).decode('utf-8')
+        except ValueError:
+            continue
+    raise BitInfoError("会话状态密钥错误，无法解密")
+
+
+def has_httponly(attrs):
+    """
+    判断cookie的非标准属性中是否有HttpOnly，服务器发送的属性名大小写不固定
+    :param attrs: cookie的非标准属性字典
+    :return: 是否为HttpOnly
+    """
+    return any(k.lower() == 'httponly' for k in attrs)
+
+
+def migrate_state(state):
+    """
+    将旧版本会话状态依次迁移到当前版本
+    :param state: 会话状态字典
+    :return: 当前版本的会话状态字典
+    """
+    while state['version'] < STATE_VERSION:
+        state = STATE_MIGRATIONS[state['version']](state)
+    return state
+
+
+def encode_state(state):
+    """
+    编码会话状态，格式为STATE_MAGIC加压缩后的JSON
+    :param state: 会话状态字典
+    :return: 字节流
+    """
+    return STATE_MAGIC + zlib.compress(json.dumps(state, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_state(data):
+    """
+    解码会话状态，旧版本pickle格式会先转换为会话状态
+    :param data: encode_state或旧版本pickle得到的字节流
+    :return: 当前版本的会话状态字典
+    """
+    if data.startswith(STATE_MAGIC):
+        return migrate_state(json.loads(zlib.decompress(data[len(STATE_MAGIC):])))
+    return pickle.loads(data).to_state()
+
+
+def host_slot(url):
+    """
+    获取url所在主机的并发槽位，用于with语句
+    :param url: 请求url
+    :return: 上下文管理器
+    """
+    if _host_concurrency <= 0:
+        return contextlib.nullcontext()
+    host = urlsplit(url).hostname
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            _host_semaphores[host] = threading.BoundedSemaphore(_host_concurrency)
+        return _host_semaphores[host]
+
+
+class SharedAdapter(HTTPAdapter):
+    """
+    所有Bit实例共享的连接池，只保存keep-alive连接，cookie仍保存在各自的Session中，不会在用户之间泄漏
+    """
+    
+    def close(self):
+        # Session.close不能关闭其他用户正在使用的连接
+        pass
+    
+    def close_pool(self):
+        """
+        关闭连接池中的所有连接
+        :return: 无
+        """
+        super().close()
+
+
+def set_pool_size(connections, maxsize):
+    """
+    设置共享连接池的大小，已创建的连接池会被关闭并在下次请求时重新创建
+    :param int connections: 最多保留连接池的主机数
+    :param int maxsize: 每个主机最多保留的keep-alive连接数，小于主机并发上限时按并发上限
+    :return: 无
+    """
+    global _pool_connections, _pool_maxsize, _shared_adapter
+    with _shared_adapter_lock:
+        _pool_connections = connections
+        _pool_maxsize = maxsize
+        adapter, _shared_adapter = _shared_adapter, None
+    if adapter is not None:
+        adapter.close_pool()
+
+
+def shared_adapter():
+    """
+    获取共享连接池，首次调用时创建
+    :return: SharedAdapter
+    """
+    global _shared_adapter
+    with _shared_adapter_lock:
+        if _shared_adapter is None:
+            # 每个主机保留的连接不少于并发上限，避免连接用完后被丢弃
+            _shared_adapter = SharedAdapter(pool_connections=_pool_connections,
+                                            pool_maxsize=max(_pool_maxsize, _host_concurrency))
+        return _shared_adapter
+
+
+def mount_shared_adapter(session):
+    """
+    让Session使用共享连接池
+    :param session: requests.Session
+    :return: session
+    """
+    adapter = shared_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def pool_stats():
+    """
+    获取共享连接池的统计
+    :return: { 'scheme://host:port': { 'requests': 请求数, 'connections': 新建连接数, 'idle': 空闲连接数 } }
+    """
+    adapter = _shared_adapter
+    if adapter is None:
+        return {}
+    stats = {}
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        idle = sum(1 for i in list(pool.pool.queue) if i is not None) if pool.pool is not None else 0
+        stats[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+            'requests': pool.num_requests, 'connections': pool.num_connections, 'idle': idle}
+    return stats
+
+
+POOL_REQUESTS = metrics.gauge('bit_http_pool_requests', "共享连接池发出的请求数", ('pool',))
+POOL_CONNECTIONS = metrics.gauge('bit_http_pool_connections', "共享连接池新建的连接数", ('pool',))
+POOL_IDLE = metrics.gauge('bit_http_pool_idle', "共享连接池中空闲的keep-alive连接数", ('pool',))
+POOL_HIT_RATIO = metrics.gauge('bit_http_pool_hit_ratio', "复用已有连接的请求比例", ('pool',))
+
+
+def collect_pool_metrics():
+    for pool, stat in pool_stats().items():
+        POOL_REQUESTS.set(pool, value=stat['requests'])
+        POOL_CONNECTIONS.set(pool, value=stat['connections'])
+        POOL_IDLE.set(pool, value=stat['idle'])
+        if stat['requests'] > 0:
+            POOL_HIT_RATIO.set(pool, value=max(0, stat['requests'] - stat['connections']) / stat['requests'])
+
+
+metrics.REGISTRY.add_collector(collect_pool_metrics)
+
+
+def set_timeouts(timeouts):
+    """
+    设置各接口的超时，未指定的接口保持原值
+    :param dict timeouts: { 接口名或'default': [连接超时, 读取超时] }
+    :return: 无
+    """
+    for endpoint, timeout in timeouts.items():
+        TIMEOUTS[endpoint] = tuple(timeout)
+
+
+def set_max_retries(retries):
+    """
+    设置幂等请求在网络错误和502、503、504时的最大重试次数
+    :param int retries: 重试次数，0为不重试
+    :return: 无
+    """
+    global _max_retries
+    _max_retries = max(0, retries)
+
+
+def request_timeout(endpoint):
+    """
+    获取接口的超时
+    :param endpoint: 接口名
+    :return: (连接超时, 读取超时)
+    """
+    return TIMEOUTS.get(endpoint, TIMEOUTS['default'])
+
+
+def is_idempotent(method, endpoint):
+    """
+    判断请求是否可以安全重试，GET请求和只查询数据的POST接口可以重试，登录表单提交不重试
+    :param method: 请求方法
+    :param endpoint: 接口名
+    :return: 是否可以重试
+    """
+    return method.upper() in ('GET', 'HEAD') or endpoint in READ_ONLY_POSTS
+
+
+def upstream_wait(names=('login', 'webvpn')):
+    """
+    获取上游主机熔断器还要打开多久，用于暂停批量任务
+    :param names: HOSTS中的主机名
+    :return: 最长的剩余时间，单位秒，都可用时为0
+    """
+    return max(resilience.breaker(urlsplit(HOSTS[i]).hostname).remaining() for i in names)
+
+
+def set_term_cache_ttl(ttl):
+    """
+    设置当前学期和上课时间表的缓存时间，0表示不缓存
+    :param int ttl: 缓存时间，单位秒
+    :return: 无
+    """
+    TERM_CACHE.ttl = ttl
+    TERM_CACHE.invalidate()
+
+
+def endpoint_name(url):
+    """
+    获取url对应的逻辑接口名，用于指标标签
+    :param url: 请求url
+    :return: 接口名，未知主机返回'other'
+    """
+    for pattern, name in ENDPOINTS:
+        if pattern in url:
+            return name
+    for name, host in HOSTS.items():
+        if url.startswith(host):
+            return name
+    return 'other'
+
+
+def count_request():
+    """
+    记录一次上游请求
+    :return: 无
+    """
+    global _request_count
+    with _request_count_lock:
+        _request_count += 1
+
+
+def request_count():
+    """
+    获取进程启动以来所有Bit实例发出的上游请求总数
+    :return: 请求数
+    """
+    return _request_count
 
 
 def get_random_string(length):
@@ -36,15 +435,11 @@ def timestamp():
     return round(time.time() * 1000)
 
 
-def get_datetime(date: datetime.datetime, time: datetime.datetime):
-    return (date + datetime.timedelta(hours=time.hour, minutes=time.minute)).replace(
-        tzinfo=TZ)
-
-
 def build_ics_event(name, location, begin_t: datetime.datetime, end_t: datetime.datetime, description=None):
     return ics.Event(name=name, location=location, begin=begin_t, end=end_t, description=description)
 
 
+@tracing.traced('ics.build')
 def build_ics(data: list):
     cal = ics.Calendar()
     for i in data:
@@ -53,22 +448,181 @@ def build_ics(data: list):
     return cal
 
 
+@tracing.traced('ics.render_classes')
+def render_classes_ics(classes, compress=False):
+    """
+    生成课表ics
+    :param classes: 课程信息list
+    :param compress: 是否将每周重复的课程合并为RRULE重复事件并直接生成ics文本，默认为否
+    :return: 课程信息ics，compress时为ics文本
+    """
+    if compress:
+        return ics_writer.render_calendar(ics_writer.compress_weekly(classes))
+    return build_ics(classes)
+
+
 class BitInfoError(Exception):
     def __init__(self, value):
+        super().__init__(value)
         self.value = value
 
 
+class UpstreamUnavailable(BitInfoError):
+    """
+    上游主机的熔断器打开，请求直接失败
+    """
+    
+    def __init__(self, host, retry_after):
+        super().__init__(f"学校服务器暂时无法访问，请{math.ceil(retry_after)}秒后重试")
+        self.host = host
+        self.retry_after = retry_after
+
+
+class UpstreamAttempts:
+    """
+    一次上游请求的重试和熔断规则，Bit和AsyncBit共用，迭代得到每次尝试的序号，从0开始
+    - 每次尝试前检查主机熔断器，打开时抛出UpstreamUnavailable
+    - 幂等请求在网络错误和502、503、504时重试，其余请求不重试
+    """
+    
+    def __init__(self, method, url):
+        self.endpoint = endpoint_name(url)
+        self.host = urlsplit(url).hostname
+        self.timeout = request_timeout(self.endpoint)
+        self.retries = _max_retries if is_idempotent(method, self.endpoint) else 0
+        self.attempt = 0
+        self.__circuit = resilience.breaker(self.host)
+    
+    def __iter__(self):
+        for attempt in range(self.retries + 1):
+            wait = self.__circuit.allow()
+            if wait > 0:
+                raise UpstreamUnavailable(self.host, wait)
+            if attempt > 0:
+                resilience.RETRIES.inc(self.endpoint)
+            count_request()
+            self.attempt = attempt
+            yield attempt
+    
+    def failed(self, error):
+        """
+        记录一次网络错误
+        :param error: 异常
+        :return: 是否重试，否则调用方应抛出该异常
+        """
+        self.__circuit.failure()
+        if self.attempt == self.retries:
+            return False
+        logging.debug(f"请求{self.endpoint}失败，准备重试：{repr(error)}")
+        return True
+    
+    def finished(self, status):
+        """
+        记录收到的响应
+        :param status: HTTP状态码
+        :return: 是否作为结果返回，否则调用方应释放响应并重试
+        """
+        metrics.record_status(self.endpoint, status)
+        if status not in RETRY_STATUS:
+            self.__circuit.success()
+            return True
+        self.__circuit.failure()
+        return self.attempt == self.retries
+    
+    def backoff(self):
+        """
+        :return: 下次尝试前的等待时间，单位秒
+        """
+        return resilience.backoff(self.attempt + 1)
+
+
+class TermWeeks:
+    """
+    按窗口分批获取学期各周课表的进度，Bit和AsyncBit共用，遇到第一个没有课程的周视为学期结束
+    partial时跳过获取失败的周，登录失败和上游熔断不跳过，连续max_failures周失败时停止，此前没有一周成功时抛出异常
+    """
+    
+    def __init__(self, term, window=1, partial=False, max_failures=MAX_MISSING_WEEKS):
+        self.term = term
+        self.window = max(1, window)
+        self.partial = partial
+        self.max_failures = max(1, max_failures)
+        self.classes = []
+        self.missing = []
+        self.done = False
+        self.__failures = 0
+        self.__succeeded = False
+    
+    def batches(self):
+        """
+        :return: 每批同时获取的周次range，结束后不再产生
+        """
+        for start in range(1, 100, self.window):
+            if self.done:
+                return
+            yield range(start, min(start + self.window, 100))
+    
+    def add(self, week, result):
+        """
+        记录一周的结果，须按周次顺序调用
+        :param week: 周次
+        :param result: 课程信息list，获取失败时为异常
+        :return: 是否已经结束
+        """
+        if isinstance(result, Exception):
+            if not self.partial or isinstance(result, BitInfoError):
+                raise result
+            logging.warning(f"获取学期 {self.term} 第 {week} 周课表失败：{repr(result)}")
+            self.missing.append(week)
+            self.__failures += 1
+            if self.__failures < self.max_failures:
+                return False
+            if not self.__succeeded:
+                raise result
+            logging.warning(f"学期 {self.term} 连续 {self.__failures} 周课表获取失败，停止获取")
+            self.done = True
+            return True
+        self.__failures = 0
+        self.__succeeded = True
+        self.classes += result
+        if len(result) == 0:
+            logging.debug(f"学期 {self.term} 课表共 {week} 周")
+            self.done = True
+        return self.done
+
+
 class Bit:
     
     def __init__(self, username=None, password=None):
         self.department = ''
         self.name = ''
-        self.__session = requests.session()
+        self.__session = mount_shared_adapter(requests.session())
         self.username = username
         self.__password = password
         self.scores = {}
         self.currentTerm = ''
         self.classTime = {}
+        self.loginTime = {}
+        self.scoresFingerprint = None
+        self.scoresUnchanged = False
+        self.missingWeeks = []
+        self.__login_lock = threading.Lock()
+        self.__relogin_time = {}
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_Bit__login_lock', None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        mount_shared_adapter(self.__session)
+        self.__login_lock = threading.Lock()
+        self.__dict__.setdefault('_Bit__relogin_time', {})
+        self.__dict__.setdefault('loginTime', {})
+        self.__dict__.setdefault('scoresFingerprint', None)
+        self.__dict__.setdefault('scoresUnchanged', False)
+        self.__dict__.setdefault('missingWeeks', [])
     
     def set_info(self, username, password):
         """
@@ -80,13 +634,90 @@ class Bit:
         self.username = username
         self.__password = password
     
+    def __request(self, method, url, **kwargs):
+        """
+        发送请求，受每个主机的并发上限和熔断器约束，使用接口的超时，幂等请求在网络错误和502、503、504时退避重试
+        :param method: 请求方法
+        :param url: 请求url
+        :return: 响应
+        """
+        attempts = UpstreamAttempts(method, url)
+        kwargs.setdefault('timeout', attempts.timeout)
+        for attempt in attempts:
+            try:
+                with tracing.span(f"http.{attempts.endpoint}", method=method, attempt=attempt), host_slot(url), \
+                        metrics.track_upstream(attempts.endpoint):
+                    response = self.__session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if not attempts.failed(e):
+                    raise
+            else:
+                if attempts.finished(response.status_code):
+                    return response
+                response.close()
+            time.sleep(attempts.backoff())
+    
+    @staticmethod
+    def __is_login_redirect(response):
+        """
+        判断响应是否被重定向到登录页
+        :param response: 响应
+        :return: 是否需要重新登录
+        """
+        login_pages = (f"{HOSTS['login']}/authserver/login", f"{HOSTS['webvpn']}/login")
+        return response.is_redirect or response.url.startswith(login_pages)
+    
+    def __ensure_login(self, realm):
+        """
+        确认登录状态，登录后TTL内直接视为已登录；开启探测时发送探测请求，否则留给实际请求懒验证
+        :param realm: 'cas'为统一身份认证，'webvpn'为webvpn
+        :return: 无
+        """
+        if not _login_probe or time.time() - self.loginTime.get(realm, 0) < LOGIN_TTL:
+            return
+        if realm == 'webvpn':
+            if not self.check_webvpn_login():
+                self.webvpn_login()
+        elif not self.check_login_status():
+            self.login()
+    
+    def __fetch(self, method, url, realm, **kwargs):
+        """
+        以登录身份请求数据接口，被重定向到登录页时重新登录并重试一次
+        多个线程同时发现登录失效时只登录一次，请求发出后已有其他线程重新登录的直接重试
+        :param method: 请求方法
+        :param url: 请求url
+        :param realm: 'cas'为统一身份认证，'webvpn'为webvpn
+        :return: 响应
+        """
+        if method == 'POST':
+            kwargs.setdefault('allow_redirects', False)
+        started = time.time()
+        response = self.__request(method, url, **kwargs)
+        if self.__is_login_redirect(response):
+            metrics.UPSTREAM_ERRORS.inc(endpoint_name(url), 'login_expired')
+            with self.__login_lock:
+                if self.__relogin_time.get(realm, 0) < started:
+                    logging.info(f"{self.username} 的{realm}登录失效，重新登录")
+                    self.loginTime.pop(realm, None)
+                    if realm == 'webvpn':
+                        self.webvpn_login()
+                    else:
+                        self.login()
+                    self.__relogin_time[realm] = time.time()
+            response = self.__request(method, url, **kwargs)
+            if self.__is_login_redirect(response):
+                raise BitInfoError("登录失败")
+        self.loginTime[realm] = time.time()
+        return response
+    
     def check_account_status(self):
         """
         检查账号状态，返回False说明账号异常
         :return: 账号是否正常
         """
-        result = self.__session.get('https://login.bit.edu.cn/authserver/checkNeedCaptcha.htl',
-                                    params={'username': self.username})
+        result = self.__request('GET', f"{HOSTS['login']}/authserver/checkNeedCaptcha.htl",
+                                params={'username': self.username})
         return not json.loads(result.text)['isNeed']
     
     def check_login_status(self):
@@ -94,11 +725,12 @@ class Bit:
         检查统一身份认证登录状态，未登录返回False
         :return: 是否已经登录
         """
-        result = self.__session.post('http://jxzxehallapp.bit.edu.cn/jwapp/sys/wdkbby/modules/xskcb/cxxsjbxx.do',
-                                     allow_redirects=False)
+        result = self.__request('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/xskcb/cxxsjbxx.do",
+                                allow_redirects=False)
         if result.status_code != 200:
             logging.info(f"{self.username} 的统一身份认证登录失效")
             return False
+        self.loginTime['cas'] = time.time()
         return True
     
     def check_webvpn_login(self):
@@ -106,29 +738,30 @@ class Bit:
         检查webvpn登录状态，未登录返回False
         :return: 是否已经登录
         """
-        result = self.__session.get(
-            'https://webvpn.bit.edu.cn/http/77726476706e69737468656265737421fae04c8f69326144300d8db9d6562d/jsxsd/framework/main.jsp',
+        result = self.__request(
+            'GET',
+            f"{HOSTS['webvpn']}{WEBVPN_JWXT}/framework/main.jsp",
             allow_redirects=False)
         if result.status_code != 200:
             logging.info(f"{self.username} 的webvpn登录失效")
             return False
+        self.loginTime['webvpn'] = time.time()
         return True
     
     def login_to_url(self, login_url):
         """
-        登录到url，为统一身份认证和webvpn提供登录
+        登录到url，为统一身份认证和webvpn提供登录，开启探测时先检查账号状态，否则只在登录失败时检查
         :param login_url: 登录url
         :return: 无
         """
-        if not self.check_account_status():
+        if _login_probe and not self.check_account_status():
             raise BitInfoError("账号异常")
-        result = self.__session.get(login_url)
+        result = self.__request('GET', login_url)
         login_url = result.url
-        page = BeautifulSoup(result.text, "html.parser")
-        if page.find(id="execution") is None:
+        form = parsers.parse_login_form(result.text)
+        if form is None:
             return
-        param_execution = page.find(id="execution")['value']
-        password_salt = page.find(id="pwdEncryptSalt")['value']
+        param_execution, password_salt = form
         param_password = encrypt_password(self.__password, password_salt)
         data = {
             'username': self.username,
@@ -141,25 +774,32 @@ class Bit:
             'lt': '',
             'execution': param_execution
         }
-        result = self.__session.post(login_url, data)
+        result = self.__request('POST', login_url, data=data)
         if result.status_code == 401:
+            if not _login_probe and not self.check_account_status():
+                raise BitInfoError("账号异常")
             raise BitInfoError("密码错误")
     
+    @tracing.traced('bit.login')
     def login(self):
         """
-        执行登录操作
+        执行登录操作，TTL内已登录时直接返回
         :return: 无
         :rtype: None
         """
         if self.username is None or self.__password is None:
             raise BitInfoError("账号或密码不能为空")
-        if self.check_login_status():
+        if time.time() - self.loginTime.get('cas', 0) < LOGIN_TTL:
             return
-        self.login_to_url('https://login.bit.edu.cn/authserver/login')
-        self.__session.get('http://jxzxehall.bit.edu.cn/login?service=http://jxzxehall.bit.edu.cn/new/index.html')
-        self.__session.get('http://jxzxehall.bit.edu.cn/appShow?appId=5959167891382285')
+        if _login_probe and self.check_login_status():
+            return
+        self.login_to_url(f"{HOSTS['login']}/authserver/login")
+        self.__request('GET', f"{HOSTS['ehall']}/login?service={HOSTS['ehall']}/new/index.html")
+        self.__request('GET', f"{HOSTS['ehall']}/appShow?appId=5959167891382285")
+        self.loginTime['cas'] = time.time()
         self.webvpn_login()
     
+    @tracing.traced('bit.webvpn_login')
     def webvpn_login(self):
         """
         登录webvpn
@@ -168,103 +808,336 @@ class Bit:
         """
         self.__session.cookies.set('show_vpn', '0', path='webvpn.bit.edu.cn')
         self.__session.cookies.set('refresh', '1', path='webvpn.bit.edu.cn')
-        self.login_to_url('https://webvpn.bit.edu.cn/login?cas_login=true')
-        self.__session.get(
-            'https://webvpn.bit.edu.cn/http/77726476706e69737468656265737421fae04c8f69326144300d8db9d6562d/jsxsd/kscj/cjcx_list')
+        self.login_to_url(f"{HOSTS['webvpn']}/login?cas_login=true")
+        self.__request(
+            'GET',
+            f"{HOSTS['webvpn']}{WEBVPN_JWXT}/kscj/cjcx_list")
+        self.loginTime['webvpn'] = time.time()
+    
+    def to_state(self):
+        """
+        导出紧凑的会话状态，只包含学号、加密后的密码、cookie、当前学期、上课时间和成绩
+        :return: 可JSON序列化的状态字典
+        """
+        return {
+            'version': STATE_VERSION,
+            'username': self.username,
+            'password': None if self.__password is None else encrypt_secret(self.__password),
+            'cookies': [{'name': i.name, 'value': i.value, 'domain': i.domain, 'path': i.path, 'expires': i.expires,
+                         'secure': i.secure, 'httponly': has_httponly(i._rest)}
+                        for i in self.__session.cookies],
+            'currentTerm': self.currentTerm,
+            'classTime': {i: [self.classTime[i]['begin'].strftime('%H:%M'), self.classTime[i]['end'].strftime('%H:%M')]
+                          for i in self.classTime},
+            'scores': self.scores,
+            'scoresFingerprint': self.scoresFingerprint
+        }
     
+    @classmethod
+    def from_state(cls, state):
+        """
+        从会话状态恢复对象，旧版本状态会先依次迁移到当前版本
+        :param state: to_state导出的状态字典
+        :return: Bit对象
+        """
+        state = migrate_state(state)
+        bit = cls(state['username'], None if state['password'] is None else decrypt_secret(state['password']))
+        for i in state['cookies']:
+            bit.__session.cookies.set(i['name'], i['value'], domain=i['domain'], path=i['path'], expires=i['expires'],
+                                      secure=i['secure'], rest={'HttpOnly': None} if i['httponly'] else {})
+        bit.currentTerm = state['currentTerm']
+        bit.classTime = {i: {'begin': datetime.datetime.strptime(state['classTime'][i][0], '%H:%M'),
+                             'end': datetime.datetime.strptime(state['classTime'][i][1], '%H:%M')}
+                         for i in state['classTime']}
+        bit.scores = state['scores']
+        bit.scoresFingerprint = state['scoresFingerprint']
+        return bit
+    
+    @tracing.traced('state.encode')
     def serialize(self):
         """
-        序列化为字节流
+        序列化为字节流，格式为STATE_MAGIC加压缩后的JSON状态
         :return: 字节流
         """
-        return pickle.dumps(self)
+        return encode_state(self.to_state())
+    
+    @classmethod
+    @tracing.traced('state.decode')
+    def deserialize(cls, data):
+        """
+        从字节流恢复对象，兼容旧版本pickle格式
+        :param data: serialize得到的字节流
+        :return: Bit对象
+        """
+        if data.startswith(STATE_MAGIC):
+            return cls.from_state(decode_state(data))
+        return pickle.loads(data)
     
     def get_info(self):
         """
         获取用户姓名和学院
         :return: {'name': 姓名, 'department': 学院}
         """
-        if not self.check_login_status():
-            raise BitInfoError("未登录")
-        result = self.__session.post('http://jxzxehallapp.bit.edu.cn/jwapp/sys/wdkbby/modules/xskcb/cxxsjbxx.do')
-        result = json.loads(result.text)['datas']['cxxsjbxx']['rows'][0]
-        self.name = result['XM']
-        self.department = result['YXMC']
-        return {'name': self.name, 'department': self.department}
+        self.__ensure_login('cas')
+        result = self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/xskcb/cxxsjbxx.do", 'cas')
+        info = parsers.parse_user_info(result.text)
+        self.name = info['name']
+        self.department = info['department']
+        return info
+    
+    @staticmethod
+    def __get_filename(response):
+        """
+        从响应头中解析文件名
+        :param response: 文件响应
+        :return: 文件名
+        """
+        return cgi.parse_header(response.headers['Content-Disposition'])[1]['filename'].encode(
+            'ISO-8859-1').decode('utf8')
+    
+    @staticmethod
+    def __save_stream(response, filepath):
+        """
+        将响应体分块写入临时文件，完成后重命名为目标文件
+        :param response: 以stream=True发起的响应
+        :param filepath: 目标文件路径
+        :return: (文件大小, sha256)
+        """
+        temppath = filepath + '.part'
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(temppath, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            os.replace(temppath, filepath)
+        except BaseException:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+            raise
+        return size, digest.hexdigest()
+    
+    @staticmethod
+    def __hash_file(filepath):
+        """
+        分块计算本地文件的sha256
+        :param filepath: 文件路径
+        :return: sha256
+        """
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
     
-    def download_file(self, url, path='', override=False):
+    def download_file(self, url, path='', override=False, quiet=False):
         """
-        从指定url下载单个文件并保存到指定路径
+        从指定url流式下载单个文件并保存到指定路径，先写入临时文件，完成后再重命名
         :param url: 文件url
         :param path: 保存路径，默认为运行路径
         :param override: 是否覆盖已存在的文件，默认为否
-        :return: 无
+        :param quiet: 是否不输出进度，默认为否
+        :return: 'downloaded'，跳过已存在的文件时返回'skipped'
         """
-        file = self.__session.get(url)
-        filename = cgi.parse_header(file.headers['Content-Disposition'])[1]['filename'].encode(
-            'ISO-8859-1').decode('utf8')
-        filepath = os.path.join(path, filename)
-        if not os.path.exists(filepath) or override:
-            with open(filepath, 'wb') as f:
-                f.write(file.content)
+        with self.__request('GET', url, stream=True) as file:
+            filepath = os.path.join(path, self.__get_filename(file))
+            if os.path.exists(filepath) and not override:
+                if not quiet:
+                    print(f"跳过已存在：{filepath}")
+                return 'skipped'
+            self.__save_stream(file, filepath)
+        if not quiet:
             print(f"已下载：{filepath}")
-        else:
-            print(f"跳过已存在：{filepath}")
+        return 'downloaded'
     
-    def download_lexue_course_files(self, courseid, path='', override=False):
+    def __sync_file(self, url, path, root, manifest, lock, quiet=False):
+        """
+        增量同步单个文件，用条件请求跳过未变化的文件，并更新课程清单
+        清单中没有记录但本地已有同名且大小一致的文件（如之前非同步下载的文件）时，直接记入清单而不重新下载
+        :param url: 文件url
+        :param path: 保存路径
+        :param root: 课程根目录，清单中的文件名相对于该目录
+        :param manifest: 课程清单，格式{ url: {'filename': 相对路径, 'size': 大小, 'etag': ETag, 'last_modified': Last-Modified, 'sha256': 哈希} }
+        :param lock: 保护清单的锁
+        :param quiet: 是否不输出进度
+        :return: 'added'、'changed'或'unchanged'
+        """
+        with lock:
+            entry = manifest.get(url)
+        headers = {}
+        if entry is not None:
+            local = os.path.join(root, entry['filename'])
+            if os.path.exists(local) and os.path.getsize(local) == entry['size']:
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+            else:
+                entry = None
+        with self.__request('GET', url, headers=headers, stream=True) as file:
+            if file.status_code == 304:
+                return 'unchanged'
+            filepath = os.path.join(path, self.__get_filename(file))
+            etag = file.headers.get('ETag')
+            last_modified = file.headers.get('Last-Modified')
+            length = file.headers.get('Content-Length')
+            if entry is None and length is not None and os.path.exists(filepath) \
+                    and os.path.getsize(filepath) == int(length):
+                with lock:
+                    manifest[url] = {'filename': os.path.relpath(filepath, root), 'size': int(length), 'etag': etag,
+                                     'last_modified': last_modified, 'sha256': self.__hash_file(filepath)}
+                return 'unchanged'
+            # 服务器忽略条件请求时，根据校验信息判断是否需要读取响应体
+            if entry is not None and entry['filename'] == os.path.relpath(filepath, root) and (
+                    (etag and etag == entry['etag']) or (last_modified and last_modified == entry['last_modified'])):
+                return 'unchanged'
+            size, sha256 = self.__save_stream(file, filepath)
+        status = 'added' if entry is None else 'changed'
+        if entry is not None and entry['sha256'] == sha256:
+            status = 'unchanged'
+        with lock:
+            manifest[url] = {'filename': os.path.relpath(filepath, root), 'size': size, 'etag': etag,
+                             'last_modified': last_modified, 'sha256': sha256}
+        if status != 'unchanged' and not quiet:
+            print(f"{'新增' if status == 'added' else '更新'}：{filepath}")
+        return status
+    
+    def download_lexue_course_files(self, courseid, path='', override=False, workers=4, sync=False, quiet=False):
         """
         根据课程号下载乐学课程文件并保存到指定路径
         :param courseid: 课程号
         :param path: 保存路径，默认为运行路径
         :param override: 是否覆盖已存在的文件，默认为否
-        :return: 无
+        :param workers: 并发下载文件的线程数，默认为4
+        :param sync: 是否按课程清单增量同步，默认为否
+        :param quiet: 是否不输出进度，默认为否
+        :return: 下载进度统计
         """
-        courseurl = 'https://lexue.bit.edu.cn/course/view.php?id=' + courseid
-        page = self.__session.get(courseurl).text
-        bs = BeautifulSoup(page, 'html.parser')
-        course_title = bs.find('h1').text
-        self.download_lexue_page_files(courseurl, os.path.join(path, course_title), override)
+        courseurl = f"{HOSTS['lexue']}/course/view.php?id={courseid}"
+        page = self.__request('GET', courseurl).text
+        course_title = parsers.parse_course_title(page)
+        return self.download_lexue_page_files(courseurl, os.path.join(path, course_title), override, workers, sync,
+                                              quiet)
     
-    def download_lexue_page_files(self, url, path='', override=False):
+    def __parse_lexue_page(self, url, path):
         """
-        递归下载乐学指定url页面上的文件
+        解析乐学页面，找出其中的文件和子页面
+        :param url: 页面url
+        :param path: 页面对应的保存路径
+        :return: (页面标题, 文件列表[(url, 保存路径)], 子页面列表[(url, 保存路径)])
+        """
+        result = self.__request('GET', url)
+        page = parsers.parse_lexue_page(result.text)
+        files = [(i, path) for i in page['files'] + page['resources']]
+        pages = [(i, os.path.join(path, name)) for i, name in page['folders'] + page['sections']]
+        return page['title'], files, pages
+    
+    def download_lexue_page_files(self, url, path='', override=False, workers=4, sync=False, quiet=False):
+        """
+        从指定url页面开始广度优先爬取乐学页面，爬取在当前线程进行，文件交给下载线程池流式下载
+        每个页面和文件只处理一次
+        增量同步时在path下维护课程清单，未变化的文件不会重新下载，清单中本次未出现的文件记为上游已删除并移出清单，本地文件保留
         :param url: 页面url
         :param path: 保存路径，默认为运行路径
-        :param override: 是否覆盖已存在的文件，默认为否
-        :return: 无
+        :param override: 是否覆盖已存在的文件，默认为否，增量同步时无效
+        :param workers: 并发下载文件的线程数，默认为4
+        :param sync: 是否按课程清单增量同步，默认为否
+        :param quiet: 是否不输出进度，默认为否，多个线程同时下载时可用于避免输出交错
+        :return: 下载进度统计 {'pages': 页面数, 'files': 文件数, 'downloaded': 已下载, 'skipped': 已跳过,
+                 'added': 新增, 'changed': 更新, 'unchanged': 未变化, 'removed': 上游已删除, 'failed': 失败}
         """
-        if not os.path.exists(path):
-            os.makedirs(path)
-        result = self.__session.get(url)
-        bs = BeautifulSoup(result.text, 'html.parser')
-        print(f"正在下载页面 {bs.title.text} 中的内容")
-        for i in bs.find_all(class_='fp-filename'):
-            if i.parent.has_attr('href'):
-                self.download_file(i.parent['href'], path, override)
-        if bs.find(class_='single-section'):
-            targets = bs.find(class_='single-section').findAll(class_='instancename')
-        elif bs.find(class_='topics'):
-            targets = bs.find(class_='topics').findAll(class_='instancename')
+        course = os.path.basename(os.path.normpath(path))
+        echo = (lambda *args: None) if quiet else print
+        progress = {'pages': 0, 'files': 0, 'downloaded': 0, 'skipped': 0, 'added': 0, 'changed': 0, 'unchanged': 0,
+                    'removed': 0, 'failed': 0}
+        lock = threading.Lock()
+        manifest_path = os.path.join(path, LEXUE_MANIFEST)
+        manifest = {}
+        if sync and os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        previous = set(manifest)
+        
+        def on_done(future, file_url):
+            with lock:
+                if future.exception() is not None:
+                    progress['failed'] += 1
+                    logging.error(f"下载 {file_url} 失败：{repr(future.exception())}")
+                else:
+                    progress[future.result()] += 1
+                done = sum(progress[i] for i in ('downloaded', 'skipped', 'added', 'changed', 'unchanged', 'failed'))
+                echo(f"[{course}] 文件进度 {done}/{progress['files']}")
+        
+        frontier = collections.deque([(url, path)])
+        visited = {url}
+        crawled = False
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                while frontier:
+                    page_url, page_path = frontier.popleft()
+                    os.makedirs(page_path, exist_ok=True)
+                    title, files, pages = self.__parse_lexue_page(page_url, page_path)
+                    progress['pages'] += 1
+                    echo(f"[{course}] 正在下载页面 {title} 中的内容")
+                    for file_url, file_path in files:
+                        if file_url in visited:
+                            continue
+                        visited.add(file_url)
+                        if sync:
+                            future = executor.submit(self.__sync_file, file_url, file_path, path, manifest, lock, quiet)
+                        else:
+                            future = executor.submit(self.download_file, file_url, file_path, override, quiet)
+                        with lock:
+                            progress['files'] += 1
+                        future.add_done_callback(lambda future, file_url=file_url: on_done(future, file_url))
+                    for sub_url, sub_path in pages:
+                        if sub_url not in visited:
+                            visited.add(sub_url)
+                            frontier.append((sub_url, sub_path))
+            crawled = True
+        finally:
+            # 爬取中途出错时也保存已下载文件的清单，但未爬取完整时无法判断上游是否已删除，保留原有记录
+            if sync:
+                if crawled:
+                    for i in previous - visited:
+                        echo(f"上游已删除，本地文件保留：{os.path.join(path, manifest.pop(i)['filename'])}")
+                        progress['removed'] += 1
+                with open(manifest_path + '.part', 'w', encoding='utf-8') as f:
+                    json.dump(manifest, f, ensure_ascii=False, indent=2)
+                os.replace(manifest_path + '.part', manifest_path)
+        if sync:
+            echo(f"[{course}] 同步完成，共 {progress['pages']} 个页面，{progress['files']} 个文件（新增 {progress['added']}，"
+                 f"更新 {progress['changed']}，未变化 {progress['unchanged']}，上游已删除 {progress['removed']}，"
+                 f"失败 {progress['failed']}）")
         else:
-            targets = bs.findAll(class_='instancename')
-        for i in targets:
-            type_tag = i.find(class_='accesshide')
-            if type_tag:
-                obj_type = type_tag.text.strip()
-                type_tag.decompose()
-                filepath = os.path.join(path, i.text)
-                if obj_type == '文件夹':
-                    if not os.path.exists(filepath):
-                        os.makedirs(filepath)
-                    self.download_lexue_page_files(i.parent['href'], filepath)
-                elif obj_type == '文件':
-                    self.download_file(i.parent['href'], path, override)
-        for i in bs.findAll(class_='section-title'):
-            self.download_lexue_page_files(i.a['href'], os.path.join(path, i.a.text))
-    
-    def get_scores_update(self, refresh_all=False):
+            echo(f"[{course}] 完成，共 {progress['pages']} 个页面，{progress['files']} 个文件（已下载 {progress['downloaded']}，"
+                 f"跳过 {progress['skipped']}，失败 {progress['failed']}）")
+        return progress
+    
+    def __get_score_analysis(self, data):
+        """
+        获取单门课程的成绩分析，补充到成绩项中
+        :param data: 成绩项，需包含课程号和学期
+        :return: 补充后的成绩项
+        """
+        response = self.__fetch(
+            'GET',
+            f"{HOSTS['webvpn']}{WEBVPN_JWXT}/kscj/cjfx",
+            'webvpn',
+            params={'xs0101id': self.username,
+                    'xnxq01id': data['term'],
+                    'kch': data['id']
+                    })
+        data.update(parsers.parse_score_analysis(response.text))
+        return data
+    
+    @tracing.traced('bit.get_scores_update')
+    def get_scores_update(self, refresh_all=False, workers=4):
         """
         从webvpn爬取新成绩，返回更新的成绩项
+        成绩列表指纹与上次相同时直接返回空字典并将scoresUnchanged置为True，不解析成绩项也不获取成绩分析
         字典项定义：
         课程号 - 学期: {
             'id': 课程号,
@@ -282,71 +1155,61 @@ class Bit:
             'all_rank': 所有学生排名
             }
         :param refresh_all: 是否刷新全部，默认为否
-        :return: 包含成绩相关信息的字典
+        :param workers: 并发获取成绩分析的线程数，默认为4
+        :return: 包含成绩相关信息的字典，顺序与成绩列表一致
         :rtype: dict
         """
-        if not self.check_webvpn_login():
-            self.webvpn_login()
-        url = "https://webvpn.bit.edu.cn/http/77726476706e69737468656265737421fae04c8f69326144300d8db9d6562d/jsxsd/kscj/cjcx_list"
-        response = self.__session.get(url)
-        page = BeautifulSoup(response.text, 'html.parser')
-        scores = page.find_all('tr')[2:]
-        updates = {}
-        for i in scores:
-            columns = i.find_all('td')
-            key = f"{columns[2].text} - {columns[1].text}"
+        self.__ensure_login('webvpn')
+        url = f"{HOSTS['webvpn']}{WEBVPN_JWXT}/kscj/cjcx_list"
+        response = self.__fetch('GET', url, 'webvpn')
+        rows = parsers.extract_table_rows(response.text)
+        fingerprint = parsers.score_list_fingerprint(rows)
+        self.scoresUnchanged = not refresh_all and fingerprint == self.scoresFingerprint
+        if self.scoresUnchanged:
+            logging.debug(f"{self.username} 的成绩列表没有变化")
+            return {}
+        pending = []
+        for data in parsers.parse_score_rows(rows):
+            key = f"{data['id']} - {data['term']}"
             if not refresh_all and key in self.scores:  # 如果scores中已经存在该项目则跳过
-                logging.debug(f"{columns[3].text} 成绩已存在")
+                logging.debug(f"{data['name']} 成绩已存在")
                 continue
-            data = {
-                'id': columns[2].text,
-                'term': columns[1].text,
-                'name': columns[3].text,
-                'type': columns[11].text,
-                'credit': float(columns[6].text),
-                'score': int(re.search(r'zcj=(\d+)', columns[-1].a['onclick']).group(1))}
-            response = self.__session.get(
-                'https://webvpn.bit.edu.cn/http/77726476706e69737468656265737421fae04c8f69326144300d8db9d6562d/jsxsd/kscj/cjfx',
-                params={'xs0101id': self.username,
-                        'xnxq01id': columns[1].text,
-                        'kch': columns[2].text
-                        })
-            bs = BeautifulSoup(response.text, 'html.parser')
-            analyse = bs.find_all('td')
-            data['class_total'] = int(re.search(r'\d+', analyse[1].text)[0])
-            data['majority_total'] = int(re.search(r'\d+', analyse[2].text)[0])
-            data['average'] = analyse[4].text.split('：')[1]
-            data['max'] = int(analyse[5].text.split('：')[1])
-            data['class_rank'] = int(analyse[8].text.split('：')[1].strip('%')) / 100
-            data['majority_rank'] = int(analyse[9].text.split('：')[1].strip('%')) / 100
-            data['all_rank'] = int(analyse[10].text.split('：')[1].strip('%')) / 100
-            self.scores[key] = data
-            updates[key] = data
+            pending.append((key, data))
+        updates = {}
+        if len(pending) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as executor:
+                results = list(executor.map(tracing.wrap(self.__get_score_analysis), [data for _, data in pending]))
+            for (key, _), data in zip(pending, results):
+                self.scores[key] = data
+                updates[key] = data
+        self.scoresFingerprint = fingerprint
         logging.debug(self.scores)
         return updates
     
+    def __load_current_term(self):
+        self.__ensure_login('cas')
+        response = self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/jshkcb/dqxnxq.do", 'cas')
+        return parsers.parse_current_term(response.text)
+    
+    @tracing.traced('bit.get_current_term')
     def get_current_term(self):
         """
-        获取当前学期并保存
+        获取当前学期并保存，优先使用所有用户共享的缓存
         :return: 当前学期，如2019-2020-1
         """
-        if not self.check_login_status():
-            self.login()
-        response = self.__session.post('http://jxzxehallapp.bit.edu.cn/jwapp/sys/wdkbby/modules/jshkcb/dqxnxq.do')
-        self.currentTerm = json.loads(response.text)['datas']['dqxnxq']['rows'][0]['DM']
+        self.currentTerm = TERM_CACHE.get('currentTerm', self.__load_current_term)
         return self.currentTerm
     
+    def __load_class_time(self):
+        response = self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/jshkcb/jc.do", 'cas')
+        return parsers.parse_class_time(response.text)
+    
     def __get_class_time(self):
         """
-        获取上课时间并保存，格式{ '第i节': {'begin': datetime,'end': datetime} }
+        获取上课时间并保存，优先使用所有用户共享的缓存，格式{ '第i节': {'begin': datetime,'end': datetime} }
         :return: 上课时间表
         """
-        self.classTime = {}
-        response = self.__session.post('http://jxzxehallapp.bit.edu.cn/jwapp/sys/wdkbby/modules/jshkcb/jc.do')
-        res = response.json()['datas']['jc']['rows']
-        for i in res:
-            self.classTime[i['MC']] = {'begin': datetime.datetime.strptime(i['KSSJ'], '%H:%M'),
-                                       'end': datetime.datetime.strptime(i['JSSJ'], '%H:%M')}
+        self.classTime = dict(TERM_CACHE.get('classTime', self.__load_class_time))
         return self.classTime
     
     def __get_week_classes(self, term, week):
@@ -357,55 +1220,57 @@ class Bit:
         :return: 课程信息list，格式为[{ 'name': 课程名, 'location': 上课地点, 'begin': 开始时间, 'end': 结束时间 }]
         """
         # 获取星期中对应日期
-        response = self.__session.post('http://jxzxehallapp.bit.edu.cn/jwapp/sys/wdkbby/wdkbByController/cxzkbrq.do',
-                                       data={'requestParamStr': f'{{"XNXQDM": "{term}", "ZC": "{week}"}}'})
-        res = response.json()['data']
-        date = {}
-        for i in res:
-            date[i['XQ']] = datetime.datetime.strptime(i['RQ'], '%Y-%m-%d')
-        response = self.__session.post('http://jxzxehallapp.bit.edu.cn/jwapp/sys/wdkbby/modules/xskcb/cxxszhxqkb.do',
-                                       {'XNXQDM': term, 'SKZC': str(week)})
-        res = response.json()['datas']['cxxszhxqkb']['rows']
-        classes = []
-        for i in res:
-            classes.append({'name': f"{i['KCM']}-{i['SKJS']}",
-                            'location': f"{i['XXXQMC']}{i['JASMC']}",
-                            'begin': get_datetime(date[i['SKXQ']], self.classTime[i['KSJC_DISPLAY']]['begin']),
-                            'end': get_datetime(date[i['SKXQ']], self.classTime[i['JSJC_DISPLAY']]['end'])
-                            })
-        return classes
-    
-    def get_term_classes(self, term=None):
-        """
-        获取指定学期课程信息
+        response = self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/wdkbByController/cxzkbrq.do",
+                                'cas', data={'requestParamStr': f'{{"XNXQDM": "{term}", "ZC": "{week}"}}'})
+        dates = parsers.parse_week_dates(response.text)
+        response = self.__fetch('POST', f"{HOSTS['ehallapp']}/jwapp/sys/wdkbby/modules/xskcb/cxxszhxqkb.do",
+                                'cas', data={'XNXQDM': term, 'SKZC': str(week)})
+        return parsers.parse_week_classes(response.text, dates, self.classTime)
+    
+    @tracing.traced('bit.get_term_classes')
+    def get_term_classes(self, term=None, window=1, partial=False):
+        """
+        获取指定学期课程信息，按窗口并发获取各周课表，结束和跳过失败周的规则见TermWeeks
+        获取失败的周记录在missingWeeks中
         :param term: 学期，如2019-2020-1
+        :param window: 每批并发获取的周数，默认为1即逐周获取
+        :param partial: 某周获取失败时是否跳过该周并返回部分课表，默认为否
         :return: 课程信息list，格式为[{ 'name': 课程名, 'location': 上课地点, 'begin': 开始时间, 'end': 结束时间 }]
         """
-        if not self.check_login_status():
-            self.login()
+        self.__ensure_login('cas')
         self.get_current_term()
         self.__get_class_time()
         if term is None:
             term = self.currentTerm
-        classes = []
-        for i in range(1, 100):
-            week_classes = self.__get_week_classes(term, i)
-            classes += week_classes
-            if len(week_classes) == 0:
-                logging.debug(f"学期 {term} 课表共 {i} 周")
-                break
-        return classes
+        weeks = TermWeeks(term, window, partial)
+        self.missingWeeks = weeks.missing
+        with ThreadPoolExecutor(max_workers=weeks.window) as executor:
+            for batch in weeks.batches():
+                futures = [executor.submit(tracing.wrap(self.__get_week_classes), term, i) for i in batch]
+                for i, future in zip(batch, futures):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = e
+                    if weeks.add(i, result):
+                        for f in futures:
+                            f.cancel()
+                        break
+        return weeks.classes
     
-    def get_term_classes_ics(self, term=None):
+    def get_term_classes_ics(self, term=None, window=1, partial=False, compress=False):
         """
         获取指定学期课程ics格式日程表
         :param term: 学期，如2019-2020-1
-        :return: 课程信息ics
+        :param window: 每批并发获取的周数，默认为1即逐周获取
+        :param partial: 某周获取失败时是否跳过该周并返回部分课表，默认为否
+        :param compress: 是否将每周重复的课程合并为RRULE重复事件并直接生成ics文本，默认为否
+        :return: 课程信息ics，compress时为ics文本
         """
-        classes = self.get_term_classes(term)
-        res = build_ics(classes)
-        return res
+        classes = self.get_term_classes(term, window, partial)
+        return render_classes_ics(classes, compress)
     
+    @tracing.traced('bit.get_exams')
     def get_exams(self, term=None):
         """
         获取指定学期考试安排信息
@@ -414,23 +1279,12 @@ class Bit:
         """
         if term is None:
             term = self.currentTerm
-        response = self.__session.post(
-            "http://jxzxehallapp.bit.edu.cn/jwapp/sys/studentWdksapApp/WdksapController/cxxsksap.do",
-            {'requestParamStr': f'{{"XNXQDM":"{term}","*order":"-KSRQ,-KSSJMS"}}'})
-        res = response.json()['datas']['cxxsksap']['rows']
-        exams = []
-        for i in res:
-            date = re.findall(r"\d+-\d+-\d+", i['KSSJMS'])[0]
-            exams.append({'name': "%s-%s-%s" % (i['KCM'], i['ZJJSXM'], i['KCH']),
-                          'location': i['JASMC'],
-                          'begin': datetime.datetime.strptime(
-                              date + ' ' + re.findall(r"\d+-\d+-\d+ (\d+:\d+)", i['KSSJMS'])[0],
-                              "%Y-%m-%d %H:%M").replace(tzinfo=TZ),
-                          'end': datetime.datetime.strptime(
-                              date + ' ' + re.findall(r"\d+-\d+-\d+ \d+:\d+-(\d+:\d+)", i['KSSJMS'])[0],
-                              "%Y-%m-%d %H:%M").replace(tzinfo=TZ), 'description': f"座位号：{i['ZWH']}"
-                          })
-        return exams
+        response = self.__fetch(
+            'POST',
+            f"{HOSTS['ehallapp']}/jwapp/sys/studentWdksapApp/WdksapController/cxxsksap.do",
+            'cas',
+            data={'requestParamStr': f'{{"XNXQDM":"{term}","*order":"-KSRQ,-KSSJMS"}}'})
+        return parsers.parse_exams(response.text)
     
     def get_exams_ics(self, term=None):
         """
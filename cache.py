@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import threading
+import time
+
+
+class RenderCache:
+    """
+    已生成ics文档的缓存，键为(学号, 学期, 类型, 内容摘要)，同时记录首次上传后Telegram返回的file_id
+    每个(学号, 学期, 类型)最近一次确认的内容在ttl内视为最新，可以不访问上游直接重发file_id
+    按最近最少使用淘汰，总大小不超过max_bytes
+    """
+    
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_entries=1024, ttl=1800):
+        self.__max_bytes = max_bytes
+        self.__max_entries = max_entries
+        self.__ttl = ttl
+        self.__entries = collections.OrderedDict()
+        self.__latest = {}
+        self.__size = 0
+        self.__lock = threading.Lock()
+    
+    @property
+    def size(self):
+        return self.__size
+    
+    def __len__(self):
+        return len(self.__entries)
+    
+    def __touch(self, key):
+        self.__entries.move_to_end(key)
+        return self.__entries[key]
+    
+    def lookup(self, username, term, kind):
+        """
+        获取ttl内确认过的最新文档
+        :param username: 学号
+        :param term: 学期，如2019-2020-1
+        :param kind: 文档类型，如classes、exams
+        :return: 缓存项，格式{ 'key', 'body', 'file_id', 'extra' }，没有或已过期时返回None
+        """
+        with self.__lock:
+            latest = self.__latest.get((username, term, kind))
+            if latest is None or time.monotonic() - latest[1] > self.__ttl:
+                return None
+            key = (username, term, kind, latest[0])
+            if key not in self.__entries:
+                return None
+            return self.__touch(key)
+    
+    def get(self, username, term, kind, digest):
+        """
+        按内容摘要获取文档，命中时将其记为最新
+        :param username: 学号
+        :param term: 学期，如2019-2020-1
+        :param kind: 文档类型
+        :param digest: 内容摘要
+        :return: 缓存项，未命中返回None
+        """
+        key = (username, term, kind, digest)
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__latest[(username, term, kind)] = (digest, time.monotonic())
+            return self.__touch(key)
+    
+    def put(self, username, term, kind, digest, body, extra=None):
+        """
+        存入新生成的文档并记为最新，同一(学号, 学期, 类型)的旧文档被替换
+        :param username: 学号
+        :param term: 学期，如2019-2020-1
+        :param kind: 文档类型
+        :param digest: 内容摘要
+        :param body: 文档内容bytes
+        :param extra: 随文档缓存的其他数据，如消息文本
+        :return: 缓存项
+        """
+        key = (username, term, kind, digest)
+        entry = {'key': key, 'body': body, 'file_id': None, 'extra': extra}
+        with self.__lock:
+            old = self.__latest.get((username, term, kind))
+            if old is not None:
+                self.__remove((username, term, kind, old[0]))
+            self.__remove(key)
+            self.__entries[key] = entry
+            self.__size += len(body)
+            self.__latest[(username, term, kind)] = (digest, time.monotonic())
+            while self.__entries and (self.__size > self.__max_bytes or len(self.__entries) > self.__max_entries):
+                self.__remove(next(iter(self.__entries)))
+        return entry
+    
+    def set_file_id(self, entry, file_id):
+        """
+        记录文档上传后Telegram返回的file_id
+        :param entry: 缓存项
+        :param file_id: Telegram file_id，为None时清除
+        :return: 无
+        """
+        with self.__lock:
+            entry['file_id'] = file_id
+    
+    def __remove(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is None:
+            return
+        self.__size -= len(entry['body'])
+        latest = self.__latest.get(key[:3])
+        if latest is not None and latest[0] == key[3]:
+            del self.__latest[key[:3]]
+    
+    def invalidate(self, username=None, term=None, kind=None):
+        """
+        删除匹配的缓存项，参数为None时匹配所有值
+        :param username: 学号
+        :param term: 学期
+        :param kind: 文档类型
+        :return: 删除的缓存项数
+        """
+        with self.__lock:
+            keys = [k for k in self.__entries if (username is None or k[0] == username) and
+                    (term is None or k[1] == term) and (kind is None or k[2] == kind)]
+            for key in keys:
+                self.__remove(key)
+            return len(keys)
+
+
+class TTLCache:
+    """
+    进程内带过期时间的缓存，同一个键同时未命中时只有一个线程执行加载，其余线程等待其结果
+    """
+    
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.__values = {}
+        self.__loading = {}
+        self.__lock = threading.Lock()
+    
+    def put(self, key, value):
+        """
+        存入值
+        :param key: 键
+        :param value: 值
+        :return: 无
+        """
+        with self.__lock:
+            self.__values[key] = (value, time.monotonic())
+    
+    def __claim(self, key):
+        """
+        查询缓存，未命中且没有其他调用方在加载时由本次调用负责加载
+        :return: (是否命中, 命中的值或加载完成时触发的Event, 是否由本次调用加载)
+        """
+        with self.__lock:
+            item = self.__values.get(key)
+            if item is not None and time.monotonic() - item[1] <= self.ttl:
+                return True, item[0], False
+            event = self.__loading.get(key)
+            if event is not None:
+                return False, event, False
+            event = self.__loading[key] = threading.Event()
+            return False, event, True
+    
+    def __release(self, key, event):
+        with self.__lock:
+            del self.__loading[key]
+        event.set()
+    
+    def get(self, key, loader):
+        """
+        获取值，未命中时调用loader加载；加载中的键等待加载完成，加载失败时由等待的线程之一重新加载
+        :param key: 键
+        :param loader: 无参数的加载函数
+        :return: 值
+        """
+        while True:
+            hit, value, owner = self.__claim(key)
+            if hit:
+                return value
+            if owner:
+                break
+            value.wait()
+        try:
+            result = loader()
+            self.put(key, result)
+            return result
+        finally:
+            self.__release(key, value)
+    
+    async def get_async(self, key, loader):
+        """
+        get的协程版本，与get共享同一次加载，等待其他线程或协程加载时不阻塞事件循环
+        :param key: 键
+        :param loader: 无参数的协程函数
+        :return: 值
+        """
+        while True:
+            hit, value, owner = self.__claim(key)
+            if hit:
+                return value
+            if owner:
+                break
+            await asyncio.get_running_loop().run_in_executor(None, value.wait)
+        try:
+            result = await loader()
+            self.put(key, result)
+            return result
+        finally:
+            self.__release(key, value)
+    
+    def invalidate(self, key=None):
+        """
+        删除缓存的值
+        :param key: 键，为None时删除全部
+        :return: 无
+        """
+        with self.__lock:
+            if key is None:
+                self.__values.clear()
+            else:
+                self.__values.pop(key, None)
@@ -0,0 +1,227 @@
+import email.utils
+import logging
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ics_writer
+from bit import Bit
+
+FEED_KINDS = ('classes', 'exams')
+
+
+class CalendarFeeds:
+    """
+    托管日历缓存，每个用户的课表和考试安排各有一份预先生成的ics
+    后台按间隔重新获取已被订阅的日历，只有内容摘要变化时才重新生成ics并更新ETag和Last-Modified
+    """
+    
+    def __init__(self, storage, refresh_interval=3600, week_window=20, compress=False, idle_timeout=7 * 86400):
+        self.__storage = storage
+        self.__refresh_interval = refresh_interval
+        self.__week_window = week_window
+        self.__compress = compress
+        self.__idle_timeout = idle_timeout
+        self.__cache = {}
+        self.__lock = threading.Lock()
+        self.__build_locks = {}
+        self.__stop = threading.Event()
+    
+    def __build_lock(self, key):
+        with self.__lock:
+            return self.__build_locks.setdefault(key, threading.Lock())
+    
+    def __evict(self, key):
+        # 调用时需持有self.__lock；正在进行的生成仍持有用户锁，丢弃其生成锁不会导致同一用户并发访问上游
+        self.__cache.pop(key, None)
+        self.__build_locks.pop(key, None)
+    
+    def __fetch_events(self, bit, kind):
+        if kind == 'classes':
+            return bit.get_term_classes(window=self.__week_window)
+        bit.get_current_term()
+        return bit.get_exams()
+    
+    def __render(self, events, kind):
+        if kind == 'classes' and self.__compress:
+            events = ics_writer.compress_weekly(events)
+        return ics_writer.render_calendar(events).encode('utf-8')
+    
+    def build(self, tgid, kind):
+        """
+        从上游获取日历内容，内容未变化时只更新检查时间
+        :param tgid: Telegram ChatID
+        :param kind: 日历类型，classes或exams
+        :return: 缓存项，用户未绑定时返回None
+        """
+        key = (str(tgid), kind)
+        with self.__build_lock(key), self.__storage.user_lock(tgid):
+            obj = self.__storage.get_obj(tgid)
+            if obj is None:
+                self.invalidate(tgid)
+                return None
+            bit = Bit.deserialize(obj)
+            events = self.__fetch_events(bit, kind)
+            self.__storage.save_obj(bit.username, bit.serialize(), tgid)
+            digest = ics_writer.content_hash(events)
+            now = time.time()
+            with self.__lock:
+                entry = self.__cache.get(key)
+                if entry is not None and entry['hash'] == digest:
+                    entry['checked'] = now
+                    return entry
+            entry = {'hash': digest, 'etag': f'"{digest}"', 'modified': now, 'checked': now, 'accessed': now,
+                     'body': self.__render(events, kind)}
+            with self.__lock:
+                self.__cache[key] = entry
+            logging.info(f"已重新生成{tgid}的{kind}日历")
+            return entry
+    
+    def get(self, tgid, kind):
+        """
+        获取缓存的日历，未缓存时立即生成
+        :param tgid: Telegram ChatID
+        :param kind: 日历类型，classes或exams
+        :return: 缓存项，格式{ 'hash', 'etag', 'modified', 'checked', 'accessed', 'body' }
+        """
+        key = (str(tgid), kind)
+        with self.__lock:
+            entry = self.__cache.get(key)
+            if entry is not None:
+                entry['accessed'] = time.time()
+                return entry
+        return self.build(tgid, kind)
+    
+    def invalidate(self, tgid):
+        """
+        删除用户的日历缓存
+        :param tgid: Telegram ChatID
+        :return: 无
+        """
+        with self.__lock:
+            for kind in FEED_KINDS:
+                self.__evict((str(tgid), kind))
+    
+    def refresh_stale(self):
+        """
+        重新获取超过刷新间隔的日历，长时间没有被访问的日历不再刷新并移出缓存
+        :return: 无
+        """
+        now = time.time()
+        with self.__lock:
+            for key in [k for k, v in self.__cache.items() if now - v['accessed'] > self.__idle_timeout]:
+                self.__evict(key)
+            stale = [k for k, v in self.__cache.items() if now - v['checked'] >= self.__refresh_interval]
+        for tgid, kind in stale:
+            if self.__stop.is_set():
+                return
+            try:
+                self.build(tgid, kind)
+            except Exception as e:
+                logging.error(f"刷新{tgid}的{kind}日历失败：{repr(e)}")
+                logging.debug(traceback.format_exc())
+    
+    def start(self):
+        """
+        在后台线程中定期刷新日历
+        :return: 无
+        """
+        def loop():
+            while not self.__stop.wait(min(60, self.__refresh_interval)):
+                self.refresh_stale()
+        
+        threading.Thread(target=loop, daemon=True).start()
+    
+    def stop(self):
+        self.__stop.set()
+
+
+class CalendarHandler(BaseHTTPRequestHandler):
+    """
+    处理 /calendar/<token>/<classes|exams>.ics 请求
+    """
+    
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+    
+    def __send(self, status, body=b'', headers=None, head=False):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+    
+    @staticmethod
+    def __not_modified(entry, if_none_match, if_modified_since):
+        if if_none_match is not None:
+            tags = [i.strip() for i in if_none_match.split(',')]
+            return '*' in tags or entry['etag'] in tags or f"W/{entry['etag']}" in tags
+        if if_modified_since is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(entry['modified']) <= since
+        return False
+    
+    def __serve(self, head=False):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'calendar' or not parts[2].endswith('.ics') \
+                or parts[2][:-4] not in FEED_KINDS:
+            self.__send(404, head=head)
+            return
+        token, kind = parts[1], parts[2][:-4]
+        tgid = self.server.storage.get_feed_user(token)
+        if tgid is None:
+            self.__send(404, head=head)
+            return
+        try:
+            entry = self.server.feeds.get(tgid, kind)
+        except Exception as e:
+            logging.error(f"生成{tgid}的{kind}日历失败：{repr(e)}")
+            logging.debug(traceback.format_exc())
+            self.__send(503, headers={'Retry-After': '300'}, head=head)
+            return
+        if entry is None:
+            self.__send(404, head=head)
+            return
+        headers = {'ETag': entry['etag'],
+                   'Last-Modified': email.utils.formatdate(entry['modified'], usegmt=True),
+                   'Cache-Control': f"private, max-age={self.server.max_age}"}
+        if self.__not_modified(entry, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')):
+            self.__send(304, headers=headers, head=True)
+            return
+        headers['Content-Type'] = 'text/calendar; charset=utf-8'
+        self.__send(200, entry['body'], headers, head)
+    
+    def do_GET(self):
+        self.__serve()
+    
+    def do_HEAD(self):
+        self.__serve(head=True)
+
+
+class CalendarServer(ThreadingHTTPServer):
+    """
+    日历托管服务，通过每个用户的私密链接提供课表和考试安排
+    """
+    daemon_threads = True
+    
+    def __init__(self, storage, feeds, host='0.0.0.0', port=8080, max_age=300):
+        super().__init__((host, port), CalendarHandler)
+        self.storage = storage
+        self.feeds = feeds
+        self.max_age = max_age
+    
+    def start(self):
+        """
+        在后台线程中启动服务和日历刷新
+        :return: 无
+        """
+        self.feeds.start()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        logging.info(f"日历托管服务已启动 {self.server_address[0]}:{self.server_address[1]}")
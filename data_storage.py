@@ -1,17 +1,182 @@
+import contextlib
+import logging
+import pickle
+import secrets
 import sqlite3
+import threading
+
+import analytics
+import tracing
+
+SCORE_COLUMNS = (('id', 'ID'), ('term', 'Term'), ('name', 'Name'), ('type', 'Type'), ('credit', 'Credit'),
+                 ('score', 'Score'), ('average', 'Average'), ('max', 'Max'), ('class_rank', 'ClassRank'),
+                 ('class_total', 'ClassTotal'), ('majority_rank', 'MajorityRank'),
+                 ('majority_total', 'MajorityTotal'), ('all_rank', 'AllRank'))
 
 
 class SqliteStorage:
     
     def __init__(self, filename):
-        self.__conn = sqlite3.connect(filename, check_same_thread=False)
-        self.__cursor = self.__conn.cursor()
-        self.__cursor.execute("CREATE TABLE IF NOT EXISTS BIT\n"
-                              "        (ID TEXT,\n"
-                              "        Obj TEXT,\n"
-                              "        TGID TEXT PRIMARY KEY\n"
-                              "        )\n")
+        self.__filename = filename
+        self.__local = threading.local()
+        self.__connections = []
+        self.__connections_lock = threading.Lock()
+        self.__user_locks = {}
+        self.__user_locks_lock = threading.Lock()
+        with self.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS BIT\n"
+                         "        (ID TEXT,\n"
+                         "        Obj TEXT,\n"
+                         "        TGID TEXT PRIMARY KEY\n"
+                         "        )\n")
+            conn.execute("CREATE TABLE IF NOT EXISTS SCORES\n"
+                         "        (TGID TEXT,\n"
+                         "        ID TEXT,\n"
+                         "        Term TEXT,\n"
+                         "        Name TEXT,\n"
+                         "        Type TEXT,\n"
+                         "        Credit REAL,\n"
+                         "        Score INTEGER,\n"
+                         "        Average TEXT,\n"
+                         "        Max INTEGER,\n"
+                         "        ClassRank REAL,\n"
+                         "        ClassTotal INTEGER,\n"
+                         "        MajorityRank REAL,\n"
+                         "        MajorityTotal INTEGER,\n"
+                         "        AllRank REAL,\n"
+                         "        PRIMARY KEY (TGID, ID, Term)\n"
+                         "        )\n")
+            conn.execute("CREATE INDEX IF NOT EXISTS SCORES_Term ON SCORES(TGID, Term)")
+            conn.execute("CREATE INDEX IF NOT EXISTS SCORES_Type ON SCORES(TGID, Type)")
+            conn.execute("CREATE TABLE IF NOT EXISTS SCHEDULE\n"
+                         "        (TGID TEXT PRIMARY KEY,\n"
+                         "        NextCheck REAL,\n"
+                         "        Failures INTEGER DEFAULT 0,\n"
+                         "        LastChange REAL\n"
+                         "        )\n")
+            conn.execute("CREATE INDEX IF NOT EXISTS SCHEDULE_NextCheck ON SCHEDULE(NextCheck)")
+            conn.execute("CREATE TABLE IF NOT EXISTS FEEDS\n"
+                         "        (TGID TEXT PRIMARY KEY,\n"
+                         "        Token TEXT UNIQUE\n"
+                         "        )\n")
+            conn.execute("CREATE TABLE IF NOT EXISTS OUTBOX\n"
+                         "        (ID INTEGER PRIMARY KEY AUTOINCREMENT,\n"
+                         "        ChatID TEXT,\n"
+                         "        Text TEXT,\n"
+                         "        Created REAL,\n"
+                         "        NextAttempt REAL,\n"
+                         "        Attempts INTEGER DEFAULT 0\n"
+                         "        )\n")
+            conn.execute("CREATE TABLE IF NOT EXISTS AGGREGATES\n"
+                         "        (TGID TEXT,\n"
+                         "        Term TEXT,\n"
+                         "        Type TEXT,\n"
+                         "        Count INTEGER,\n"
+                         "        Credits REAL,\n"
+                         "        ScoreSum REAL,\n"
+                         "        Histogram TEXT,\n"
+                         "        ClassRankSum REAL,\n"
+                         "        ClassRankCredits REAL,\n"
+                         "        MajorityRankSum REAL,\n"
+                         "        MajorityRankCredits REAL,\n"
+                         "        PRIMARY KEY (TGID, Term, Type)\n"
+                         "        )\n")
+            conn.execute("CREATE INDEX IF NOT EXISTS OUTBOX_NextAttempt ON OUTBOX(NextAttempt)")
+            conn.execute("CREATE INDEX IF NOT EXISTS OUTBOX_ChatID ON OUTBOX(ChatID, ID)")
+        self.__migrate()
     
+    def __connection(self):
+        """
+        获取当前线程的数据库连接，首次使用时创建并启用WAL
+        :return: 数据库连接
+        """
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.__filename, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.__local.conn = conn
+            self.__local.depth = 0
+            with self.__connections_lock:
+                self.__connections.append(conn)
+        return conn
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        在当前线程的连接上开启事务，正常退出时提交，异常时回滚，嵌套调用时并入最外层事务
+        :return: 数据库连接
+        """
+        conn = self.__connection()
+        self.__local.depth += 1
+        try:
+            if self.__local.depth > 1:
+                yield conn
+            else:
+                with conn:
+                    yield conn
+        finally:
+            self.__local.depth -= 1
+    
+    def user_lock(self, tgid):
+        """
+        获取用户的锁，读取、修改并保存会话对象的操作需要持有该锁，避免并发操作互相覆盖
+        :param tgid: Telegram ChatID
+        :return: 可重入锁
+        """
+        with self.__user_locks_lock:
+            return self.__user_locks.setdefault(str(tgid), threading.RLock())
+    
+    def __migrate(self):
+        """
+        一次性迁移：
+        1. 将旧版本序列化对象中的成绩写入SCORES表
+        2. 为已有成绩生成AGGREGATES聚合数据
+        :return: 无
+        """
+        with self.transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version < 1:
+                for tgid, obj in conn.execute("SELECT TGID, Obj FROM BIT").fetchall():
+                    try:
+                        scores = pickle.loads(obj).scores
+                    except Exception as e:
+                        logging.error(f"迁移{tgid}的成绩失败：{repr(e)}")
+                        continue
+                    conn.executemany(self.__replace_scores_sql(), self.__score_rows(tgid, scores))
+            if version < 2:
+                for tgid, term, course_type in conn.execute("SELECT DISTINCT TGID, Term, Type FROM SCORES").fetchall():
+                    self.__update_aggregate(conn, tgid, term, course_type)
+                conn.execute("PRAGMA user_version = 2")
+    
+    @staticmethod
+    def __update_aggregate(conn, tgid, term, course_type):
+        """
+        重新计算一组成绩的聚合数据，一组为同一用户同一学期同一课程性质的成绩
+        :return: 无
+        """
+        rows = conn.execute("SELECT Score, Credit, ClassRank, MajorityRank FROM SCORES "
+                            "WHERE TGID=? AND Term=? AND Type IS ?", (tgid, term, course_type)).fetchall()
+        if len(rows) == 0:
+            conn.execute("DELETE FROM AGGREGATES WHERE TGID=? AND Term=? AND Type IS ?", (tgid, term, course_type))
+            return
+        agg = analytics.aggregate(rows)
+        conn.execute("REPLACE INTO AGGREGATES(TGID,Term,Type,Count,Credits,ScoreSum,Histogram,ClassRankSum,"
+                     "ClassRankCredits,MajorityRankSum,MajorityRankCredits) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                     (tgid, term, course_type, agg['count'], agg['credits'], agg['score_sum'],
+                      analytics.encode_histogram(agg), agg['class_rank_sum'], agg['class_rank_credits'],
+                      agg['majority_rank_sum'], agg['majority_rank_credits']))
+    
+    @staticmethod
+    def __replace_scores_sql():
+        return (f"REPLACE INTO SCORES(TGID,{','.join(i[1] for i in SCORE_COLUMNS)}) "
+                f"VALUES (?{',?' * len(SCORE_COLUMNS)})")
+    
+    @staticmethod
+    def __score_rows(tgid, scores):
+        return [(tgid, *(scores[i].get(key) for key, _ in SCORE_COLUMNS)) for i in scores]
+    
+    @tracing.traced('db.save_obj')
     def save_obj(self, username, obj, tgid):
         """
         存储序列化对象到数据库中
@@ -20,41 +185,270 @@ class SqliteStorage:
         :param obj: 用户名对应的会话对象
         :return: 无
         """
-        self.__cursor.execute("REPLACE INTO BIT(ID,Obj,TGID) VALUES (?,?,?)", (username, obj, tgid))
-        self.__conn.commit()
+        with self.transaction() as conn:
+            conn.execute("REPLACE INTO BIT(ID,Obj,TGID) VALUES (?,?,?)", (username, obj, str(tgid)))
     
+    @tracing.traced('db.get_obj')
     def get_obj(self, tgid):
         """
         获取Telegram ChatID对应的会话对象
         :param tgid: Telegram ChatID
         :return: 对应的会话对象字节流
         """
-        self.__cursor.execute("SELECT Obj FROM BIT WHERE TGID='%s'" % tgid)
-        res = self.__cursor.fetchone()
+        res = self.__connection().execute("SELECT Obj FROM BIT WHERE TGID=?", (str(tgid),)).fetchone()
         if res is not None:
             return res[0]
         return None
     
+    def get_username(self, tgid):
+        """
+        获取Telegram ChatID绑定的学号，不读取会话对象
+        :param tgid: Telegram ChatID
+        :return: 学号，未绑定返回None
+        """
+        res = self.__connection().execute("SELECT ID FROM BIT WHERE TGID=?", (str(tgid),)).fetchone()
+        if res is not None:
+            return res[0]
+        return None
+    
+    @tracing.traced('db.save_scores')
+    def save_scores(self, tgid, scores):
+        """
+        存储成绩项，已存在的同一课程同一学期成绩会被覆盖，并更新涉及的学期和课程性质的聚合数据
+        :param tgid: Telegram ChatID
+        :param scores: 成绩字典，格式同Bit.scores
+        :return: 无
+        """
+        with self.transaction() as conn:
+            groups = {(scores[i]['term'], scores[i]['type']) for i in scores}
+            # 覆盖已存在的成绩时课程性质可能变化，原来所在的组也要重新计算
+            for key in scores:
+                old = conn.execute("SELECT Term, Type FROM SCORES WHERE TGID=? AND ID=? AND Term=?",
+                                   (str(tgid), scores[key]['id'], scores[key]['term'])).fetchone()
+                if old is not None:
+                    groups.add(old)
+            conn.executemany(self.__replace_scores_sql(), self.__score_rows(str(tgid), scores))
+            for term, course_type in groups:
+                self.__update_aggregate(conn, str(tgid), term, course_type)
+    
+    @tracing.traced('db.get_scores')
+    def get_scores(self, tgid, term=None, course_type=None):
+        """
+        查询成绩项
+        :param tgid: Telegram ChatID
+        :param term: 学期，如2019-2020-1，默认为所有学期
+        :param course_type: 课程性质，默认为所有课程
+        :return: 成绩字典，格式同Bit.scores
+        """
+        sql = f"SELECT {','.join(i[1] for i in SCORE_COLUMNS)} FROM SCORES WHERE TGID=?"
+        params = [str(tgid)]
+        if term is not None:
+            sql += " AND Term=?"
+            params.append(term)
+        if course_type is not None:
+            sql += " AND Type=?"
+            params.append(course_type)
+        scores = {}
+        for row in self.__connection().execute(sql + " ORDER BY rowid", params).fetchall():
+            data = {key: value for (key, _), value in zip(SCORE_COLUMNS, row)}
+            scores[f"{data['id']} - {data['term']}"] = data
+        return scores
+    
+    def get_aggregates(self, tgid, term=None):
+        """
+        查询成绩聚合数据，不读取成绩项
+        :param tgid: Telegram ChatID
+        :param term: 学期，如2019-2020-1，默认为所有学期
+        :return: [(学期, 课程性质, 聚合数据)]，聚合数据格式同analytics.aggregate
+        """
+        sql = ("SELECT Term, Type, Count, Credits, ScoreSum, Histogram, ClassRankSum, ClassRankCredits, "
+               "MajorityRankSum, MajorityRankCredits FROM AGGREGATES WHERE TGID=?")
+        params = [str(tgid)]
+        if term is not None:
+            sql += " AND Term=?"
+            params.append(term)
+        return [(row[0], row[1], analytics.decode(row[2:]))
+                for row in self.__connection().execute(sql + " ORDER BY Term", params).fetchall()]
+    
     def delete_user(self, tgid):
         """
         删除Telegram ChatID对应的用户
         :param tgid:
         :return:
         """
-        self.__cursor.execute("DELETE FROM BIT WHERE TGID='%s'" % tgid)
-        self.__conn.commit()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM BIT WHERE TGID=?", (str(tgid),))
+            conn.execute("DELETE FROM SCORES WHERE TGID=?", (str(tgid),))
+            conn.execute("DELETE FROM AGGREGATES WHERE TGID=?", (str(tgid),))
+            conn.execute("DELETE FROM FEEDS WHERE TGID=?", (str(tgid),))
+            conn.execute("DELETE FROM SCHEDULE WHERE TGID=?", (str(tgid),))
+    
+    def schedule_new_users(self, now, spread):
+        """
+        为还没有成绩检查计划的用户安排首次检查，时间在now之后spread秒内随机分布
+        :param now: 当前时间戳
+        :param spread: 分布范围，单位秒
+        :return: 新安排的用户数
+        """
+        with self.transaction() as conn:
+            return conn.execute("INSERT INTO SCHEDULE(TGID,NextCheck,Failures,LastChange) "
+                                "SELECT TGID, ? + abs(random() % ?), 0, NULL FROM BIT "
+                                "WHERE TGID NOT IN (SELECT TGID FROM SCHEDULE)",
+                                (now, max(1, int(spread)))).rowcount
+    
+    def get_due_users(self, now, limit):
+        """
+        获取到期需要检查成绩的用户，最早到期的在前
+        :param now: 当前时间戳
+        :param limit: 最多返回的用户数
+        :return: [(Telegram ChatID, 连续失败次数, 上次成绩变化时间)]
+        """
+        return self.__connection().execute("SELECT TGID, Failures, LastChange FROM SCHEDULE WHERE NextCheck<=? "
+                                           "ORDER BY NextCheck LIMIT ?", (now, limit)).fetchall()
+    
+    def update_schedule(self, tgid, next_check, failures, last_change):
+        """
+        更新用户的成绩检查计划，检查期间已解绑的用户没有计划，不会重新创建
+        :param tgid: Telegram ChatID
+        :param next_check: 下次检查时间戳
+        :param failures: 连续失败次数
+        :param last_change: 上次成绩变化时间戳，没有时为None
+        :return: 无
+        """
+        with self.transaction() as conn:
+            conn.execute("UPDATE SCHEDULE SET NextCheck=?, Failures=?, LastChange=? WHERE TGID=?",
+                         (next_check, failures, last_change, str(tgid)))
+    
+    def get_feed_token(self, tgid, reset=False):
+        """
+        获取用户托管日历链接中的私密令牌，不存在或要求重置时生成新令牌
+        :param tgid: Telegram ChatID
+        :param reset: 是否重置令牌，重置后旧链接失效
+        :return: 令牌
+        """
+        with self.transaction() as conn:
+            res = conn.execute("SELECT Token FROM FEEDS WHERE TGID=?", (str(tgid),)).fetchone()
+            if res is not None and not reset:
+                return res[0]
+            token = secrets.token_urlsafe(24)
+            conn.execute("REPLACE INTO FEEDS(TGID,Token) VALUES (?,?)", (str(tgid), token))
+            return token
+    
+    def get_feed_user(self, token):
+        """
+        根据托管日历令牌查找用户
+        :param token: 令牌
+        :return: Telegram ChatID，令牌无效返回None
+        """
+        res = self.__connection().execute("SELECT TGID FROM FEEDS WHERE Token=?", (token,)).fetchone()
+        if res is not None:
+            return res[0]
+        return None
+    
+    def enqueue_messages(self, chat_id, texts, now):
+        """
+        将消息加入发件箱
+        :param chat_id: Telegram ChatID
+        :param texts: 消息文本list，按顺序发送
+        :param now: 当前时间戳
+        :return: 无
+        """
+        with self.transaction() as conn:
+            conn.executemany("INSERT INTO OUTBOX(ChatID,Text,Created,NextAttempt,Attempts) VALUES (?,?,?,?,0)",
+                             [(str(chat_id), text, now, now) for text in texts])
+    
+    def get_pending_messages(self, now, limit):
+        """
+        获取到期可以发送的消息，同一会话中较早的消息还在等待重试时，之后的消息也不返回
+        :param now: 当前时间戳
+        :param limit: 最多返回的消息数
+        :return: [(消息ID, Telegram ChatID, 消息文本, 入队时间, 已尝试次数)]
+        """
+        return self.__connection().execute("SELECT ID, ChatID, Text, Created, Attempts FROM OUTBOX AS m "
+                                           "WHERE NextAttempt<=? AND NOT EXISTS (SELECT 1 FROM OUTBOX AS o "
+                                           "WHERE o.ChatID=m.ChatID AND o.ID<m.ID AND o.NextAttempt>?) "
+                                           "ORDER BY ID LIMIT ?", (now, now, limit)).fetchall()
+    
+    def next_message_delay(self, now):
+        """
+        获取距离发件箱中最早一条消息可以发送的时间
+        :param now: 当前时间戳
+        :return: 等待时间，单位秒，发件箱为空时为inf
+        """
+        res = self.__connection().execute("SELECT MIN(NextAttempt) FROM OUTBOX").fetchone()
+        if res[0] is None:
+            return float('inf')
+        return max(0.0, res[0] - now)
+    
+    def postpone_message(self, message_id, next_attempt, attempts):
+        """
+        推迟发送失败的消息
+        :param message_id: 消息ID
+        :param next_attempt: 下次尝试时间戳
+        :param attempts: 已尝试次数
+        :return: 无
+        """
+        with self.transaction() as conn:
+            conn.execute("UPDATE OUTBOX SET NextAttempt=?, Attempts=? WHERE ID=?", (next_attempt, attempts, message_id))
+    
+    def move_messages(self, chat_id, new_chat_id):
+        """
+        会话迁移后将发件箱中的消息转到新的ChatID
+        :param chat_id: 原Telegram ChatID
+        :param new_chat_id: 新Telegram ChatID
+        :return: 无
+        """
+        with self.transaction() as conn:
+            conn.execute("UPDATE OUTBOX SET ChatID=? WHERE ChatID=?", (str(new_chat_id), str(chat_id)))
+    
+    def delete_message(self, message_id):
+        """
+        从发件箱删除消息
+        :param message_id: 消息ID
+        :return: 无
+        """
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM OUTBOX WHERE ID=?", (message_id,))
+    
+    def count_pending_messages(self):
+        """
+        获取发件箱中的消息数
+        :return: 消息数
+        """
+        return self.__connection().execute("SELECT COUNT(*) FROM OUTBOX").fetchone()[0]
+    
+    def iter_users(self, page_size=500):
+        """
+        分页遍历所有用户的Telegram ChatID，每次只读取一页
+        :param page_size: 每页数量
+        :return: Telegram ChatID迭代器
+        """
+        last = ''
+        while True:
+            rows = self.__connection().execute("SELECT TGID FROM BIT WHERE TGID>? ORDER BY TGID LIMIT ?",
+                                               (last, page_size)).fetchall()
+            for row in rows:
+                yield row[0]
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
     
     def get_all_users(self):
         """
         获取所有用户的Telegram ChatID
         :return: 所有用户的Telegram ChatID列表
         """
-        self.__cursor.execute("SELECT TGID FROM BIT")
-        res = self.__cursor.fetchone()
-        if res is not None:
-            return res
-        return None
+        return list(self.iter_users())
+    
+    def close(self):
+        """
+        关闭所有线程的数据库连接
+        :return: 无
+        """
+        with self.__connections_lock:
+            for conn in self.__connections:
+                conn.close()
+            self.__connections.clear()
     
     def __del__(self):
-        self.__conn.commit()
-        self.__conn.close()
+        self.close()
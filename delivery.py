@@ -0,0 +1,294 @@
+import collections
+import logging
+import threading
+import time
+
+from telegram.error import BadRequest, ChatMigrated, RetryAfter, TelegramError, Unauthorized
+
+import metrics
+import tracing
+
+MESSAGE_LIMIT = 4096
+# 每隔多少秒清理一次已经补满的会话令牌桶
+BUCKET_SWEEP_INTERVAL = 60
+DELIVERY_SECONDS = metrics.histogram('bit_delivery_latency_seconds', "消息从入队到发送成功的延迟",
+                                     buckets=(0.5, 1, 2, 5, 10, 30, 60, 300, 1800))
+DELIVERY_RESULTS = metrics.counter('bit_delivery_results_total', "消息发送结果数", ('result',))
+DELIVERY_QUEUE_DEPTH = metrics.gauge('bit_delivery_queue_depth', "发件箱中待发送的消息数")
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    将长消息按行拆分为不超过limit个字符的若干条，单行超长时才在行中间截断
+    :param text: 消息文本
+    :param limit: 每条消息的最大字符数
+    :return: 消息list
+    """
+    parts = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ''
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ''
+        current += line
+    if current.strip():
+        parts.append(current)
+    return parts
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class TokenBucket:
+    """
+    令牌桶，按rate个每秒补充，最多积累capacity个
+    """
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = float(capacity)
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+    
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+    
+    def wait_time(self):
+        """
+        获取一个令牌还需要等待的时间
+        :return: 等待时间，单位秒，可以立即获取时为0
+        """
+        with self.__lock:
+            self.__refill()
+            return 0 if self.__tokens >= 1 else (1 - self.__tokens) / self.rate
+    
+    def acquire(self):
+        """
+        取走一个令牌，调用前应确认wait_time为0
+        :return: 无
+        """
+        with self.__lock:
+            self.__refill()
+            self.__tokens -= 1
+    
+    def full(self):
+        """
+        判断令牌桶是否已补满，补满的桶与新建的桶等价
+        :return: 是否已满
+        """
+        with self.__lock:
+            self.__refill()
+            return self.__tokens >= self.capacity
+
+
+class DeliveryQueue:
+    """
+    Telegram消息发送队列，消息先写入数据库中的发件箱，由后台线程按全局和每个会话的速率限制发送
+    交互命令的回复使用reply立即发送，不在发件箱中排在批量推送之后
+    - 遇到RetryAfter时暂停所有发送直到限制解除
+    - 网络错误按指数退避重试，超过max_attempts次后放弃
+    - 同一会话的消息按入队顺序发送
+    """
+    
+    def __init__(self, storage, global_rate=25, chat_rate=1, chat_burst=3, max_attempts=5, report_interval=300):
+        self.__storage = storage
+        self.__bot = None
+        self.__global = TokenBucket(global_rate, global_rate)
+        self.__chat_rate = chat_rate
+        self.__chat_burst = chat_burst
+        self.__chats = {}
+        self.__last_sweep = time.monotonic()
+        self.__max_attempts = max_attempts
+        self.__report_interval = report_interval
+        self.__paused_until = 0
+        self.__wakeup = threading.Event()
+        self.__stop = threading.Event()
+        self.__latencies = collections.deque(maxlen=1000)
+        self.__counters = {'sent': 0, 'retried': 0, 'dropped': 0}
+        self.__last_report = time.monotonic()
+    
+    @tracing.traced('delivery.enqueue')
+    def send(self, chat_id, text):
+        """
+        将消息加入发件箱，超长消息按行拆分
+        :param chat_id: Telegram ChatID
+        :param text: 消息文本，使用机器人默认的解析模式
+        :return: 拆分后的消息条数
+        """
+        parts = split_message(text)
+        self.__storage.enqueue_messages(chat_id, parts, time.time())
+        self.__wakeup.set()
+        return len(parts)
+    
+    def reply(self, chat_id, text, max_wait=30):
+        """
+        立即发送交互命令的回复，超长消息按行拆分，与发件箱共享全局速率限制
+        遇到RetryAfter时暂停发件箱并等待后重试，需要等待超过max_wait秒时剩余部分改为加入发件箱
+        :param chat_id: Telegram ChatID
+        :param text: 消息文本，使用机器人默认的解析模式
+        :param max_wait: 最多等待的秒数
+        :return: 拆分后的消息条数
+        """
+        parts = split_message(text)
+        for i, part in enumerate(parts):
+            while True:
+                wait = self.__global.wait_time()
+                if wait > 0:
+                    time.sleep(wait)
+                    continue
+                self.__global.acquire()
+                try:
+                    self.__bot.send_message(chat_id=chat_id, text=part)
+                    break
+                except RetryAfter as e:
+                    self.__paused_until = max(self.__paused_until, time.monotonic() + e.retry_after)
+                    DELIVERY_RESULTS.inc('rate_limited')
+                    if e.retry_after > max_wait:
+                        logging.warning(f"回复{chat_id}触发频率限制，剩余{len(parts) - i}条加入发件箱")
+                        self.__storage.enqueue_messages(chat_id, parts[i:], time.time())
+                        self.__wakeup.set()
+                        return len(parts)
+                    logging.warning(f"回复{chat_id}触发频率限制，{e.retry_after}秒后重试")
+                    time.sleep(e.retry_after)
+            DELIVERY_RESULTS.inc('sent')
+        return len(parts)
+    
+    def __chat_bucket(self, chat_id):
+        # 定期丢弃已补满的桶，需要时重新创建，避免为发过消息的每个会话永久保留一个桶
+        if time.monotonic() - self.__last_sweep >= BUCKET_SWEEP_INTERVAL:
+            self.__last_sweep = time.monotonic()
+            self.__chats = {k: v for k, v in self.__chats.items() if not v.full()}
+        bucket = self.__chats.get(chat_id)
+        if bucket is None:
+            bucket = self.__chats[chat_id] = TokenBucket(self.__chat_rate, self.__chat_burst)
+        return bucket
+    
+    def __deliver(self, message_id, chat_id, text, created, attempts):
+        """
+        发送一条消息并根据结果更新发件箱
+        :return: 是否需要暂停该会话后续消息的发送
+        """
+        try:
+            self.__bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            self.__paused_until = time.monotonic() + e.retry_after
+            self.__storage.postpone_message(message_id, time.time() + e.retry_after, attempts)
+            self.__counters['retried'] += 1
+            DELIVERY_RESULTS.inc('rate_limited')
+            logging.warning(f"发送消息触发频率限制，暂停{e.retry_after}秒")
+            return True
+        except ChatMigrated as e:
+            self.__storage.move_messages(chat_id, e.new_chat_id)
+            return True
+        except (Unauthorized, BadRequest) as e:
+            self.__storage.delete_message(message_id)
+            self.__counters['dropped'] += 1
+            DELIVERY_RESULTS.inc('dropped')
+            logging.error(f"向{chat_id}发送消息失败，已放弃：{repr(e)}")
+            return False
+        except TelegramError as e:
+            attempts += 1
+            if attempts >= self.__max_attempts:
+                self.__storage.delete_message(message_id)
+                self.__counters['dropped'] += 1
+                DELIVERY_RESULTS.inc('dropped')
+                logging.error(f"向{chat_id}发送消息失败{attempts}次，已放弃：{repr(e)}")
+                return False
+            self.__storage.postpone_message(message_id, time.time() + 2 ** attempts, attempts)
+            self.__counters['retried'] += 1
+            DELIVERY_RESULTS.inc('retried')
+            logging.warning(f"向{chat_id}发送消息失败，{2 ** attempts}秒后重试：{repr(e)}")
+            return True
+        self.__storage.delete_message(message_id)
+        self.__counters['sent'] += 1
+        DELIVERY_RESULTS.inc('sent')
+        self.__latencies.append(time.time() - created)
+        DELIVERY_SECONDS.observe(value=time.time() - created)
+        return False
+    
+    def __run_once(self):
+        """
+        发送一批到期的消息
+        :return: 到下次需要检查的等待时间，单位秒
+        """
+        pause = self.__paused_until - time.monotonic()
+        if pause > 0:
+            return pause
+        blocked = set()
+        wait = 5.0
+        for message_id, chat_id, text, created, attempts in self.__storage.get_pending_messages(time.time(), 100):
+            if chat_id in blocked:
+                continue
+            chat_wait = self.__chat_bucket(chat_id).wait_time()
+            if chat_wait > 0:
+                blocked.add(chat_id)
+                wait = min(wait, chat_wait)
+                continue
+            global_wait = self.__global.wait_time()
+            if global_wait > 0:
+                return global_wait
+            self.__global.acquire()
+            self.__chat_bucket(chat_id).acquire()
+            if self.__deliver(message_id, chat_id, text, created, attempts):
+                blocked.add(chat_id)
+                if self.__paused_until > time.monotonic():
+                    return self.__paused_until - time.monotonic()
+        else:
+            return wait if blocked else min(wait, self.__storage.next_message_delay(time.time()))
+    
+    def __loop(self):
+        while not self.__stop.is_set():
+            try:
+                wait = self.__run_once()
+            except Exception as e:
+                logging.error(f"发送队列出错：{repr(e)}")
+                wait = 5.0
+            self.__report()
+            self.__wakeup.wait(max(0.01, wait))
+            self.__wakeup.clear()
+    
+    def stats(self):
+        """
+        获取发送统计
+        :return: { 'queue_depth': 待发送消息数, 'sent', 'retried', 'dropped', 'latency_p50', 'latency_p95': 最近1000条的入队到发送延迟 }
+        """
+        latencies = list(self.__latencies)
+        return {'queue_depth': self.__storage.count_pending_messages(), **self.__counters,
+                'latency_p50': percentile(latencies, 50) if latencies else None,
+                'latency_p95': percentile(latencies, 95) if latencies else None}
+    
+    def __report(self):
+        if time.monotonic() - self.__last_report < self.__report_interval:
+            return
+        self.__last_report = time.monotonic()
+        stats = self.stats()
+        if stats['sent'] == 0 and stats['queue_depth'] == 0:
+            return
+        logging.info(f"发送队列：待发送{stats['queue_depth']}条，已发送{stats['sent']}条，重试{stats['retried']}次，"
+                     f"放弃{stats['dropped']}条，延迟p50 {round(stats['latency_p50'] or 0, 2)}秒，"
+                     f"p95 {round(stats['latency_p95'] or 0, 2)}秒")
+    
+    def start(self, bot):
+        """
+        在后台线程中开始发送
+        :param bot: telegram.Bot
+        :return: 无
+        """
+        self.__bot = bot
+        metrics.REGISTRY.add_collector(lambda: DELIVERY_QUEUE_DEPTH.set(value=self.__storage.count_pending_messages()))
+        threading.Thread(target=self.__loop, name='delivery', daemon=True).start()
+    
+    def stop(self):
+        self.__stop.set()
+        self.__wakeup.set()
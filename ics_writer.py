@@ -0,0 +1,156 @@
+import datetime
+import hashlib
+import json
+
+import pytz
+
+PRODID = '-//emonq//BitEssentials//CN'
+
+
+def escape_text(text):
+    """
+    按RFC 5545转义文本属性值
+    :param text: 原文本
+    :return: 转义后的文本
+    """
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def format_datetime(dt: datetime.datetime):
+    """
+    格式化为UTC时间，如20210906T000000Z
+    :param dt: 带时区的时间
+    :return: 格式化后的字符串
+    """
+    return dt.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def fold(line):
+    """
+    按RFC 5545将超过75字节的行折叠
+    :param line: 内容行
+    :return: 折叠后的内容行，不含结尾换行
+    """
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line
+    parts = []
+    limit = 75
+    while len(data) > limit:
+        cut = limit
+        while cut > 0 and (data[cut] & 0xC0) == 0x80:  # 不在UTF-8多字节字符中间折叠
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+        limit = 74
+    parts.append(data.decode('utf-8'))
+    return '\r\n '.join(parts)
+
+
+def event_uid(event):
+    """
+    根据事件内容生成稳定的UID，内容不变时多次导出的UID相同
+    :param event: 事件字典
+    :return: UID
+    """
+    key = f"{event['name']}|{event['location']}|{event['begin'].isoformat()}|{event['end'].isoformat()}"
+    return f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}@bitessentials"
+
+
+def content_hash(events):
+    """
+    计算事件内容的摘要，只包含会写入日历的字段，与生成时间无关
+    :param events: 事件字典list
+    :return: 十六进制摘要
+    """
+    rows = sorted((i['name'], i['location'], i['begin'].isoformat(), i['end'].isoformat(), i.get('description') or '')
+                  for i in events)
+    return hashlib.sha1(json.dumps(rows, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def iter_event_lines(event, dtstamp):
+    """
+    逐行生成一个VEVENT
+    :param event: 事件字典，格式{ 'name', 'location', 'begin', 'end', 'description'（可选）, 'rrule'（可选）, 'exdates'（可选） }
+    :param dtstamp: 格式化后的生成时间
+    :return: 内容行迭代器
+    """
+    yield 'BEGIN:VEVENT'
+    yield f"UID:{event_uid(event)}"
+    yield f"DTSTAMP:{dtstamp}"
+    yield f"DTSTART:{format_datetime(event['begin'])}"
+    yield f"DTEND:{format_datetime(event['end'])}"
+    if event.get('rrule'):
+        yield f"RRULE:{event['rrule']}"
+    if event.get('exdates'):
+        yield f"EXDATE:{','.join(format_datetime(i) for i in event['exdates'])}"
+    yield f"SUMMARY:{escape_text(event['name'])}"
+    if event.get('location'):
+        yield f"LOCATION:{escape_text(event['location'])}"
+    if event.get('description'):
+        yield f"DESCRIPTION:{escape_text(event['description'])}"
+    yield 'END:VEVENT'
+
+
+def iter_calendar(events):
+    """
+    流式生成ics日历，不构建ics.Calendar对象
+    :param events: 事件字典的可迭代对象
+    :return: 以CRLF结尾的折叠后内容行迭代器
+    """
+    dtstamp = format_datetime(datetime.datetime.now(pytz.utc))
+    yield 'BEGIN:VCALENDAR\r\n'
+    yield 'VERSION:2.0\r\n'
+    yield f"PRODID:{PRODID}\r\n"
+    for event in events:
+        for line in iter_event_lines(event, dtstamp):
+            yield fold(line) + '\r\n'
+    yield 'END:VCALENDAR\r\n'
+
+
+def write_calendar(events, fp):
+    """
+    将日历写入文本文件对象
+    :param events: 事件字典的可迭代对象
+    :param fp: 文本文件对象
+    :return: 无
+    """
+    for line in iter_calendar(events):
+        fp.write(line)
+
+
+def render_calendar(events):
+    """
+    生成完整的ics文本
+    :param events: 事件字典的可迭代对象
+    :return: ics文本
+    """
+    return ''.join(iter_calendar(events))
+
+
+def compress_weekly(events):
+    """
+    将每周同一时间、同一地点的同名课程合并为带RRULE的重复事件，中间缺少的周用EXDATE排除
+    :param events: 课程信息list，格式为[{ 'name': 课程名, 'location': 上课地点, 'begin': 开始时间, 'end': 结束时间 }]
+    :return: 合并后的事件list，按首次上课时间排序
+    """
+    groups = {}
+    for i in events:
+        key = (i['name'], i['location'], i.get('description'), i['begin'].weekday(), i['begin'].timetz(),
+               i['end'] - i['begin'])
+        groups.setdefault(key, []).append(i)
+    res = []
+    for occurrences in groups.values():
+        occurrences.sort(key=lambda x: x['begin'])
+        first = occurrences[0]
+        begins = {i['begin'] for i in occurrences}
+        count = (occurrences[-1]['begin'] - first['begin']).days // 7 + 1
+        event = dict(first)
+        if count > 1:
+            event['rrule'] = f"FREQ=WEEKLY;COUNT={count}"
+            event['exdates'] = [first['begin'] + datetime.timedelta(weeks=n) for n in range(count)
+                                if first['begin'] + datetime.timedelta(weeks=n) not in begins]
+        res.append(event)
+    res.sort(key=lambda x: (x['begin'], x['name']))
+    return res
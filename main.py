@@ -1,29 +1,95 @@
 import datetime
+import functools
 import json
 import logging
-import pickle
 import re
+import sys
+import threading
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import pytz
 import uuid
 
 from telegram import ParseMode
+from telegram import TelegramError
 from telegram import Update
 from telegram.ext import CallbackContext
 from telegram.ext import CommandHandler
 from telegram.ext import Defaults
 from telegram.ext import Updater
 
-from bit import Bit, BitInfoError
+import analytics
+import ics_writer
+import resilience
+import tracing
+from bit import Bit, BitInfoError, UpstreamUnavailable, build_ics, render_classes_ics, set_base_url, \
+    set_host_concurrency, set_login_probe, set_max_retries, set_pool_size, set_state_key, set_term_cache_ttl, set_timeouts
+from cache import RenderCache
+from calendar_server import CalendarFeeds, CalendarServer
 from data_storage import SqliteStorage
+from delivery import DeliveryQueue
+from metrics import MetricsServer, track_command
+from scheduler import RefreshScheduler
 
 configs = json.load(open("config.json", 'r'))
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=configs['logging_level'])
 db = SqliteStorage(configs['Sqlite_filename'])
+set_host_concurrency(configs.get('upstream_host_concurrency', 4))
+set_pool_size(configs.get('upstream_pool_hosts', 16), configs.get('upstream_pool_size', 32))
+set_login_probe(configs.get('login_probe', False))
+if not configs.get('state_secret'):
+    logging.critical("请在config.json中设置state_secret")
+    sys.exit(1)
+# 未设置state_secret的旧版本使用bot_token加密，保留为解密用的旧密钥
+set_state_key(configs['state_secret'], *configs.get('previous_state_secrets', []), configs['bot_token'])
+set_term_cache_ttl(configs.get('term_cache_ttl', 3600))
+set_timeouts(configs.get('upstream_timeouts', {}))
+analytics.set_gpa_scales(configs.get('gpa_scales', {}))
+set_max_retries(configs.get('upstream_max_retries', 2))
+resilience.configure(configs.get('circuit_failure_threshold', 5), configs.get('circuit_recovery_timeout', 30))
+tracing.configure(configs.get('trace_sample_rate', 0), configs.get('trace_directory', 'traces'),
+                  configs.get('trace_min_duration', 0), configs.get('trace_format', 'chrome'))
+if configs.get('upstream_base_url'):
+    set_base_url(configs['upstream_base_url'])
 with open("TOS.txt", 'r', encoding='UTF-8') as f:
     TOS = f.read()
+feeds = CalendarFeeds(db, configs.get('calendar_refresh_interval', 3600), configs.get('class_week_window', 20),
+                      configs.get('compress_ics', False))
+# 正在处理的命令，键为(ChatID, 命令处理函数名, 参数)
+running_commands = set()
+running_commands_lock = threading.Lock()
+render_cache = RenderCache(configs.get('render_cache_max_bytes', 32 * 1024 * 1024),
+                           ttl=configs.get('render_cache_ttl', 1800))
+delivery = DeliveryQueue(db, configs.get('delivery_global_rate', 25), configs.get('delivery_chat_rate', 1),
+                         configs.get('delivery_chat_burst', 3), configs.get('delivery_max_attempts', 5))
+
+
+def user_command(handler):
+    """
+    命令处理函数装饰器：同一会话中相同的命令正在处理时，重复的命令不再执行，等待正在处理的命令回复；
+    处理期间持有该用户的锁，同一用户的读取、修改并保存会话对象的操作依次执行
+    """
+    
+    @functools.wraps(handler)
+    def wrapper(update: Update, context: CallbackContext):
+        chat_id = update.effective_chat.id
+        key = (chat_id, handler.__name__, tuple(context.args or ()))
+        with running_commands_lock:
+            if key in running_commands:
+                context.bot.send_message(chat_id=chat_id, text="相同的请求正在处理中，完成后会回复你")
+                return
+            running_commands.add(key)
+        try:
+            with db.user_lock(chat_id):
+                return handler(update, context)
+        finally:
+            with running_commands_lock:
+                running_commands.discard(key)
+    
+    return wrapper
 
 
 def get_scores_message(scores):
@@ -34,29 +100,127 @@ def get_scores_message(scores):
     return msg
 
 
+def format_number(value):
+    return '-' if value is None else str(round(value, 3))
+
+
+def format_rank(rank):
+    return '-' if rank is None else f"前{round(rank * 100, 1)}%"
+
+
+def get_average_message(title, summary):
+    msg = f"你在{title}共有 {summary['count']} 项考试成绩计入均分，共 {format_number(summary['credits'])} 学分\n"
+    msg += f"加权均分：{format_number(summary['average'])}（含校公选课 {format_number(summary['average_all'])}）\n"
+    msg += f"GPA：{'，'.join(f'{name} {format_number(value)}' for name, value in summary['gpa'].items())}\n"
+    msg += f"学分：{'，'.join(f'{name} {format_number(value)}' for name, value in summary['credits_by_type'].items())}\n"
+    msg += f"加权排名：班级{format_rank(summary['class_rank'])}，专业{format_rank(summary['majority_rank'])}"
+    return msg
+
+
 def get_score_update_of_user(tgid, refresh_all=False):
-    obj = db.get_obj(tgid)
-    if obj is None:
-        return "你还没有绑定学号，使用 /link 绑定后才能使用本功能"
-    bit = pickle.loads(obj)
-    updates = bit.get_scores_update(refresh_all)
-    logging.info(f"开始为{bit.username}更新成绩")
-    if len(updates) == 0:
-        return "没有新的成绩更新"
-    else:
-        db.save_obj(bit.username, bit.serialize(), tgid)
-        msg = "天啊天啊有新的成绩！！！\n"
-        msg += get_scores_message(updates)
-        return msg
+    """
+    检查用户的成绩更新，读取、更新和保存都在用户锁内完成，保存在释放锁前提交
+    :param tgid: Telegram ChatID
+    :param refresh_all: 是否重新获取所有成绩的详细信息
+    :return: 回复消息
+    """
+    with db.user_lock(tgid):
+        obj = db.get_obj(tgid)
+        if obj is None:
+            return "你还没有绑定学号，使用 /link 绑定后才能使用本功能"
+        bit = Bit.deserialize(obj)
+        fingerprint = bit.scoresFingerprint
+        updates = bit.get_scores_update(refresh_all)
+        logging.info(f"开始为{bit.username}更新成绩")
+        if bit.scoresUnchanged:
+            return "成绩列表没有变化"
+        if len(updates) == 0:
+            if bit.scoresFingerprint != fingerprint:
+                db.save_obj(bit.username, bit.serialize(), tgid)
+            return "没有新的成绩更新"
+        else:
+            with db.transaction():
+                db.save_obj(bit.username, bit.serialize(), tgid)
+                db.save_scores(tgid, updates)
+            msg = "天啊天啊有新的成绩！！！\n"
+            msg += get_scores_message(updates)
+            return msg
+
+
+@tracing.traced('telegram.send_document')
+def send_cached_document(context: CallbackContext, chat_id, entry, filename):
+    """
+    发送缓存的文档，已上传过的直接重发file_id，否则上传并记录file_id
+    :param context: 上下文
+    :param chat_id: Telegram ChatID
+    :param entry: RenderCache缓存项
+    :param filename: 上传时使用的文件名
+    :return: 无
+    """
+    if entry['file_id'] is not None:
+        try:
+            context.bot.send_document(chat_id=chat_id, document=entry['file_id'])
+            return
+        except TelegramError as e:
+            logging.warning(f"重发文档{filename}失败，重新上传：{repr(e)}")
+            render_cache.set_file_id(entry, None)
+    message = context.bot.send_document(chat_id=chat_id, document=entry['body'], filename=filename)
+    render_cache.set_file_id(entry, message.document.file_id)
+
+
+def refresh_user_scores(context: CallbackContext, tgid):
+    """
+    更新单个用户的成绩并推送，异常只影响该用户
+    :param context: 任务上下文
+    :param tgid: Telegram ChatID
+    :return: 'notified'为推送了新成绩，'unchanged'为成绩列表指纹命中，'checked'为已检查但没有新成绩
+    """
+    msg = get_score_update_of_user(tgid)
+    if msg.startswith("天啊天啊有新的成绩！！！"):
+        delivery.send(tgid, msg)
+        return 'notified'
+    if msg == "成绩列表没有变化":
+        return 'unchanged'
+    return 'checked'
 
 
 def refresh_scores(context: CallbackContext):
-    logging.info("开始更新所有用户成绩")
-    ids = db.get_all_users()
-    for ID in ids:
-        msg = get_score_update_of_user(ID)
-        if msg.startswith("天啊天啊有新的成绩！！！"):
-            context.bot.send_message(chat_id=ID, text=msg)
+    # 重新排队的任务只处理上次因学校服务器熔断推迟的用户
+    deferred_users = context.job.context if context.job is not None else None
+    if deferred_users:
+        logging.info(f"开始更新{len(deferred_users)}个推迟的用户成绩")
+    else:
+        logging.info("开始更新所有用户成绩")
+    start = time.monotonic()
+    processed = failed = notified = unchanged = 0
+    deferred = []
+    retry_after = 0
+    # 每个用户的成绩在其用户锁内提交后才推送，不使用批量写入器，否则锁释放后可能读到未提交的旧数据
+    with ThreadPoolExecutor(max_workers=configs.get('refresh_workers', 8)) as executor:
+        futures = {executor.submit(refresh_user_scores, context, ID): ID
+                   for ID in (deferred_users or db.iter_users())}
+        for future, ID in futures.items():
+            processed += 1
+            try:
+                result = future.result()
+                if result == 'notified':
+                    notified += 1
+                elif result == 'unchanged':
+                    unchanged += 1
+            except UpstreamUnavailable as e:
+                deferred.append(ID)
+                retry_after = max(retry_after, e.retry_after)
+            except Exception as e:
+                failed += 1
+                logging.error(f"为{ID}更新成绩失败：{repr(e)}")
+                logging.debug(traceback.format_exc())
+    checked = processed - failed - len(deferred)
+    logging.info(f"成绩更新完成，共处理{processed}个用户，失败{failed}个，推送{notified}个，"
+                 f"成绩列表未变化跳过{unchanged}个（命中率{round(unchanged / checked * 100, 1) if checked else 0}%），"
+                 f"耗时{round(time.monotonic() - start, 3)}秒")
+    if len(deferred) > 0:
+        logging.warning(f"学校服务器熔断，{len(deferred)}个用户推迟到{round(retry_after)}秒后更新")
+        context.job_queue.run_once(refresh_scores, retry_after + 5, context=deferred)
 
 
 def start_handler(update: Update, context: CallbackContext):
@@ -68,6 +232,7 @@ def tos_handler(update: Update, context: CallbackContext):
     context.bot.send_message(chat_id=update.effective_chat.id, text=TOS)
 
 
+@user_command
 def refresh_handler(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     try:
@@ -75,8 +240,7 @@ def refresh_handler(update: Update, context: CallbackContext):
         if len(context.args) > 0:
             refresh_all = True
         msg = get_score_update_of_user(chat_id, refresh_all)
-        for x in range(0, len(msg), 4096):
-            context.bot.send_message(chat_id=chat_id, text=msg[x:x + 4096])
+        delivery.reply(chat_id, msg)
     except BitInfoError as e:
         context.bot.send_message(chat_id=chat_id, text=str(e))
         logging.error(f"from {chat_id}:{e}")
@@ -87,10 +251,10 @@ def refresh_handler(update: Update, context: CallbackContext):
         context.bot.send_message(chat_id=chat_id, text=f"出现了未知错误，错误id {errid}")
 
 
+@user_command
 def link_handler(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
-    obj = db.get_obj(chat_id)
-    if obj is not None:
+    if db.get_username(chat_id) is not None:
         context.bot.send_message(
             chat_id=chat_id, text="你已经绑定成功，如需重新绑定请 /unlink 解绑之后重新绑定")
         return
@@ -115,43 +279,42 @@ def link_handler(update: Update, context: CallbackContext):
             chat_id=chat_id, text=f"绑定失败，出现了未知错误，错误id {errid}")
 
 
+@user_command
 def unlink_handler(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
-    obj = db.get_obj(chat_id)
-    if obj is None:
+    if db.get_username(chat_id) is None:
         context.bot.send_message(
             chat_id=chat_id, text="你还没有绑定学号，使用 /link 绑定后才能使用本功能")
         return
     else:
+        render_cache.invalidate(db.get_username(chat_id))
         db.delete_user(chat_id)
+        feeds.invalidate(chat_id)
         context.bot.send_message(chat_id=chat_id, text="解绑成功")
 
 
 def info_handler(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     msg = f"你的chat id是：{chat_id}\n当前绑定状态："
-    obj = db.get_obj(chat_id)
-    if obj is None:
+    username = db.get_username(chat_id)
+    if username is None:
         msg += "未绑定"
     else:
-        bit = pickle.loads(obj)
-        msg += f"已绑定 {bit.username}"
+        msg += f"已绑定 {username}"
     context.bot.send_message(chat_id=chat_id, text=msg)
 
 
 def getscores_handler(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
-    obj = db.get_obj(chat_id)
-    if obj is None:
+    if db.get_username(chat_id) is None:
         context.bot.send_message(
             chat_id=chat_id, text="你还没有绑定学号，使用 /link 绑定后才能使用本功能")
         return
     else:
         context.bot.send_message(chat_id=chat_id, text="请稍候，正在为你查询……")
         try:
-            bit = pickle.loads(obj)
             if len(context.args) == 0:
-                scores = bit.scores
+                scores = db.get_scores(chat_id)
             else:
                 if len(context.args) > 1 or context.args[0] == 'help':
                     context.bot.send_message(
@@ -164,12 +327,10 @@ def getscores_handler(update: Update, context: CallbackContext):
                         context.bot.send_message(
                             chat_id=chat_id, text="学期格式有误")
                         return
-                    scores = {
-                        i: bit.scores[i] for i in bit.scores if bit.scores[i]['term'] == term}
+                    scores = db.get_scores(chat_id, term)
             msg = f"为你查询到{len(scores)}条结果：\n"
             msg += get_scores_message(scores)
-            for x in range(0, len(msg), 4096):
-                context.bot.send_message(chat_id=chat_id, text=msg[x:x + 4096])
+            delivery.reply(chat_id, msg)
         except BitInfoError as e:
             context.bot.send_message(chat_id=chat_id, text=str(e))
             logging.error(f"from {chat_id}:{e}")
@@ -182,6 +343,7 @@ def getscores_handler(update: Update, context: CallbackContext):
                 chat_id=chat_id, text=f"出现了未知错误，错误id {errid}")
 
 
+@user_command
 def getclasses_handler(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     obj = db.get_obj(chat_id)
@@ -191,7 +353,7 @@ def getclasses_handler(update: Update, context: CallbackContext):
         return
     else:
         try:
-            bit = pickle.loads(obj)
+            bit = Bit.deserialize(obj)
             if len(context.args) == 0:
                 term = bit.get_current_term()
             else:
@@ -206,12 +368,26 @@ def getclasses_handler(update: Update, context: CallbackContext):
                     context.bot.send_message(chat_id=chat_id, text="学期格式有误")
                     return
             context.bot.send_message(chat_id=chat_id, text="请稍候，正在为你查询……")
-            res = bit.get_term_classes_ics(term)
-            db.save_obj(bit.username, bit.serialize(), chat_id)
-            context.bot.send_message(
-                chat_id=chat_id, text=f"这是为你查询到的学期 {term} 课表")
-            context.bot.send_document(chat_id=chat_id, document=str(res).encode('UTF-8'),
-                                      filename=f"{bit.username}-{term}.ics")
+            entry = render_cache.lookup(bit.username, term, 'classes')
+            missing_weeks = []
+            if entry is None:
+                classes = bit.get_term_classes(term, configs.get('class_week_window', 20), True)
+                db.save_obj(bit.username, bit.serialize(), chat_id)
+                missing_weeks = bit.missingWeeks
+                digest = ics_writer.content_hash(classes)
+                entry = render_cache.get(bit.username, term, 'classes', digest)
+                if entry is None:
+                    body = str(render_classes_ics(classes, configs.get('compress_ics', False))).encode('UTF-8')
+                    if len(missing_weeks) > 0:
+                        # 不完整的课表不缓存
+                        entry = {'body': body, 'file_id': None}
+                    else:
+                        entry = render_cache.put(bit.username, term, 'classes', digest, body)
+            msg = f"这是为你查询到的学期 {term} 课表"
+            if len(missing_weeks) > 0:
+                msg += f"，第 {'、'.join(map(str, missing_weeks))} 周课表获取失败，请稍后重试"
+            context.bot.send_message(chat_id=chat_id, text=msg)
+            send_cached_document(context, chat_id, entry, f"{bit.username}-{term}.ics")
         except BitInfoError as e:
             context.bot.send_message(chat_id=chat_id, text=str(e))
             logging.error(f"from {chat_id}:{e}")
@@ -224,6 +400,7 @@ def getclasses_handler(update: Update, context: CallbackContext):
                 chat_id=chat_id, text=f"出现了未知错误，错误id {errid}")
 
 
+@user_command
 def getexams_handler(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     obj = db.get_obj(chat_id)
@@ -233,7 +410,7 @@ def getexams_handler(update: Update, context: CallbackContext):
         return
     else:
         try:
-            bit = pickle.loads(obj)
+            bit = Bit.deserialize(obj)
             if len(context.args) == 0:
                 term = bit.get_current_term()
             else:
@@ -248,19 +425,24 @@ def getexams_handler(update: Update, context: CallbackContext):
                     context.bot.send_message(chat_id=chat_id, text="学期格式有误")
                     return
             context.bot.send_message(chat_id=chat_id, text="请稍候，正在为你查询……")
-            res = bit.get_exams(term)
-            if len(res) == 0:
-                context.bot.send_message(
-                    chat_id=chat_id, text=f"你在学期 {term} 暂无考试安排")
-                return
-            msg = f"这是为你查询到的学期 {term} 考试安排，共 {len(res)} 项\n"
-            for i in res:
-                msg += f"\n<b>{i['name']}</b>\n地点：{i['location']}\n时间：{i['begin'].strftime('%Y-%m-%d %H:%M')} - {i['end'].strftime('%Y-%m-%d %H:%M')}\n备注：{i['description'] if 'description' in i.keys() else '无'}\n"
-            res_ics = bit.get_exams_ics(term)
-            db.save_obj(bit.username, bit.serialize(), chat_id)
-            context.bot.send_message(chat_id=chat_id, text=msg)
-            context.bot.send_document(chat_id=chat_id, document=str(res_ics).encode('UTF-8'),
-                                      filename=f"{bit.username}-{term}-exams.ics")
+            entry = render_cache.lookup(bit.username, term, 'exams')
+            if entry is None:
+                res = bit.get_exams(term)
+                db.save_obj(bit.username, bit.serialize(), chat_id)
+                if len(res) == 0:
+                    context.bot.send_message(
+                        chat_id=chat_id, text=f"你在学期 {term} 暂无考试安排")
+                    return
+                digest = ics_writer.content_hash(res)
+                entry = render_cache.get(bit.username, term, 'exams', digest)
+                if entry is None:
+                    msg = f"这是为你查询到的学期 {term} 考试安排，共 {len(res)} 项\n"
+                    for i in res:
+                        msg += f"\n<b>{i['name']}</b>\n地点：{i['location']}\n时间：{i['begin'].strftime('%Y-%m-%d %H:%M')} - {i['end'].strftime('%Y-%m-%d %H:%M')}\n备注：{i['description'] if 'description' in i.keys() else '无'}\n"
+                    entry = render_cache.put(bit.username, term, 'exams', digest,
+                                             str(build_ics(res)).encode('UTF-8'), msg)
+            context.bot.send_message(chat_id=chat_id, text=entry['extra'])
+            send_cached_document(context, chat_id, entry, f"{bit.username}-{term}-exams.ics")
         except BitInfoError as e:
             context.bot.send_message(chat_id=chat_id, text=str(e))
             logging.error(f"from {chat_id}:{e}")
@@ -273,15 +455,14 @@ def getexams_handler(update: Update, context: CallbackContext):
                 chat_id=chat_id, text=f"出现了未知错误，错误id {errid}")
 
 
+@user_command
 def getaverage_handler(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
-    obj = db.get_obj(chat_id)
-    if obj is None:
+    if db.get_username(chat_id) is None:
         context.bot.send_message(
             chat_id=chat_id, text="你还没有绑定学号，使用 /link 绑定后才能使用本功能")
         return
     else:
-        context.bot.send_message(chat_id=chat_id, text="请稍候，正在为你查询……")
         try:
             if len(context.args) > 1 or (
                     len(context.args) == 1 and (context.args[0] == 'help' or not re.match(r'\d\d\d\d-\d\d\d\d-\d',
@@ -289,33 +470,26 @@ def getaverage_handler(update: Update, context: CallbackContext):
                 context.bot.send_message(
                     chat_id=chat_id, text="使用格式 /getaverage [学期，如 2019-2020-1] 默认查询所有成绩的加权均分")
                 return
-            bit = pickle.loads(obj)
-            msg = get_score_update_of_user(chat_id)
-            if msg.startswith("天啊天啊有新的成绩！！！"):
-                context.bot.send_message(chat_id=chat_id, text=msg)
             if len(context.args) == 0:
-                term = bit.get_current_term()
+                term = None
             else:
                 term = context.args[0]
                 years = re.findall(r'\d\d\d\d', term)
                 if int(years[1]) - int(years[0]) != 1:
                     context.bot.send_message(chat_id=chat_id, text="学期格式有误")
                     return
-            scores = {i: bit.scores[i] for i in bit.scores if
-                      bit.scores[i]['term'] == term and bit.scores[i]['type'] != '校公选课'}
-            total = 0
-            total_credit = 0
-            for i in scores:
-                total += scores[i]['score'] * scores[i]['credit']
-                total_credit += scores[i]['credit']
-            if len(scores) == 0:
-                msg = f"你在学期 {term} 还没有考试成绩"
+            groups = db.get_aggregates(chat_id, term)
+            if len(groups) == 0:
+                msg = f"你在学期 {term} 还没有考试成绩" if term is not None else "你还没有考试成绩，使用 /refresh 获取成绩"
             else:
-                msg = f"你在学期 {term} 共有 {len(scores)} 项考试成绩，均分为 {round(total / total_credit, 3)} 分"
+                msg = get_average_message(f"学期 {term}" if term is not None else "所有学期",
+                                          analytics.summarize(groups))
+                if term is None:
+                    msg += "\n\n<b>各学期</b>"
+                    for i, summary in analytics.term_trend(groups):
+                        msg += f"\n{i}：{format_number(summary['average'])} 分，" \
+                               f"班级 {format_rank(summary['class_rank'])}，专业 {format_rank(summary['majority_rank'])}"
             context.bot.send_message(chat_id=chat_id, text=msg)
-        except BitInfoError as e:
-            context.bot.send_message(chat_id=chat_id, text=str(e))
-            logging.error(f"from {chat_id}:{e}")
         except Exception as e:
             errid = uuid.uuid1()
             logging.error(f"{errid}:{repr(e)}")
@@ -325,24 +499,92 @@ def getaverage_handler(update: Update, context: CallbackContext):
                 chat_id=chat_id, text=f"出现了未知错误，错误id {errid}")
 
 
+def clearcache_handler(update: Update, context: CallbackContext):
+    chat_id = update.effective_chat.id
+    username = db.get_username(chat_id)
+    if username is None:
+        context.bot.send_message(
+            chat_id=chat_id, text="你还没有绑定学号，使用 /link 绑定后才能使用本功能")
+        return
+    count = render_cache.invalidate(username)
+    feeds.invalidate(chat_id)
+    context.bot.send_message(chat_id=chat_id, text=f"已清除 {count} 项缓存，下次查询将重新获取")
+
+
+def calendar_handler(update: Update, context: CallbackContext):
+    chat_id = update.effective_chat.id
+    if not configs.get('calendar_port'):
+        context.bot.send_message(chat_id=chat_id, text="本机器人未开启日历托管")
+        return
+    if db.get_username(chat_id) is None:
+        context.bot.send_message(
+            chat_id=chat_id, text="你还没有绑定学号，使用 /link 绑定后才能使用本功能")
+        return
+    if len(context.args) > 1 or (len(context.args) == 1 and context.args[0] != 'reset'):
+        context.bot.send_message(
+            chat_id=chat_id, text="使用方法：/calendar [ reset ] 获取日历订阅链接，reset 重置链接，旧链接将失效")
+        return
+    reset = len(context.args) == 1
+    token = db.get_feed_token(chat_id, reset)
+    if reset:
+        feeds.invalidate(chat_id)
+    base_url = (configs.get('calendar_base_url') or
+                f"http://{configs.get('calendar_host', '0.0.0.0')}:{configs['calendar_port']}").rstrip('/')
+    msg = "在日历应用中订阅以下链接，课表和考试安排会自动更新，请勿泄露链接\n"
+    msg += f"\n课表：{base_url}/calendar/{token}/classes.ics\n考试安排：{base_url}/calendar/{token}/exams.ics\n"
+    msg += "\n链接泄露后可使用 /calendar reset 重置"
+    context.bot.send_message(chat_id=chat_id, text=msg)
+
+
+def command_handler(command, handler, **kwargs):
+    """
+    创建记录处理耗时指标并按采样率追踪的命令处理器
+    :param command: 命令名
+    :param handler: 命令处理函数
+    :return: CommandHandler
+    """
+    return CommandHandler(command, track_command(command)(tracing.trace_handler(command)(handler)), **kwargs)
+
+
 def run():
     defaults = Defaults(parse_mode=ParseMode.HTML,
                         tzinfo=pytz.timezone('Asia/Shanghai'))
-    updater = Updater(token=configs['bot_token'], use_context=True, defaults=defaults, request_kwargs={
-                      'proxy_url': configs['proxy_url']})
+    updater = Updater(token=configs['bot_token'], use_context=True, defaults=defaults,
+                      workers=configs.get('handler_workers', 8), request_kwargs={
+                          'proxy_url': configs['proxy_url']})
     job_queue = updater.job_queue
-    job_queue.run_daily(refresh_scores, datetime.time(0, 35, 0, 0))
+    delivery.start(updater.bot)
+    if configs.get('adaptive_refresh', True):
+        scheduler = RefreshScheduler(
+            db, refresh_user_scores,
+            workers=configs.get('refresh_workers', 8),
+            rpm=configs.get('refresh_rpm', 120),
+            request_cost=configs.get('refresh_request_cost', 3),
+            base_interval=configs.get('refresh_base_interval', 24 * 60 * 60),
+            release_interval=configs.get('refresh_release_interval', 3 * 60 * 60),
+            active_interval=configs.get('refresh_active_interval', 4 * 60 * 60),
+            release_periods=configs.get('grade_release_periods', []),
+            max_backoff=configs.get('refresh_max_backoff', 7 * 24 * 60 * 60))
+        job_queue.run_repeating(scheduler.tick, interval=60, first=10)
+    else:
+        job_queue.run_daily(refresh_scores, datetime.time(0, 35, 0, 0))
     dispatcher = updater.dispatcher
-    dispatcher.add_handler(CommandHandler('start', start_handler))
-    dispatcher.add_handler(CommandHandler('tos', tos_handler))
-    dispatcher.add_handler(CommandHandler('link', link_handler))
-    dispatcher.add_handler(CommandHandler('refresh', refresh_handler))
-    dispatcher.add_handler(CommandHandler('unlink', unlink_handler))
-    dispatcher.add_handler(CommandHandler('info', info_handler))
-    dispatcher.add_handler(CommandHandler('getscores', getscores_handler))
-    dispatcher.add_handler(CommandHandler('getclasses', getclasses_handler))
-    dispatcher.add_handler(CommandHandler('getexams', getexams_handler))
-    dispatcher.add_handler(CommandHandler('getaverage', getaverage_handler))
+    dispatcher.add_handler(command_handler('start', start_handler))
+    dispatcher.add_handler(command_handler('tos', tos_handler))
+    dispatcher.add_handler(command_handler('link', link_handler, run_async=True))
+    dispatcher.add_handler(command_handler('refresh', refresh_handler, run_async=True))
+    dispatcher.add_handler(command_handler('unlink', unlink_handler, run_async=True))
+    dispatcher.add_handler(command_handler('info', info_handler))
+    dispatcher.add_handler(command_handler('getscores', getscores_handler, run_async=True))
+    dispatcher.add_handler(command_handler('getclasses', getclasses_handler, run_async=True))
+    dispatcher.add_handler(command_handler('getexams', getexams_handler, run_async=True))
+    dispatcher.add_handler(command_handler('getaverage', getaverage_handler, run_async=True))
+    dispatcher.add_handler(command_handler('calendar', calendar_handler, run_async=True))
+    dispatcher.add_handler(command_handler('clearcache', clearcache_handler))
+    if configs.get('calendar_port'):
+        CalendarServer(db, feeds, configs.get('calendar_host', '0.0.0.0'), configs['calendar_port']).start()
+    if configs.get('metrics_port'):
+        MetricsServer(configs.get('metrics_host', '127.0.0.1'), configs['metrics_port']).start()
     updater.start_polling()
     updater.idle()
 
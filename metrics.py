@@ -0,0 +1,290 @@
+import bisect
+import contextlib
+import functools
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    带标签的指标，每组标签值对应一个序列
+    """
+    kind = 'untyped'
+    
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+    
+    def _key(self, values):
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name} 需要标签 {self.labels}")
+        return tuple(str(i) for i in values)
+    
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in sorted(self._values.items())]
+    
+    def render(self):
+        """
+        输出Prometheus文本格式
+        :return: 文本行list
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{format_labels(self.labels, key, extra)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+    
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    
+    def set(self, *labels, value):
+        with self._lock:
+            self._values[self._key(labels)] = value
+    
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+    
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, *labels, value):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            series['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            series['sum'] += value
+    
+    def count(self, *labels):
+        with self._lock:
+            series = self._values.get(self._key(labels))
+            return sum(series['counts']) if series else 0
+    
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, series in sorted(self._values.items()):
+                total = 0
+                for bound, count in zip(self.buckets + (float('inf'),), series['counts']):
+                    total += count
+                    samples.append((f"{self.name}_bucket", key, (('le', format_value(bound)),), total))
+                samples.append((f"{self.name}_sum", key, (), series['sum']))
+                samples.append((f"{self.name}_count", key, (), total))
+        return samples
+
+
+class Registry:
+    """
+    指标集合
+    """
+    
+    def __init__(self):
+        self.__metrics = {}
+        self.__collectors = []
+        self.__lock = threading.Lock()
+    
+    def register(self, metric):
+        """
+        注册指标，同名指标已存在时返回已有的
+        :param metric: 指标
+        :return: 已注册的指标
+        """
+        with self.__lock:
+            return self.__metrics.setdefault(metric.name, metric)
+    
+    def add_collector(self, collector):
+        """
+        添加采集函数，每次输出前调用，用于更新由其他组件维护的指标
+        :param collector: 无参数函数
+        :return: 无
+        """
+        with self.__lock:
+            self.__collectors.append(collector)
+    
+    def render(self):
+        """
+        输出所有指标的Prometheus文本格式
+        :return: 文本
+        """
+        with self.__lock:
+            collectors = list(self.__collectors)
+            metrics = list(self.__metrics.values())
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                logging.error(f"采集指标失败：{repr(e)}")
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labels=()):
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+
+def gauge(name, documentation, labels=()):
+    return REGISTRY.register(Gauge(name, documentation, labels))
+
+
+def histogram(name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+
+UPSTREAM_SECONDS = histogram('bit_upstream_request_seconds', "上游请求耗时", ('endpoint',))
+UPSTREAM_ERRORS = counter('bit_upstream_errors_total', "上游请求错误数", ('endpoint', 'reason'))
+UPSTREAM_IN_FLIGHT = gauge('bit_upstream_in_flight', "进行中的上游请求数", ('endpoint',))
+COMMAND_SECONDS = histogram('bit_command_seconds', "命令处理耗时", ('command',))
+COMMAND_ERRORS = counter('bit_command_errors_total', "命令处理中未捕获的异常数", ('command',))
+COMMAND_IN_FLIGHT = gauge('bit_command_in_flight', "正在处理的命令数", ('command',))
+
+
+@contextlib.contextmanager
+def track_upstream(endpoint):
+    """
+    记录一次上游请求的耗时、进行中数量和异常，用于with语句
+    :param endpoint: 逻辑接口名
+    :return: 上下文管理器
+    """
+    UPSTREAM_IN_FLIGHT.inc(endpoint)
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        UPSTREAM_ERRORS.inc(endpoint, type(e).__name__)
+        raise
+    finally:
+        UPSTREAM_SECONDS.observe(endpoint, value=time.monotonic() - start)
+        UPSTREAM_IN_FLIGHT.dec(endpoint)
+
+
+def record_status(endpoint, status):
+    """
+    记录上游返回的错误状态码，5xx和429计为错误
+    :param endpoint: 逻辑接口名
+    :param status: HTTP状态码
+    :return: 无
+    """
+    if status >= 500 or status == 429:
+        UPSTREAM_ERRORS.inc(endpoint, f"http_{status}")
+
+
+def track_command(command):
+    """
+    命令处理函数装饰器，记录耗时、正在处理的数量和未捕获的异常
+    :param command: 命令名
+    :return: 装饰器
+    """
+    
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            COMMAND_IN_FLIGHT.inc(command)
+            start = time.monotonic()
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                COMMAND_ERRORS.inc(command)
+                raise
+            finally:
+                COMMAND_SECONDS.observe(command, value=time.monotonic() - start)
+                COMMAND_IN_FLIGHT.dec(command)
+        
+        return wrapper
+    
+    return decorator
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    处理 /metrics 请求
+    """
+    
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+    
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """
+    以Prometheus文本格式提供指标
+    """
+    daemon_threads = True
+    
+    def __init__(self, host='127.0.0.1', port=9100, registry=REGISTRY):
+        super().__init__((host, port), MetricsHandler)
+        self.registry = registry
+    
+    def start(self):
+        """
+        在后台线程中启动服务
+        :return: 无
+        """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        logging.info(f"指标服务已启动 {self.server_address[0]}:{self.server_address[1]}")
@@ -0,0 +1,363 @@
+import datetime
+import hashlib
+import json
+import re
+from html.parser import HTMLParser
+
+import pytz
+from bs4 import BeautifulSoup, SoupStrainer
+
+import tracing
+
+try:
+    import lxml  # noqa: F401
+    BACKEND = 'lxml'
+except ImportError:
+    BACKEND = 'html.parser'
+
+TZ = pytz.timezone("Asia/Shanghai")
+# 成绩列表中成绩分析链接里的总成绩
+TOTAL_SCORE = re.compile(r'zcj=(\d+)')
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track',
+             'wbr'}
+
+
+def get_datetime(date: datetime.datetime, time: datetime.datetime):
+    return (date + datetime.timedelta(hours=time.hour, minutes=time.minute)).replace(
+        tzinfo=TZ)
+
+
+def soup(html, parse_only=None):
+    """
+    使用可用的最快后端解析页面
+    :param html: 页面内容
+    :param parse_only: SoupStrainer，只构建匹配的元素
+    :return: BeautifulSoup对象
+    """
+    return BeautifulSoup(html, BACKEND, parse_only=parse_only)
+
+
+@tracing.traced('parse.login_form')
+def parse_login_form(html):
+    """
+    解析统一身份认证登录页
+    :param html: 登录页内容
+    :return: (execution, pwdEncryptSalt)，页面没有登录表单时返回None
+    """
+    page = soup(html, SoupStrainer(id=['execution', 'pwdEncryptSalt']))
+    execution = page.find(id='execution')
+    if execution is None:
+        return None
+    return execution['value'], page.find(id='pwdEncryptSalt')['value']
+
+
+@tracing.traced('parse.course_title')
+def parse_course_title(html):
+    """
+    解析乐学课程页标题
+    :param html: 课程页内容
+    :return: 课程名
+    """
+    return soup(html, SoupStrainer('h1')).find('h1').text
+
+
+class TableExtractor(HTMLParser):
+    """
+    单遍扫描页面中的表格，只收集每行单元格的文本和单元格内第一个链接的onclick，不构建文档树
+    """
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.__cell = None
+    
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self.rows.append([])
+            self.__cell = None
+        elif tag == 'td' and self.rows:
+            self.__cell = {'text': '', 'onclick': None}
+            self.rows[-1].append(self.__cell)
+        elif tag == 'a' and self.__cell is not None and self.__cell['onclick'] is None:
+            self.__cell['onclick'] = dict(attrs).get('onclick')
+    
+    def handle_endtag(self, tag):
+        if tag in ('td', 'tr'):
+            self.__cell = None
+    
+    def handle_data(self, data):
+        if self.__cell is not None:
+            self.__cell['text'] += data
+
+
+@tracing.traced('parse.extract_table_rows')
+def extract_table_rows(html):
+    """
+    单遍扫描页面中的表格行
+    :param html: 页面内容
+    :return: 行list，每行为单元格list，单元格格式{ 'text': 文本, 'onclick': 第一个链接的onclick }
+    """
+    extractor = TableExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.rows
+
+
+@tracing.traced('parse.score_list_fingerprint')
+def score_list_fingerprint(rows):
+    """
+    计算成绩列表指纹，只取每行的课程号、学期和总成绩，不构建成绩项
+    :param rows: extract_table_rows得到的cjcx_list表格行
+    :return: 指纹，格式为'行数:摘要'
+    """
+    digest = hashlib.sha1()
+    for columns in rows[2:]:
+        score = TOTAL_SCORE.search(columns[-1]['onclick']).group(1)
+        digest.update(f"{columns[2]['text']}\t{columns[1]['text']}\t{score}\n".encode('utf-8'))
+    return f"{max(0, len(rows) - 2)}:{digest.hexdigest()}"
+
+
+@tracing.traced('parse.score_rows')
+def parse_score_rows(rows):
+    """
+    将成绩列表表格行转换为成绩行
+    :param rows: extract_table_rows得到的cjcx_list表格行
+    :return: 成绩行list，格式为[{ 'id': 课程号, 'term': 学期, 'name': 课程名, 'type': 课程性质, 'credit': 学分, 'score': 分数 }]
+    """
+    res = []
+    for columns in rows[2:]:
+        res.append({
+            'id': columns[2]['text'],
+            'term': columns[1]['text'],
+            'name': columns[3]['text'],
+            'type': columns[11]['text'],
+            'credit': float(columns[6]['text']),
+            'score': int(TOTAL_SCORE.search(columns[-1]['onclick']).group(1))})
+    return res
+
+
+def parse_score_list(html):
+    """
+    解析成绩列表页
+    :param html: cjcx_list页面内容
+    :return: 成绩行list，格式同parse_score_rows
+    """
+    return parse_score_rows(extract_table_rows(html))
+
+
+@tracing.traced('parse.score_analysis')
+def parse_score_analysis(html):
+    """
+    解析单门课程的成绩分析页
+    :param html: cjfx页面内容
+    :return: 成绩分析字典，包含班级人数、专业人数、平均分、最高分和各项排名
+    """
+    analyse = soup(html, SoupStrainer('td')).find_all('td')
+    return {
+        'class_total': int(re.search(r'\d+', analyse[1].text)[0]),
+        'majority_total': int(re.search(r'\d+', analyse[2].text)[0]),
+        'average': analyse[4].text.split('：')[1],
+        'max': int(analyse[5].text.split('：')[1]),
+        'class_rank': int(analyse[8].text.split('：')[1].strip('%')) / 100,
+        'majority_rank': int(analyse[9].text.split('：')[1].strip('%')) / 100,
+        'all_rank': int(analyse[10].text.split('：')[1].strip('%')) / 100
+    }
+
+
+class LexuePageExtractor(HTMLParser):
+    """
+    单遍扫描乐学页面，只提取标题、文件链接、活动项和章节链接，不构建文档树
+    """
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ''
+        self.files = []
+        self.instances = []
+        self.sections = []
+        self.containers = {'single-section': 0, 'topics': 0}
+        self.__stack = []
+        self.__in_title = False
+        self.__instance = None
+        self.__section = None
+    
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        parent = self.__stack[-1] if self.__stack else None
+        entry = {'tag': tag, 'href': attrs.get('href'), 'container': None, 'instance': False, 'hide': False,
+                 'section': False, 'link': False}
+        for i in self.containers:
+            if i in classes:
+                entry['container'] = (i, self.containers[i])
+                self.containers[i] += 1
+        if tag == 'title':
+            self.__in_title = True
+        if 'fp-filename' in classes and parent is not None and parent['href'] is not None:
+            self.files.append(parent['href'])
+        if 'instancename' in classes and self.__instance is None:
+            containers = [i['container'] for i in self.__stack if i['container'] is not None]
+            self.__instance = {'href': parent['href'] if parent is not None else None, 'name': '', 'type': None,
+                               'containers': containers}
+            entry['instance'] = True
+        elif 'accesshide' in classes and self.__instance is not None and self.__instance['type'] is None:
+            self.__instance['type'] = ''
+            entry['hide'] = True
+        if 'section-title' in classes and self.__section is None:
+            self.__section = {'href': None, 'name': '', 'closed': False}
+            entry['section'] = True
+        elif tag == 'a' and self.__section is not None and self.__section['href'] is None:
+            self.__section['href'] = attrs.get('href')
+            entry['link'] = True
+        if tag not in VOID_TAGS:
+            self.__stack.append(entry)
+    
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+    
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.__in_title = False
+        if not any(i['tag'] == tag for i in self.__stack):
+            return
+        while self.__stack:
+            entry = self.__stack.pop()
+            if entry['instance']:
+                self.instances.append(self.__instance)
+                self.__instance = None
+            if entry['link']:
+                self.__section['closed'] = True
+            if entry['section']:
+                if self.__section['href'] is not None:
+                    self.sections.append((self.__section['href'], self.__section['name']))
+                self.__section = None
+            if entry['tag'] == tag:
+                break
+    
+    def handle_data(self, data):
+        if self.__in_title:
+            self.title += data
+        if self.__instance is not None:
+            if any(i['hide'] for i in self.__stack):
+                self.__instance['type'] += data
+            else:
+                self.__instance['name'] += data
+        if self.__section is not None and self.__section['href'] is not None and not self.__section['closed']:
+            self.__section['name'] += data
+
+
+@tracing.traced('parse.lexue_page')
+def parse_lexue_page(html):
+    """
+    解析乐学页面，活动项优先取single-section中的，其次取topics中的，都没有时取整个页面的
+    :param html: 页面内容
+    :return: { 'title': 页面标题, 'files': 文件链接list, 'folders': [(链接, 名称)], 'resources': [链接],
+               'sections': [(链接, 名称)] }
+    """
+    extractor = LexuePageExtractor()
+    extractor.feed(html)
+    extractor.close()
+    if extractor.containers['single-section'] > 0:
+        scope = ('single-section', 0)
+    elif extractor.containers['topics'] > 0:
+        scope = ('topics', 0)
+    else:
+        scope = None
+    folders = []
+    resources = []
+    for i in extractor.instances:
+        if i['type'] is None or i['href'] is None or (scope is not None and scope not in i['containers']):
+            continue
+        obj_type = i['type'].strip()
+        if obj_type == '文件夹':
+            folders.append((i['href'], i['name']))
+        elif obj_type == '文件':
+            resources.append(i['href'])
+    return {'title': extractor.title, 'files': extractor.files, 'folders': folders, 'resources': resources,
+            'sections': extractor.sections}
+
+
+@tracing.traced('parse.user_info')
+def parse_user_info(text):
+    """
+    解析学生基本信息接口
+    :param text: cxxsjbxx.do响应内容
+    :return: {'name': 姓名, 'department': 学院}
+    """
+    row = json.loads(text)['datas']['cxxsjbxx']['rows'][0]
+    return {'name': row['XM'], 'department': row['YXMC']}
+
+
+@tracing.traced('parse.current_term')
+def parse_current_term(text):
+    """
+    解析当前学期接口
+    :param text: dqxnxq.do响应内容
+    :return: 当前学期，如2019-2020-1
+    """
+    return json.loads(text)['datas']['dqxnxq']['rows'][0]['DM']
+
+
+@tracing.traced('parse.class_time')
+def parse_class_time(text):
+    """
+    解析上课时间接口
+    :param text: jc.do响应内容
+    :return: 上课时间表，格式{ '第i节': {'begin': datetime,'end': datetime} }
+    """
+    return {i['MC']: {'begin': datetime.datetime.strptime(i['KSSJ'], '%H:%M'),
+                      'end': datetime.datetime.strptime(i['JSSJ'], '%H:%M')}
+            for i in json.loads(text)['datas']['jc']['rows']}
+
+
+@tracing.traced('parse.week_dates')
+def parse_week_dates(text):
+    """
+    解析一周中各天对应日期的接口
+    :param text: cxzkbrq.do响应内容
+    :return: { 星期: 日期datetime }
+    """
+    return {i['XQ']: datetime.datetime.strptime(i['RQ'], '%Y-%m-%d') for i in json.loads(text)['data']}
+
+
+@tracing.traced('parse.week_classes')
+def parse_week_classes(text, dates, class_time):
+    """
+    解析一周课表接口
+    :param text: cxxszhxqkb.do响应内容
+    :param dates: parse_week_dates得到的日期
+    :param class_time: parse_class_time得到的上课时间表
+    :return: 课程信息list，格式为[{ 'name': 课程名, 'location': 上课地点, 'begin': 开始时间, 'end': 结束时间 }]
+    """
+    classes = []
+    for i in json.loads(text)['datas']['cxxszhxqkb']['rows']:
+        classes.append({'name': f"{i['KCM']}-{i['SKJS']}",
+                        'location': f"{i['XXXQMC']}{i['JASMC']}",
+                        'begin': get_datetime(dates[i['SKXQ']], class_time[i['KSJC_DISPLAY']]['begin']),
+                        'end': get_datetime(dates[i['SKXQ']], class_time[i['JSJC_DISPLAY']]['end'])
+                        })
+    return classes
+
+
+@tracing.traced('parse.exams')
+def parse_exams(text):
+    """
+    解析考试安排接口
+    :param text: cxxsksap.do响应内容
+    :return: 考试安排list，格式[{ 'name': 课程名, 'location': 考试地点, 'begin': 开始时间, 'end': 结束时间, 'description': 备注信息 }]
+    """
+    exams = []
+    for i in json.loads(text)['datas']['cxxsksap']['rows']:
+        date = re.findall(r"\d+-\d+-\d+", i['KSSJMS'])[0]
+        exams.append({'name': "%s-%s-%s" % (i['KCM'], i['ZJJSXM'], i['KCH']),
+                      'location': i['JASMC'],
+                      'begin': datetime.datetime.strptime(
+                          date + ' ' + re.findall(r"\d+-\d+-\d+ (\d+:\d+)", i['KSSJMS'])[0],
+                          "%Y-%m-%d %H:%M").replace(tzinfo=TZ),
+                      'end': datetime.datetime.strptime(
+                          date + ' ' + re.findall(r"\d+-\d+-\d+ \d+:\d+-(\d+:\d+)", i['KSSJMS'])[0],
+                          "%Y-%m-%d %H:%M").replace(tzinfo=TZ), 'description': f"座位号：{i['ZWH']}"
+                      })
+    return exams
@@ -0,0 +1,123 @@
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+CIRCUIT_OPEN = metrics.gauge('bit_circuit_open', "主机熔断器是否打开", ('host',))
+RETRIES = metrics.counter('bit_upstream_retries_total', "上游请求重试次数", ('endpoint',))
+
+_failure_threshold = 5
+_recovery_timeout = 30
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def configure(failure_threshold=5, recovery_timeout=30):
+    """
+    设置熔断参数，只影响之后创建的熔断器
+    :param int failure_threshold: 连续失败多少次后打开熔断器
+    :param float recovery_timeout: 打开后多少秒放行一个探测请求
+    :return: 无
+    """
+    global _failure_threshold, _recovery_timeout
+    _failure_threshold = failure_threshold
+    _recovery_timeout = recovery_timeout
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def backoff(attempt, base=0.5, cap=8.0):
+    """
+    计算第attempt次重试前的等待时间，在指数退避上限内均匀随机
+    :param attempt: 重试次数，从1开始
+    :param base: 第一次重试的等待上限，单位秒
+    :param cap: 等待时间上限，单位秒
+    :return: 等待时间，单位秒
+    """
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    主机熔断器
+    - 连续failure_threshold次失败后打开，期间请求直接失败，不访问上游
+    - 打开recovery_timeout秒后放行一个探测请求，成功则关闭，失败则重新打开
+    """
+    
+    def __init__(self, host, failure_threshold=5, recovery_timeout=30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.__failures = 0
+        self.__opened_at = None
+        self.__probe_at = None
+        self.__lock = threading.Lock()
+    
+    def remaining(self):
+        """
+        获取熔断器还要打开多久
+        :return: 剩余时间，单位秒，关闭或可以探测时为0
+        """
+        with self.__lock:
+            if self.__opened_at is None:
+                return 0
+            return max(0.0, self.__opened_at + self.recovery_timeout - time.monotonic())
+    
+    def allow(self):
+        """
+        判断是否可以发送请求，熔断器打开超过recovery_timeout后只放行一个探测请求
+        :return: 需要等待的时间，单位秒，可以发送时为0
+        """
+        with self.__lock:
+            if self.__opened_at is None:
+                return 0
+            remaining = self.__opened_at + self.recovery_timeout - time.monotonic()
+            if remaining > 0:
+                return remaining
+            # 探测请求没有结果（如抛出了与网络无关的异常）时，超过recovery_timeout后再放行一个
+            if self.__probe_at is not None and time.monotonic() - self.__probe_at < self.recovery_timeout:
+                return 1.0
+            self.__probe_at = time.monotonic()
+            return 0
+    
+    def success(self):
+        """
+        记录一次成功的请求
+        :return: 无
+        """
+        with self.__lock:
+            recovered = self.__opened_at is not None
+            self.__failures = 0
+            self.__opened_at = None
+            self.__probe_at = None
+        if recovered:
+            CIRCUIT_OPEN.set(self.host, value=0)
+            logging.info(f"{self.host} 已恢复，关闭熔断器")
+    
+    def failure(self):
+        """
+        记录一次失败的请求
+        :return: 无
+        """
+        with self.__lock:
+            self.__failures += 1
+            if self.__probe_at is None and (self.__opened_at is not None or self.__failures < self.failure_threshold):
+                return
+            self.__opened_at = time.monotonic()
+            self.__probe_at = None
+        CIRCUIT_OPEN.set(self.host, value=1)
+        logging.warning(f"{self.host} 连续失败{self.__failures}次，打开熔断器{self.recovery_timeout}秒")
+
+
+def breaker(host):
+    """
+    获取主机的熔断器
+    :param host: 主机名
+    :return: CircuitBreaker
+    """
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host, _failure_threshold, _recovery_timeout)
+        return _breakers[host]
@@ -0,0 +1,177 @@
+import datetime
+import logging
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import bit
+import tracing
+
+DAY = 24 * 60 * 60
+
+
+def in_periods(date, periods):
+    """
+    判断日期是否在某个时间段内
+    :param date: 日期
+    :param periods: 时间段list，格式[('MM-DD', 'MM-DD')]，开始晚于结束时视为跨年
+    :return: 是否在时间段内
+    """
+    day = date.strftime('%m-%d')
+    for begin, end in periods:
+        if (begin <= day <= end) if begin <= end else (day >= begin or day <= end):
+            return True
+    return False
+
+
+class RefreshScheduler:
+    """
+    按用户安排成绩检查，每个用户有各自的下次检查时间，替代每天固定时间集中检查所有用户
+    - 平时每个用户每base_interval秒检查一次，出成绩的时间段内缩短为release_interval
+    - 最近recent_window秒内有新成绩的用户缩短为active_interval
+    - 连续失败的用户按2的失败次数次方退避，最长max_backoff秒
+    - 所有检查间隔加上±jitter比例的随机抖动
+    - 所有上游请求共享每分钟rpm个请求的预算，每个检查预估消耗request_cost个请求
+    - 学校服务器熔断期间暂停启动检查，因熔断失败的检查在熔断器关闭后重新排队，不计为失败
+    """
+    
+    def __init__(self, storage, check, workers=8, rpm=120, request_cost=3, base_interval=DAY,
+                 release_interval=3 * 60 * 60, active_interval=4 * 60 * 60, recent_window=14 * DAY,
+                 release_periods=(), max_backoff=7 * DAY, jitter=0.2):
+        """
+        :param storage: SqliteStorage
+        :param check: 检查单个用户的函数，参数为(任务上下文, Telegram ChatID)，返回'notified'、'unchanged'或'checked'，失败时抛出异常
+        """
+        self.__storage = storage
+        self.__check = check
+        self.__workers = workers
+        self.__rpm = rpm
+        self.__request_cost = request_cost
+        self.__base_interval = base_interval
+        self.__release_interval = release_interval
+        self.__active_interval = active_interval
+        self.__recent_window = recent_window
+        self.__release_periods = [tuple(i) for i in release_periods]
+        self.__max_backoff = max_backoff
+        self.__jitter = jitter
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__lock = threading.Lock()
+        self.__in_flight = set()
+        self.__tokens = float(rpm)
+        self.__last_tick = time.monotonic()
+        self.__last_requests = bit.request_count()
+        self.__stats = {'checks': 0, 'failed': 0, 'notified': 0, 'unchanged': 0, 'deferred': 0}
+        self.__stats_since = time.monotonic()
+    
+    def next_interval(self, failures, last_change, now):
+        """
+        计算下次检查的间隔
+        :param failures: 连续失败次数
+        :param last_change: 上次成绩变化时间戳，没有时为None
+        :param now: 当前时间戳
+        :return: 间隔，单位秒
+        """
+        interval = self.__base_interval
+        if in_periods(datetime.date.fromtimestamp(now), self.__release_periods):
+            interval = min(interval, self.__release_interval)
+        if last_change is not None and now - last_change < self.__recent_window:
+            interval = min(interval, self.__active_interval)
+        if failures > 0:
+            interval = min(interval * 2 ** failures, self.__max_backoff)
+        return interval * random.uniform(1 - self.__jitter, 1 + self.__jitter)
+    
+    def __refill(self):
+        """
+        按时间补充请求预算，并扣除上次补充以来实际发出的请求
+        :return: 可用预算
+        """
+        now = time.monotonic()
+        requests = bit.request_count()
+        self.__tokens = min(self.__rpm, self.__tokens + (now - self.__last_tick) * self.__rpm / 60)
+        self.__tokens -= requests - self.__last_requests
+        self.__last_tick = now
+        self.__last_requests = requests
+        return self.__tokens
+    
+    def __run(self, context, tgid, failures, last_change):
+        now = time.time()
+        try:
+            with tracing.trace('refresh', tgid=tgid):
+                result = self.__check(context, tgid)
+        except bit.UpstreamUnavailable as e:
+            # 学校服务器熔断不计为该用户的失败，熔断器关闭后重新排队
+            result = 'deferred'
+            next_check = now + e.retry_after + random.uniform(0, 60)
+        except Exception as e:
+            failures += 1
+            result = 'failed'
+            logging.error(f"为{tgid}更新成绩失败（连续{failures}次）：{repr(e)}")
+            logging.debug(traceback.format_exc())
+        else:
+            failures = 0
+            if result == 'notified':
+                last_change = now
+        if result != 'deferred':
+            next_check = now + self.next_interval(failures, last_change, now)
+        try:
+            self.__storage.update_schedule(tgid, next_check, failures, last_change)
+        finally:
+            with self.__lock:
+                self.__in_flight.discard(tgid)
+                if result != 'deferred':
+                    self.__stats['checks'] += 1
+                if result in self.__stats:
+                    self.__stats[result] += 1
+    
+    def tick(self, context=None):
+        """
+        安排新用户并在预算内启动到期的检查，由job_queue定期调用
+        :param context: 任务上下文，传给检查函数
+        :return: 本次启动的检查数
+        """
+        now = time.time()
+        self.__storage.schedule_new_users(now, self.__base_interval)
+        paused = bit.upstream_wait()
+        if paused > 0:
+            logging.info(f"学校服务器熔断中，{round(paused)}秒内暂停成绩检查")
+            self.__report()
+            return 0
+        with self.__lock:
+            # 进行中的检查按预估消耗预留预算，实际发出的请求在补充时扣除
+            budget = self.__refill() - len(self.__in_flight) * self.__request_cost
+            slots = self.__workers * 2 - len(self.__in_flight)
+            limit = min(int(budget // self.__request_cost), slots)
+            due = []
+            if limit > 0:
+                due = [i for i in self.__storage.get_due_users(now, limit + len(self.__in_flight))
+                       if i[0] not in self.__in_flight][:limit]
+            for tgid, _, _ in due:
+                self.__in_flight.add(tgid)
+        for tgid, failures, last_change in due:
+            self.__executor.submit(self.__run, context, tgid, failures or 0, last_change)
+        self.__report()
+        return len(due)
+    
+    def __report(self):
+        """
+        每小时输出一次检查统计
+        :return: 无
+        """
+        with self.__lock:
+            elapsed = time.monotonic() - self.__stats_since
+            if elapsed < 60 * 60:
+                return
+            stats = self.__stats
+            self.__stats = {'checks': 0, 'failed': 0, 'notified': 0, 'unchanged': 0, 'deferred': 0}
+            self.__stats_since = time.monotonic()
+        checked = stats['checks'] - stats['failed']
+        logging.info(f"最近{round(elapsed / 60)}分钟检查成绩{stats['checks']}次，失败{stats['failed']}次，"
+                     f"推送{stats['notified']}次，成绩列表未变化跳过{stats['unchanged']}次"
+                     f"（命中率{round(stats['unchanged'] / checked * 100, 1) if checked else 0}%），"
+                     f"因学校服务器熔断推迟{stats['deferred']}次，"
+                     f"剩余请求预算{round(self.__tokens)}")
+    
+    def shutdown(self):
+        self.__executor.shutdown(wait=False)
@@ -0,0 +1,210 @@
+import contextlib
+import contextvars
+import functools
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+_sample_rate = 0.0
+_directory = 'traces'
+_min_duration = 0.0
+_format = 'chrome'
+# 当前上下文中的(Trace, 当前span的ID)，未采样时为None
+_current = contextvars.ContextVar('trace', default=None)
+
+
+def configure(sample_rate=0.0, directory='traces', min_duration=0.0, fmt='chrome'):
+    """
+    设置追踪参数
+    :param float sample_rate: 采样率，0为关闭，1为追踪所有请求
+    :param str directory: 追踪文件保存目录
+    :param float min_duration: 只保存耗时不少于该值的追踪，单位秒
+    :param str fmt: 'chrome'为Chrome trace格式，可用chrome://tracing、Perfetto或speedscope查看火焰图；'json'为嵌套的span树
+    :return: 无
+    """
+    global _sample_rate, _directory, _min_duration, _format
+    if fmt not in ('chrome', 'json'):
+        raise ValueError(f"未知的追踪格式 {fmt}")
+    _sample_rate = sample_rate
+    _directory = directory
+    _min_duration = min_duration
+    _format = fmt
+
+
+class Trace:
+    """
+    一次请求的追踪，记录所有嵌套span的开始时间和耗时
+    """
+    
+    def __init__(self, name, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.spans = []
+        self.__ids = itertools.count(1)
+    
+    def begin(self, name, parent, attrs):
+        span = {'id': next(self.__ids), 'parent': parent, 'name': name, 'thread': threading.get_ident(),
+                'start': time.time(), 'duration': None, 'attrs': attrs}
+        self.spans.append(span)
+        return span
+    
+    @property
+    def duration(self):
+        return self.spans[0]['duration'] if self.spans and self.spans[0]['duration'] is not None else 0.0
+    
+    def to_chrome(self):
+        """
+        转换为Chrome trace格式
+        :return: 字典，格式{ 'traceEvents': [...], 'displayTimeUnit': 'ms' }
+        """
+        threads = {}
+        events = []
+        for span in self.spans:
+            tid = threads.setdefault(span['thread'], len(threads) + 1)
+            events.append({'name': span['name'], 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': round((span['start'] - self.start) * 1e6),
+                           'dur': round((span['duration'] or 0) * 1e6), 'args': span['attrs']})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': {'name': self.name, **self.attrs}}
+    
+    def to_tree(self):
+        """
+        转换为嵌套的span树
+        :return: 字典，格式{ 'name', 'start': 相对追踪开始的秒数, 'duration': 秒, 'attrs', 'children': [...] }
+        """
+        nodes = {}
+        roots = []
+        for span in self.spans:
+            node = {'name': span['name'], 'start': round(span['start'] - self.start, 6),
+                    'duration': None if span['duration'] is None else round(span['duration'], 6),
+                    'attrs': span['attrs'], 'children': []}
+            nodes[span['id']] = node
+            parent = nodes.get(span['parent'])
+            (parent['children'] if parent is not None else roots).append(node)
+        return {'name': self.name, 'attrs': self.attrs, 'spans': roots}
+    
+    def dump(self, directory=None, fmt=None):
+        """
+        保存为追踪文件
+        :param directory: 保存目录，默认为configure设置的目录
+        :param fmt: 'chrome'或'json'，默认为configure设置的格式
+        :return: 文件路径
+        """
+        directory = directory or _directory
+        fmt = fmt or _format
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.start))
+        filename = f"{stamp}-{int(self.start * 1000) % 1000:03d}-{self.name}-" \
+                   f"{'-'.join(str(v) for v in self.attrs.values())}.json"
+        path = os.path.join(directory, filename.replace(os.sep, '_'))
+        with open(path, 'w', encoding='UTF-8') as f:
+            json.dump(self.to_chrome() if fmt == 'chrome' else self.to_tree(), f, ensure_ascii=False, default=str)
+        return path
+
+
+@contextlib.contextmanager
+def trace(name, force=False, **attrs):
+    """
+    按采样率开始一次追踪，整个with块为根span，结束时保存追踪文件
+    :param name: 追踪名，如命令名
+    :param force: 是否忽略采样率强制追踪
+    :param attrs: 附加信息，如ChatID
+    :return: 上下文管理器，值为Trace，未采样时为None
+    """
+    if _current.get() is not None or not (force or (_sample_rate > 0 and random.random() < _sample_rate)):
+        yield None
+        return
+    current = Trace(name, **attrs)
+    root = current.begin(name, None, attrs)
+    token = _current.set((current, root['id']))
+    try:
+        yield current
+    finally:
+        root['duration'] = time.time() - root['start']
+        _current.reset(token)
+        if current.duration >= _min_duration:
+            try:
+                path = current.dump()
+                logging.debug(f"已保存追踪 {path}")
+            except OSError as e:
+                logging.error(f"保存追踪失败：{repr(e)}")
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    在当前追踪中记录一个span，没有进行中的追踪时不做任何事
+    :param name: span名
+    :param attrs: 附加信息
+    :return: 上下文管理器
+    """
+    current = _current.get()
+    if current is None:
+        yield
+        return
+    record = current[0].begin(name, current[1], attrs)
+    token = _current.set((current[0], record['id']))
+    try:
+        yield
+    finally:
+        record['duration'] = time.time() - record['start']
+        _current.reset(token)
+
+
+def traced(name):
+    """
+    函数装饰器，将每次调用记录为一个span
+    :param name: span名
+    :return: 装饰器
+    """
+    
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+        
+        return wrapper
+    
+    return decorator
+
+
+def trace_handler(command):
+    """
+    命令处理函数装饰器，按采样率追踪整个命令的处理过程
+    :param command: 命令名
+    :return: 装饰器
+    """
+    
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(update, context):
+            with trace(command, chat_id=update.effective_chat.id):
+                return handler(update, context)
+        
+        return wrapper
+    
+    return decorator
+
+
+def wrap(func):
+    """
+    让提交到线程池的函数在当前追踪中执行，其中的span记录为当前span的子span
+    :param func: 函数
+    :return: 包装后的函数
+    """
+    if _current.get() is None:
+        return func
+    context = contextvars.copy_context()
+    
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    
+    return wrapper